@@ -0,0 +1,329 @@
+/*
+ * Diecast Remote Raceway - Race Coordination Cluster
+ *
+ * Runs the Race Coordination Server (drr_server.js) as several worker processes behind the
+ * one public port, so a busy coordinator can use every core and a crashed worker only
+ * takes down the circuits it owned.
+ *
+ * Usage:
+ *
+ *    % DRR_WORKERS=4 node drr_cluster.js
+ *    % kill -USR2 <pid of drr_cluster.js>          # Add a worker
+ *
+ *    DRR_PORT               Public port of the router.  Defaults to 1968.
+ *    DRR_WORKERS            Number of workers to start with.  Defaults to the number of CPUs.
+ *    DRR_WORKER_BASE_PORT   Worker n listens on 127.0.0.1 at this port + n.  Defaults to the
+ *                           router's port + 1.
+ *    DRR_STORE              Path of the SQLite membership store shared with the workers.
+ *
+ * Running a single drr_server.js, without this router, remains supported and needs no store.
+ *
+ * StartingGate/drr_cluster_check.py runs the cluster on localhost and checks its routing and
+ * failover with real Coordinator clients.
+ *
+ * Routing
+ *
+ *   Every circuit is owned by one worker, which holds all of its barriers and heats.  The
+ *   router assigns the owner of a new circuit by consistent hashing of the circuit name on a
+ *   ring of the workers, and records it in the membership store (see drr_store.js).  Each
+ *   request is forwarded to the owner of its circuit:
+ *
+ *    /register         The circuit in the registration
+ *    /channel          The circuit query parameter of the WebSocket URL
+ *    /skew             Every worker, merging their reports
+ *    /metrics          Every worker, merging their metrics, which are labelled by worker
+ *    anything else     The circuit of the session, from the X-DRR-Session header or the
+ *                      client's address, as recorded by its worker.  Requests from tracks
+ *                      that aren't registered go to the owner of the default circuit.
+ *
+ *   The router passes the track's address to the worker in X-Forwarded-For.
+ *
+ *   Adding a worker only changes where new circuits are placed.  Circuits that already have
+ *   members stay with their owner, so their waiting barriers are undisturbed, and are
+ *   released to be placed afresh once they empty.  A worker that exits is restarted, recovers
+ *   its circuits from its journal (see drr_journal.js) and keeps them, and its tracks resume
+ *   their sessions with it.
+ *
+ * Linux Installation:
+ *
+ *    % npm install better-sqlite3 --save
+ *
+ */
+
+/* Imports */
+require('log-timestamp')
+const cluster = require('cluster')
+const crypto = require('crypto')
+const http = require('http')
+const net = require('net')
+const os = require('os')
+const path = require('path')
+const cron = require('node-cron')
+const { MembershipStore } = require('./drr_store')
+const { mergeExpositions } = require('./drr_metrics')
+
+/* Globals */
+const port = Number(process.env.DRR_PORT) || 1968
+const hostname = os.hostname()
+const defaultCircuit = 'DRR'
+const sessionHeader = 'x-drr-session'
+const workerCount = Number(process.env.DRR_WORKERS) || os.cpus().length
+const workerBasePort = Number(process.env.DRR_WORKER_BASE_PORT) || port + 1
+const storePath = process.env.DRR_STORE || path.join(os.tmpdir(), `drr-${port}.sqlite`)
+
+// Points per worker on the hash ring.  More points spread circuits more evenly.
+const virtualNodes = 64
+
+// Delay before restarting a worker that exited, so one that fails at startup doesn't spin
+const restartMilliseconds = 1000
+
+// Age past which a circuit without members is released
+const releaseMilliseconds = 60 * 1000
+
+/*
+ * A consistent hash ring of workers.  Adding or removing a worker only moves the keys
+ * adjacent to its points on the ring.
+ */
+class HashRing {
+    constructor(virtualNodes) {
+        this.virtualNodes = virtualNodes
+        this.points = []    // {hash, worker}, in order of hash
+        this.members = new Set()
+    }
+
+    add(worker) {
+        this.members.add(worker)
+        for (let i = 0; i < this.virtualNodes; i++) {
+            this.points.push({hash: ringHash(`${worker}#${i}`), worker: worker})
+        }
+        this.points.sort((a, b) => a.hash - b.hash)
+    }
+
+    remove(worker) {
+        this.members.delete(worker)
+        this.points = this.points.filter(point => point.worker !== worker)
+    }
+
+    lookup(key) {
+        if (this.points.length == 0) {
+            return undefined
+        }
+        const hash = ringHash(key)
+        let low = 0
+        let high = this.points.length
+        while (low < high) {
+            const middle = (low + high) >>> 1
+            if (this.points[middle].hash < hash) {
+                low = middle + 1
+            } else {
+                high = middle
+            }
+        }
+        return this.points[low % this.points.length].worker
+    }
+}
+
+function ringHash(key) {
+    return crypto.createHash('md5').update(key).digest().readUInt32BE(0)
+}
+
+function workerPort(worker) {
+    return workerBasePort + worker
+}
+
+/*
+ * Primary: start the workers and route requests to them
+ */
+if (cluster.isPrimary) {
+    const ring = new HashRing(virtualNodes)
+    const workers = new Map()   // worker number -> cluster Worker
+    const store = new MembershipStore(storePath)
+    let nextWorker = 0
+    let shuttingDown = false
+
+    store.reset()
+    cluster.setupPrimary({exec: path.join(__dirname, 'drr_server.js')})
+
+    function startWorker(id) {
+        const worker = cluster.fork({
+            DRR_WORKER_ID: id,
+            DRR_PORT: workerPort(id),
+            DRR_STORE: storePath
+        })
+        workers.set(id, worker)
+        worker.on('listening', function() {
+            console.log(`worker ${id} listening on port ${workerPort(id)}`)
+            ring.add(id)
+        })
+        worker.on('exit', function(code, signal) {
+            console.log(`worker ${id} exited (${signal || code})`)
+            ring.remove(id)
+            workers.delete(id)
+            if (!shuttingDown) {
+                setTimeout(() => startWorker(id), restartMilliseconds)
+            }
+        })
+    }
+
+    /*
+     * The worker owning circuit, assigning one from the ring if it has none
+     */
+    function circuitOwner(circuit) {
+        const owner = store.ownerOf(circuit)
+        if (owner !== undefined) {
+            return owner    // Even while it restarts, as it recovers its circuits
+        }
+        const candidate = ring.lookup(circuit)
+        return candidate === undefined ? undefined : store.assign(circuit, candidate)
+    }
+
+    function sessionCircuit(req) {
+        const session = req.headers[sessionHeader] || req.socket.remoteAddress
+        return store.circuitOf(session) || defaultCircuit
+    }
+
+    function readBody(req) {
+        return new Promise((resolve, reject) => {
+            const chunks = []
+            req.on('data', chunk => chunks.push(chunk))
+            req.on('end', () => resolve(Buffer.concat(chunks)))
+            req.on('error', reject)
+        })
+    }
+
+    function registrationCircuit(body) {
+        try {
+            const registration = JSON.parse(body)
+            return 'circuit' in registration ? registration.circuit : defaultCircuit
+        } catch (err) {
+            return defaultCircuit   // Let the worker reject it
+        }
+    }
+
+    function proxyRequest(req, res, worker, body) {
+        if (worker === undefined) {
+            res.writeHead(503, {'Retry-After': Math.ceil(restartMilliseconds / 1000)})
+            res.end('No race coordinator workers are running')
+            return
+        }
+        const headers = Object.assign({}, req.headers, {'x-forwarded-for': req.socket.remoteAddress})
+        const upstream = http.request({host: '127.0.0.1', port: workerPort(worker),
+            method: req.method, path: req.url, headers: headers}, function(upstreamRes) {
+            res.writeHead(upstreamRes.statusCode, upstreamRes.headers)
+            upstreamRes.pipe(res)
+        })
+        upstream.on('error', function(err) {
+            console.log(`worker ${worker}: ${req.method} ${req.url} failed: ${err.message}`)
+            if (!res.headersSent) {
+                res.writeHead(503, {'Retry-After': Math.ceil(restartMilliseconds / 1000)})
+            }
+            res.end()
+        })
+        // A track that gives up on a long poll abandons the forwarded request too
+        res.on('close', function() {
+            if (!res.writableFinished) {
+                upstream.destroy()
+            }
+        })
+        if (body !== null) {
+            upstream.end(body)
+        } else {
+            req.pipe(upstream)
+        }
+    }
+
+    async function gatherSkew(res) {
+        const reports = await Promise.all(Array.from(ring.members, worker =>
+            fetch(`http://127.0.0.1:${workerPort(worker)}/skew`)
+                .then(reply => reply.json())
+                .catch(() => ({}))))
+        res.writeHead(200, {'Content-Type': 'application/json'})
+        res.end(JSON.stringify(Object.assign({}, ...reports)))
+    }
+
+    async function gatherMetrics(res) {
+        const texts = await Promise.all(Array.from(ring.members, worker =>
+            fetch(`http://127.0.0.1:${workerPort(worker)}/metrics`)
+                .then(reply => reply.text())
+                .catch(() => '')))
+        res.writeHead(200, {'Content-Type': 'text/plain; version=0.0.4'})
+        res.end(mergeExpositions(texts))
+    }
+
+    const router = http.createServer(async function(req, res) {
+        const url = new URL(req.url, 'http://localhost')
+        try {
+            if (url.pathname === '/skew') {
+                await gatherSkew(res)
+            } else if (url.pathname === '/metrics') {
+                await gatherMetrics(res)
+            } else if (req.method === 'POST' && url.pathname === '/register') {
+                const body = await readBody(req)
+                proxyRequest(req, res, circuitOwner(registrationCircuit(body)), body)
+            } else {
+                proxyRequest(req, res, circuitOwner(sessionCircuit(req)), null)
+            }
+        } catch (err) {
+            console.log(`${req.method} ${req.url} failed: ${err.message}`)
+            res.destroy()
+        }
+    })
+
+    /* Forward channel WebSockets, byte for byte, to the worker owning their circuit */
+    router.on('upgrade', function(req, socket, head) {
+        const url = new URL(req.url, 'http://localhost')
+        const worker = circuitOwner(url.searchParams.get('circuit') || defaultCircuit)
+        if (worker === undefined) {
+            socket.end('HTTP/1.1 503 Service Unavailable\r\n\r\n')
+            return
+        }
+        const upstream = net.connect(workerPort(worker), '127.0.0.1', function() {
+            let request = `${req.method} ${req.url} HTTP/${req.httpVersion}\r\n`
+            for (let i = 0; i < req.rawHeaders.length; i += 2) {
+                if (req.rawHeaders[i].toLowerCase() !== 'x-forwarded-for') {
+                    request += `${req.rawHeaders[i]}: ${req.rawHeaders[i + 1]}\r\n`
+                }
+            }
+            request += `X-Forwarded-For: ${req.socket.remoteAddress}\r\n\r\n`
+            upstream.write(request)
+            upstream.write(head)
+            socket.pipe(upstream).pipe(socket)
+        })
+        upstream.on('error', () => socket.destroy())
+        socket.on('error', () => upstream.destroy())
+        upstream.on('close', () => socket.destroy())
+        socket.on('close', () => upstream.destroy())
+    })
+
+    // Release circuits that have emptied, so they are placed on the current workers
+    cron.schedule('* * * * *', function() {
+        const released = store.sweep(releaseMilliseconds)
+        if (released > 0) {
+            console.log(`released ${released} empty circuits`)
+        }
+    })
+
+    process.on('SIGUSR2', function() {
+        console.log(`adding worker ${nextWorker}`)
+        startWorker(nextWorker++)
+    })
+
+    for (const signal of ['SIGINT', 'SIGTERM']) {
+        process.on(signal, function() {
+            shuttingDown = true
+            for (const worker of workers.values()) {
+                worker.kill()
+            }
+            store.close()
+            process.exit(0)
+        })
+    }
+
+    /* Ladies and gentlemen, start your servers! */
+    while (nextWorker < workerCount) {
+        startWorker(nextWorker++)
+    }
+    router.listen(port, () => console.log(`Raceway router listening at http://${hostname}:${port} for ${workerCount} workers`))
+}
+
+// vim: expandtab: sw=4
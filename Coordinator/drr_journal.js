@@ -0,0 +1,107 @@
+/*
+ * Diecast Remote Raceway - Coordinator Journal
+ *
+ * Durable record of the coordinator's circuit state, so a restarted coordinator picks up
+ * where it left off instead of sending every track back through registration.
+ *
+ * The state is kept as a snapshot plus an append-only journal of the changes since:
+ *
+ *    <directory>/snapshot.json     The whole state, as of journal record number seq
+ *    <directory>/journal.log       One JSON record per line, each numbered by seq
+ *
+ * Each change is appended to the journal as it happens.  The journal is compacted
+ * periodically, and whenever it grows past a threshold, by writing a fresh snapshot beside
+ * the old one, renaming it into place and starting an empty journal.  A crash at any point
+ * leaves a snapshot and a journal that together hold every change: records already in the
+ * snapshot are recognized by their seq and skipped on load, and a record torn by a crash
+ * mid-append is discarded.
+ *
+ * Appends are written straight to the file, so they survive the coordinator process dying.
+ * They are not synced to disk, so the last few may be lost if the whole host fails.
+ */
+
+/* Imports */
+const fs = require('fs')
+const path = require('path')
+
+class Journal {
+    constructor(directory) {
+        fs.mkdirSync(directory, {recursive: true})
+        this.snapshotPath = path.join(directory, 'snapshot.json')
+        this.journalPath = path.join(directory, 'journal.log')
+        this.seq = 0        // Number of the last record written
+        this.records = 0    // Records appended since the last compaction
+        this.fd = null
+    }
+
+    /*
+     * Read the snapshot and the journal records written after it, and open the journal for
+     * appending.  Returns {snapshot, records}, with a null snapshot if there is none.
+     */
+    load() {
+        let snapshot = null
+        if (fs.existsSync(this.snapshotPath)) {
+            snapshot = JSON.parse(fs.readFileSync(this.snapshotPath, 'utf8'))
+            this.seq = snapshot.seq
+        }
+
+        const records = []
+        let torn = false
+        if (fs.existsSync(this.journalPath)) {
+            const contents = fs.readFileSync(this.journalPath, 'utf8')
+            torn = contents.length > 0 && !contents.endsWith('\n')
+            const lines = contents.split('\n')
+            for (const line of lines) {
+                if (line.length == 0) {
+                    continue
+                }
+                let record
+                try {
+                    record = JSON.parse(line)
+                } catch (err) {
+                    console.log(`journal: discarding torn record ${line}`)
+                    continue
+                }
+                if (record.seq > this.seq) {
+                    records.push(record)
+                    this.seq = record.seq
+                }
+            }
+        }
+
+        this.records = records.length
+        this.fd = fs.openSync(this.journalPath, 'a')
+        if (torn) {
+            fs.writeSync(this.fd, '\n')     // Keep the next record off the torn line
+        }
+        return {snapshot: snapshot, records: records}
+    }
+
+    append(record) {
+        record.seq = ++this.seq
+        fs.writeSync(this.fd, JSON.stringify(record) + '\n')
+        this.records++
+    }
+
+    /*
+     * Replace the snapshot with snapshot, the whole state as of the last record appended,
+     * and empty the journal
+     */
+    compact(snapshot) {
+        snapshot.seq = this.seq
+        const temporary = this.snapshotPath + '.tmp'
+        const fd = fs.openSync(temporary, 'w')
+        fs.writeSync(fd, JSON.stringify(snapshot))
+        fs.fsyncSync(fd)
+        fs.closeSync(fd)
+        fs.renameSync(temporary, this.snapshotPath)
+
+        fs.closeSync(this.fd)
+        this.fd = fs.openSync(this.journalPath, 'w')
+        this.records = 0
+    }
+}
+
+module.exports = { Journal }
+
+// vim: expandtab: sw=4
@@ -0,0 +1,220 @@
+/*
+ * Diecast Remote Raceway - Coordinator Metrics
+ *
+ * Counters, gauges and histograms for the coordinator's /metrics endpoint, rendered in the
+ * Prometheus text exposition format so any Prometheus compatible scraper, or curl, can read
+ * them.
+ *
+ * Each metric holds one series per distinct set of label values.  Series are created on
+ * first use and can be removed, e.g. when the circuit or track they describe goes away, so
+ * the number of series stays bounded by the tracks currently registered.
+ */
+
+/* Globals */
+
+// Default histogram buckets, in seconds, for request handling and for barrier waits
+const latencyBuckets = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+const waitBuckets = [0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600]
+
+function escapeLabel(value) {
+    return String(value).replace(/\\/g, '\\\\').replace(/"/g, '\\"').replace(/\n/g, '\\n')
+}
+
+function labelText(names, values) {
+    if (names.length == 0) {
+        return ''
+    }
+    return '{' + names.map((name, i) => `${name}="${escapeLabel(values[i])}"`).join(',') + '}'
+}
+
+class Metric {
+    constructor(registry, name, help, type, labelNames) {
+        this.registry = registry
+        this.name = name
+        this.help = help
+        this.type = type
+        this.labelNames = registry.constLabelNames.concat(labelNames)
+        this.series = new Map()     // label values joined -> {values, ...}
+    }
+
+    seriesFor(labels) {
+        const values = this.registry.constLabelValues.concat(
+            this.labelNames.slice(this.registry.constLabelNames.length).map(name => String(labels[name])))
+        const key = values.join('\u0000')
+        let series = this.series.get(key)
+        if (series === undefined) {
+            series = this.newSeries(values)
+            this.series.set(key, series)
+        }
+        return series
+    }
+
+    /*
+     * Remove every series whose labels include all of the given labels
+     */
+    remove(labels) {
+        const entries = Object.entries(labels).map(([name, value]) =>
+            [this.labelNames.indexOf(name), String(value)])
+        for (const [key, series] of this.series) {
+            if (entries.every(([index, value]) => series.values[index] === value)) {
+                this.series.delete(key)
+            }
+        }
+    }
+
+    reset() {
+        this.series.clear()
+    }
+
+    render(lines) {
+        lines.push(`# HELP ${this.name} ${this.help}`)
+        lines.push(`# TYPE ${this.name} ${this.type}`)
+        for (const series of this.series.values()) {
+            this.renderSeries(lines, series)
+        }
+    }
+}
+
+class Counter extends Metric {
+    constructor(registry, name, help, labelNames) {
+        super(registry, name, help, 'counter', labelNames)
+    }
+
+    newSeries(values) {
+        return {values: values, value: 0}
+    }
+
+    inc(labels, value = 1) {
+        this.seriesFor(labels).value += value
+    }
+
+    renderSeries(lines, series) {
+        lines.push(`${this.name}${labelText(this.labelNames, series.values)} ${series.value}`)
+    }
+}
+
+class Gauge extends Counter {
+    constructor(registry, name, help, labelNames) {
+        super(registry, name, help, labelNames)
+        this.type = 'gauge'
+    }
+
+    set(labels, value) {
+        this.seriesFor(labels).value = value
+    }
+}
+
+class Histogram extends Metric {
+    constructor(registry, name, help, labelNames, buckets) {
+        super(registry, name, help, 'histogram', labelNames)
+        this.buckets = buckets
+    }
+
+    newSeries(values) {
+        return {values: values, counts: new Array(this.buckets.length).fill(0), sum: 0, count: 0}
+    }
+
+    observe(labels, value) {
+        const series = this.seriesFor(labels)
+        for (let i = 0; i < this.buckets.length; i++) {
+            if (value <= this.buckets[i]) {
+                series.counts[i]++
+            }
+        }
+        series.sum += value
+        series.count++
+    }
+
+    renderSeries(lines, series) {
+        const names = this.labelNames.concat(['le'])
+        for (let i = 0; i < this.buckets.length; i++) {
+            lines.push(`${this.name}_bucket${labelText(names, series.values.concat([this.buckets[i]]))} ${series.counts[i]}`)
+        }
+        lines.push(`${this.name}_bucket${labelText(names, series.values.concat(['+Inf']))} ${series.count}`)
+        lines.push(`${this.name}_sum${labelText(this.labelNames, series.values)} ${series.sum}`)
+        lines.push(`${this.name}_count${labelText(this.labelNames, series.values)} ${series.count}`)
+    }
+}
+
+/*
+ * The metrics of one server.  constLabels are added to every series, e.g. to tell the
+ * workers of drr_cluster.js apart.  Collectors registered with onCollect() run before each
+ * render, to set gauges read from the server's state.
+ */
+class Registry {
+    constructor(constLabels = {}) {
+        this.constLabelNames = Object.keys(constLabels)
+        this.constLabelValues = Object.values(constLabels).map(String)
+        this.metrics = []
+        this.collectors = []
+    }
+
+    counter(name, help, labelNames = []) {
+        return this.add(new Counter(this, name, help, labelNames))
+    }
+
+    gauge(name, help, labelNames = []) {
+        return this.add(new Gauge(this, name, help, labelNames))
+    }
+
+    histogram(name, help, labelNames = [], buckets = latencyBuckets) {
+        return this.add(new Histogram(this, name, help, labelNames, buckets))
+    }
+
+    add(metric) {
+        this.metrics.push(metric)
+        return metric
+    }
+
+    onCollect(collector) {
+        this.collectors.push(collector)
+    }
+
+    render() {
+        for (const collector of this.collectors) {
+            collector()
+        }
+        let lines = []
+        for (const metric of this.metrics) {
+            metric.render(lines)
+        }
+        return lines.join('\n') + '\n'
+    }
+}
+
+/*
+ * Merge the metrics rendered by several servers, each with its own constant labels, into
+ * one exposition, keeping the samples of each metric together under a single HELP and TYPE
+ */
+function mergeExpositions(texts) {
+    const families = new Map()  // metric name -> lines
+    for (const text of texts) {
+        let family = null
+        for (const line of text.split('\n')) {
+            if (line.length == 0) {
+                continue
+            }
+            const comment = line.match(/^# (HELP|TYPE) (\S+)/)
+            if (comment !== null) {
+                if (!families.has(comment[2])) {
+                    families.set(comment[2], {header: [], samples: []})
+                }
+                family = families.get(comment[2])
+                if (family.header.length < 2) {
+                    family.header.push(line)
+                }
+            } else if (family !== null) {
+                family.samples.push(line)
+            }
+        }
+    }
+    let lines = []
+    for (const family of families.values()) {
+        lines.push(...family.header, ...family.samples)
+    }
+    return lines.join('\n') + '\n'
+}
+
+module.exports = { Registry, mergeExpositions, latencyBuckets, waitBuckets }
+
+// vim: expandtab: sw=4
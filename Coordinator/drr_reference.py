@@ -0,0 +1,819 @@
+#! /usr/bin/python3
+
+"""
+Diecast Remote Raceway - Reference Race Coordinator
+
+A Python asyncio implementation of the Race Coordination Server's contract, for testing
+the Starting Gate and measuring coordinator overhead without a Node.js install.  It
+serves the same endpoints as drr_server.js, with the same request and reply bodies,
+status codes and channel messages, so a Starting Gate can't tell the two apart:
+
+   /register         Register to participate in a race circuit
+   /deregister       Deregister and stop participating in a race circuit
+   /start            Synchronize the start of a race
+   /results          Post local race results and collect global results
+   /health           Report that the server is up
+   /time             Report the server clock for clock synchronization
+   /skew             Report start skew statistics for each track
+   /DRR              Root of binary download location
+   /channel          WebSocket carrying register, start, results, deregister, time and
+                     resume requests as messages
+
+See the handler definitions in drr_server.js for the detail of each.  Sessions, heats,
+start and results deadlines, admission control of registrations, live race events and
+heartbeats behave as they do there, and honour the same DRR_* environment variables.
+
+The barriers, heat scheduler and admission queue it coordinates races with are in
+drr_scheduling.py.
+
+drr_server.js remains the coordinator to deploy.  This one keeps its state in memory only,
+so it has no journal to recover from after a restart, doesn't run as a cluster and doesn't
+serve /metrics.
+
+Linux Installation:
+
+   % pip3 install aiohttp
+
+Usage:
+
+   % python3 drr_reference.py [port]
+
+or in-process, e.g. from a test, on a free port of the loopback address:
+
+   coordinator = ReferenceCoordinator(port=0)
+   coordinator.start_in_thread()
+   ... connect Starting Gates to coordinator.port ...
+   coordinator.stop_in_thread()
+
+Code already running an asyncio event loop awaits start() and stop() instead.
+
+Author: Tom Quiggle
+tquiggle@gmail.com
+https://github.com/tquiggle/Die-Cast-Remote-Raceway
+
+Copyright (c) Thomas Quiggle. All rights reserved.
+
+Licensed under the MIT license. See LICENSE file in the project root for full license information.
+
+"""
+
+import asyncio
+import json
+import math
+import os
+import secrets
+import socket
+import sys
+import threading
+import time
+
+from aiohttp import web, WSMsgType
+
+from drr_scheduling import (AdmissionQueue, CyclicBarrier, DeadlineBarrier, HeatScheduler,
+                            RequestError)
+
+def env_number(name, default):
+    """
+    Returns the value of environment variable name as a number, or default if it is unset,
+    zero or not a number
+    """
+    try:
+        return float(os.environ.get(name, '')) or default
+    except ValueError:
+        return default
+
+PORT = 1968 # The year Mattel introduced Hot Wheels to the market
+DEFAULT_CIRCUIT = 'DRR'
+SESSION_HEADER = 'X-DRR-Session'
+IDLE_TIMEOUT = 60 * 60
+
+# Delay, in seconds, from a heat being formed to its scheduled start.  Tracks run their
+# 3 second countdown first, so it must cover the countdown plus the slowest network path.
+START_LEAD = 4.0
+
+# Grace periods, in seconds, from the first track arriving at the start or results barrier
+# of a race, after which the race goes ahead without the tracks that aren't there
+START_GRACE = env_number('DRR_START_GRACE_MS', 60 * 1000) / 1000
+RESULTS_GRACE = env_number('DRR_RESULTS_GRACE_MS', 20 * 1000) / 1000
+
+# Tracks per heat, and the time a heat waits for a track its members have raced less often
+HEAT_SIZE = int(env_number('DRR_HEAT_SIZE', 2))
+ROTATION = env_number('DRR_ROTATION_MS', 10 * 1000) / 1000
+
+# Lane time reported for the lanes of a track missing from the results, matching the
+# Starting Gate's NOT_FINISHED
+NOT_FINISHED = sys.float_info.max
+
+# Interval between heartbeats on a channel, and the silence after which the track at the
+# other end is presumed dead and deregistered
+HEARTBEAT_SECONDS = 2.0
+HEARTBEAT_TIMEOUT = 3 * HEARTBEAT_SECONDS
+
+# Live events waiting to be forwarded to a track, past which the oldest is dropped
+MAX_PENDING_EVENTS = 32
+
+# Registrations admitted per second, in bursts of up to ADMISSION_BURST, with up to
+# ADMISSION_QUEUE_LENGTH more waiting their turn
+ADMISSION_RATE = env_number('DRR_ADMISSION_RATE', 50)
+ADMISSION_BURST = env_number('DRR_ADMISSION_BURST', 2 * ADMISSION_RATE)
+ADMISSION_QUEUE_LENGTH = env_number('DRR_ADMISSION_QUEUE', 10 * ADMISSION_RATE)
+
+# File system path for the root of the release directory
+RELEASES_ROOT = '/home/htdocs/DRR'
+
+# Offset from time.monotonic() to the Unix epoch, fixed at startup, so the server clock
+# is monotonic yet counts from the epoch like drr_server.js's
+EPOCH_OFFSET = time.time() - time.monotonic()
+
+def server_now():
+    """
+    The server's clock, in milliseconds
+    """
+    return (time.monotonic() + EPOCH_OFFSET) * 1000
+
+class CachedReply:
+    """
+    A reply serialized once and shared by every request it answers
+    """
+
+    def __init__(self, value):
+        self.text = json.dumps(value)
+
+def reply_text(reply):
+    """
+    Returns the serialized form of a handler's reply
+    """
+    return reply.text if isinstance(reply, CachedReply) else json.dumps(reply)
+
+class Participant:
+    """
+    A track registered in a circuit
+    """
+
+    def __init__(self, ip):
+        self.ip = ip
+        self.last_request_time = time.monotonic()
+        self.track_name = None
+        self.num_lanes = None
+        self.registration = None
+        self.heat = None    # The heat the track was last drawn into
+        self.skew = None    # Start skew statistics, once the track has reported one
+
+class Heat:
+    """
+    A race in progress between some of the tracks of a circuit
+    """
+
+    def __init__(self, race, sessions, start_time):
+        self.race = race
+        self.sessions = sessions
+        self.start_time = start_time
+        self.results = []
+        self.results_waiters = {}   # session -> future of the results barrier wait
+        self.concluded = False
+        self.results_barrier = None
+
+class Circuit:
+    """
+    The state maintained for each circuit
+    """
+
+    def __init__(self, name, on_heat):
+        self.participants = {}      # Registered tracks, by session
+        self.rosters = {}           # Cached registration reply for each session
+        self.heats = {}             # Heats in progress, by race number
+        self.registration_barrier = None
+        self.scheduler = HeatScheduler("{} start".format(name), HEAT_SIZE, ROTATION,
+                                       START_GRACE, on_heat)
+
+class ChannelPeer:
+    """
+    The coordinator's end of a track's channel
+    """
+
+    def __init__(self, ws, ip):
+        self.ws = ws
+        self.ip = ip
+        self.session = None
+        self.last_received = time.monotonic()
+        self.pending_events = {}    # Events to forward, by coalescing key, oldest first
+        self.flush_scheduled = False
+
+    def is_open(self):
+        """
+        Returns True until the channel starts closing
+        """
+        return not self.ws.closed
+
+class ReferenceCoordinator:
+    """
+    The reference race coordinator.  See the module documentation.
+    """
+
+# PUBLIC:
+
+    async def start(self):
+        """
+        Start serving on the running event loop.  Returns the port listened on, which is
+        chosen by the operating system if the coordinator was created with port 0.
+        """
+        self.runner = web.AppRunner(self.__application(), handle_signals=False)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+        self.port = self.runner.addresses[0][1]
+        self.tasks.add(asyncio.create_task(self.__heartbeats()))
+        self.tasks.add(asyncio.create_task(self.__sweep_idle()))
+        print("Reference raceway server listening at http://{}:{}".format(
+            socket.gethostname(), self.port))
+        return self.port
+
+    async def stop(self):
+        """
+        Close every channel and stop serving
+        """
+        for task in self.tasks:
+            task.cancel()
+        for peer in list(self.open_channels):
+            await peer.ws.close()
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    def start_in_thread(self):
+        """
+        Start serving on an event loop of its own, in a background thread, and return the
+        port once the coordinator is accepting connections
+        """
+        started = threading.Event()
+        failure = []
+
+        def run():
+            self.loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self.loop)
+            try:
+                self.loop.run_until_complete(self.start())
+            except OSError as exc:
+                failure.append(exc)
+                started.set()
+                self.loop.close()
+                return
+            started.set()
+            self.loop.run_forever()
+            self.loop.run_until_complete(self.stop())
+            # Abandon the requests still waiting at barriers
+            pending = asyncio.all_tasks(self.loop)
+            for task in pending:
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+            self.loop.close()
+
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+        started.wait()
+        if failure:
+            raise failure[0]
+        return self.port
+
+    def stop_in_thread(self):
+        """
+        Stop a coordinator started with start_in_thread()
+        """
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    @property
+    def url(self):
+        """
+        Base URL of the coordinator
+        """
+        return "http://{}:{}".format(self.host, self.port)
+
+# PRIVATE:
+
+    def __init__(self, host='127.0.0.1', port=PORT, releases_root=RELEASES_ROOT):
+        self.host = host
+        self.port = port
+        self.releases_root = releases_root
+        self.runner = None
+        self.loop = None
+        self.thread = None
+        self.tasks = set()
+        self.session_to_circuit = {}
+        self.circuits = {DEFAULT_CIRCUIT: self.__new_circuit(DEFAULT_CIRCUIT)}
+        self.channels = {}          # session -> ChannelPeer registered with it
+        self.open_channels = set()  # Every open channel, registered or not
+        self.admissions = AdmissionQueue(ADMISSION_RATE, ADMISSION_BURST, ADMISSION_QUEUE_LENGTH)
+        self.channel_handlers = {
+            'register': self.__register_track,
+            'start': self.__start_race,
+            'results': self.__post_results,
+            'deregister': self.__deregister_request,
+            'time': self.__server_time,
+            'resume': self.__resume_session,
+        }
+
+    def __application(self):
+        app = web.Application()
+        app.router.add_post('/register', self.__http_handler(self.__register_track))
+        app.router.add_post('/deregister', self.__deregister_http)
+        app.router.add_get('/start', self.__http_handler(self.__start_race))
+        app.router.add_post('/results', self.__http_handler(self.__post_results))
+        app.router.add_get('/health', self.__health)
+        app.router.add_get('/time', self.__http_handler(self.__server_time))
+        app.router.add_get('/skew', self.__skew)
+        app.router.add_get('/channel', self.__open_channel)
+        if os.path.isdir(self.releases_root):
+            app.router.add_static('/DRR', self.releases_root)
+        return app
+
+    def __new_circuit(self, name):
+        return Circuit(name, lambda outcome: self.__heat_starting(name, outcome))
+
+    def __participant_for(self, session):
+        circuit = self.session_to_circuit.get(session)
+        return None if circuit is None else self.circuits[circuit].participants.get(session)
+
+    async def __sweep_idle(self):
+        """
+        Evict tracks that have made no request for IDLE_TIMEOUT, checking every minute.
+        Messages on a track's channel count as requests, and a track waiting for a heat
+        to form is never idle.
+        """
+        while True:
+            await asyncio.sleep(60)
+            now = time.monotonic()
+            for session, circuit in list(self.session_to_circuit.items()):
+                state = self.circuits[circuit]
+                participant = state.participants.get(session)
+                if participant is None or session in state.scheduler.ready:
+                    continue
+                if now - participant.last_request_time > IDLE_TIMEOUT:
+                    self.__evict(session, "idle for {} seconds".format(IDLE_TIMEOUT))
+
+    def __deregister(self, session):
+        """
+        Remove the registration of session.  A circuit is removed once its last track leaves.
+        """
+        circuit = self.session_to_circuit.pop(session, None)
+        if circuit is None:
+            return
+        state = self.circuits[circuit]
+        participant = state.participants.pop(session, None)
+        if participant is not None:
+            state.rosters.clear()
+            heat = participant.heat
+            if heat is not None and not heat.concluded:
+                self.__leave_heat(circuit, heat, session)
+            state.scheduler.remove(session)
+        if not state.participants:
+            print("removing empty circuit", circuit)
+            del self.circuits[circuit]
+
+    def __evict(self, session, reason):
+        """
+        Remove a track from its circuit, closing its channel so the Starting Gate returns
+        to its menu
+        """
+        print("evicting session {}: {}".format(session, reason))
+        self.__deregister(session)
+        peer = self.channels.get(session)
+        if peer is not None:
+            asyncio.get_running_loop().create_task(
+                peer.ws.close(code=4000, message=reason.encode()))
+
+    def __register(self, session, ip, registration):
+        """
+        Register session in the circuit named in registration
+        """
+        circuit = registration.get('circuit', DEFAULT_CIRCUIT)
+        print("registering session {} in circuit {}".format(session, circuit))
+
+        if self.session_to_circuit.get(session, circuit) != circuit:
+            self.__deregister(session)
+
+        if circuit not in self.circuits:
+            self.circuits[circuit] = self.__new_circuit(circuit)
+        state = self.circuits[circuit]
+
+        participant = state.participants.get(session)
+        if participant is not None:
+            participant.last_request_time = time.monotonic()
+        else:
+            participant = Participant(ip)
+            state.participants[session] = participant
+            state.scheduler.add(session)
+
+        participant.track_name = registration.get('trackName',
+                                                  "Track {}".format(len(state.participants)))
+        participant.num_lanes = registration.get('numLanes')
+        participant.registration = {'trackName': participant.track_name,
+                                    'numLanes': participant.num_lanes,
+                                    'carIcons': registration.get('carIcons')}
+        state.rosters.clear()
+        self.session_to_circuit[session] = circuit
+
+        if len(state.participants) == 1:
+            state.registration_barrier = CyclicBarrier(2)
+        return circuit
+
+    async def __register_track(self, session, body, ip):
+        await self.admissions.admit()
+        circuit = self.__register(session, ip, body)
+        await asyncio.shield(self.circuits[circuit].registration_barrier.wait())
+        # The track may have left while it waited, taking the circuit with it if it was
+        # the last track
+        state = self.circuits.get(circuit)
+        if state is None or session not in state.participants:
+            raise RequestError(409, "{} left circuit {} while registering".format(session, circuit))
+        return self.__roster(circuit, session)
+
+    def __roster(self, circuit, session):
+        """
+        Returns the registration reply for session, cached until the circuit's membership
+        changes
+        """
+        state = self.circuits[circuit]
+        if session not in state.rosters:
+            state.rosters[session] = CachedReply({
+                'ip': state.participants[session].ip,
+                'session': session,
+                'remoteRegistrations': [participant.registration for rsession, participant
+                                        in state.participants.items() if rsession != session]})
+        return state.rosters[session]
+
+    async def __server_time(self, session, body, ip): #pylint: disable=unused-argument
+        return {'time': server_now()}
+
+    async def __start_race(self, session, body, ip): #pylint: disable=unused-argument
+        participant = self.__participant_for(session)
+        if participant is None:
+            raise RequestError(424, 'Received /start request prior to registration')
+        participant.last_request_time = time.monotonic()
+        circuit = self.session_to_circuit[session]
+        state = self.circuits[circuit]
+
+        # A track that resumed its session after losing the reply asks again for the race
+        # the resume reply reported.  Any other request from a track still in a heat
+        # abandons that race and waits for a new heat.
+        heat = self.__pending_heat(participant, session)
+        race = body.get('race') if isinstance(body, dict) else None
+        if heat is not None and heat.race != race:
+            print("/start({}): abandoning race {}".format(session, heat.race))
+            self.__leave_heat(circuit, heat, session)
+            participant.heat = None
+            heat = None
+        if heat is None:
+            await asyncio.shield(state.scheduler.arrive(session))
+            participant.last_request_time = time.monotonic()
+            heat = participant.heat
+
+        opponents = [state.participants[opponent].registration for opponent in heat.sessions
+                     if opponent != session and opponent in state.participants]
+        return {'startTime': heat.start_time, 'race': heat.race, 'opponents': opponents}
+
+    def __heat_starting(self, circuit, outcome):
+        """
+        Heat formed: schedule its start, set up the collection of its results and evict the
+        tracks that held up the start
+        """
+        state = self.circuits[circuit]
+        heat = Heat(outcome['generation'], outcome['arrived'], server_now() + START_LEAD * 1000)
+        heat.results_barrier = DeadlineBarrier(
+            "{} race {} results".format(circuit, heat.race), RESULTS_GRACE,
+            lambda results: self.__results_collected(circuit, heat, results))
+        heat.results_barrier.expect(heat.sessions)
+        state.heats[heat.race] = heat
+        for session in heat.sessions:
+            state.participants[session].heat = heat
+        print("circuit {}: race {} with {}, {} heats racing".format(
+            circuit, heat.race, heat.sessions, len(state.heats)))
+
+        for session in outcome['missing']:
+            self.__evict(session, "not ready for race {} in circuit {}".format(heat.race, circuit))
+
+    async def __post_results(self, session, body, ip): #pylint: disable=unused-argument
+        participant = self.__participant_for(session)
+        if participant is None:
+            raise RequestError(424, 'Received /results request prior to registration')
+        participant.last_request_time = time.monotonic()
+        legacy = isinstance(body, list)
+        lane_results = body if legacy else body.get('results') or []
+        heat = participant.heat
+
+        if heat is None:
+            raise RequestError(409, 'Results posted before the start of a race')
+        if not legacy and body.get('race') is not None and body['race'] != heat.race:
+            raise RequestError(409, "Results for race {}, which has already concluded".format(
+                body['race']))
+
+        # A retry joins the barrier wait of the original request
+        if session not in heat.results_waiters:
+            if heat.concluded:
+                raise RequestError(409, "Results for race {}, which has already concluded".format(
+                    heat.race))
+            release_time = None if legacy else body.get('releaseTime')
+            skew = 0 if release_time is None else (release_time - heat.start_time) / 1000
+            if release_time is not None:
+                self.__record_skew(participant, skew)
+            for result in lane_results:
+                result = dict(result, trackName=participant.track_name, skew=skew)
+                result['finishTime'] = result['laneTime'] + skew
+                heat.results.append(result)
+            heat.results_waiters[session] = heat.results_barrier.arrive(session)
+
+        outcome = await asyncio.shield(heat.results_waiters[session])
+        participant.last_request_time = time.monotonic()
+        return outcome['legacy_reply'] if legacy else outcome['reply']
+
+    def __results_collected(self, circuit, heat, outcome):
+        """
+        Results barrier trip: mark the lanes of tracks that didn't report as missing, evict
+        those tracks and end the heat, freeing the others for their next
+        """
+        state = self.circuits[circuit]
+        results = heat.results
+        missing_tracks = []
+
+        self.__end_heat(circuit, heat)
+        for session in outcome['missing']:
+            participant = state.participants[session]
+            missing_tracks.append(participant.track_name)
+            for lane in range(1, (participant.num_lanes or 0) + 1):
+                results.append({'trackName': participant.track_name, 'laneNumber': lane,
+                                'laneTime': NOT_FINISHED, 'skew': 0,
+                                'finishTime': NOT_FINISHED, 'missing': True})
+            self.__evict(session, "no results for race {} in circuit {}".format(heat.race, circuit))
+
+        standings = sorted(results, key=lambda result: result['laneTime'])
+        raw_standings = sorted(results, key=lambda result: result['finishTime'])
+        outcome['reply'] = CachedReply({'standings': standings, 'rawStandings': raw_standings,
+                                        'missing': missing_tracks})
+        outcome['legacy_reply'] = CachedReply(raw_standings)
+
+        heat.results = []
+        if circuit in self.circuits:
+            state.scheduler.finished(outcome['arrived'])
+
+    def __leave_heat(self, circuit, heat, session):
+        """
+        Remove session from a heat in progress, ending the heat if no track remains to
+        post results
+        """
+        heat.sessions = [member for member in heat.sessions if member != session]
+        heat.results_barrier.remove(session)
+        if not heat.results_barrier.expected:
+            self.__end_heat(circuit, heat)
+
+    @staticmethod
+    def __pending_heat(participant, session):
+        """
+        Returns the heat session was drawn into and has yet to post results for, if any
+        """
+        heat = participant.heat
+        if heat is None or heat.concluded or session in heat.results_waiters:
+            return None
+        return heat
+
+    def __end_heat(self, circuit, heat):
+        heat.concluded = True
+        self.circuits[circuit].heats.pop(heat.race, None)
+
+    @staticmethod
+    def __record_skew(participant, skew):
+        if participant.skew is None:
+            participant.skew = {'races': 0, 'sum': 0, 'sumSquares': 0, 'max': 0}
+        stats = participant.skew
+        stats['races'] += 1
+        stats['sum'] += skew
+        stats['sumSquares'] += skew * skew
+        stats['max'] = max(stats['max'], abs(skew))
+
+    async def __skew(self, request): #pylint: disable=unused-argument
+        report = {}
+        for circuit, state in self.circuits.items():
+            report[circuit] = {}
+            for participant in state.participants.values():
+                stats = participant.skew
+                if stats is not None:
+                    report[circuit][participant.track_name] = {
+                        'races': stats['races'],
+                        'meanSkew': stats['sum'] / stats['races'],
+                        'rmsSkew': math.sqrt(stats['sumSquares'] / stats['races']),
+                        'maxSkew': stats['max']}
+        return web.json_response(report)
+
+    async def __health(self, request): #pylint: disable=unused-argument
+        return web.Response(text='OK')
+
+    async def __deregister_request(self, session, body, ip): #pylint: disable=unused-argument
+        self.__deregister(session)
+        return 'Deregistration complete. Bye.'
+
+    async def __deregister_http(self, request):
+        self.__deregister(self.__request_session(request))
+        return web.Response(text='Deregistration complete. Bye.')
+
+    async def __resume_session(self, session, body, ip): #pylint: disable=unused-argument
+        participant = self.__participant_for(session)
+        if participant is None:
+            raise RequestError(404, "Unknown session {}".format(session))
+        participant.last_request_time = time.monotonic()
+        roster = self.__roster(self.session_to_circuit[session], session)
+        heat = self.__pending_heat(participant, session)
+        if heat is None:
+            return roster
+        return dict(json.loads(roster.text), race=heat.race)
+
+    @staticmethod
+    def __request_session(request):
+        """
+        The session of an HTTP request: its session token, or its IP address
+        """
+        return request.headers.get(SESSION_HEADER) or request.remote
+
+    def __http_handler(self, handler):
+        """
+        Wrap handler(session, body, ip) as an HTTP endpoint answering with its JSON reply,
+        or the status code of the RequestError it raises
+        """
+        async def endpoint(request):
+            body = {}
+            if request.content_type == 'application/json' and request.can_read_body:
+                try:
+                    body = await request.json()
+                except ValueError:
+                    return web.Response(status=400, text='Malformed JSON body')
+            try:
+                reply = await handler(self.__request_session(request), body, request.remote)
+            except RequestError as exc:
+                headers = {} if exc.retry_after is None else {'Retry-After': str(exc.retry_after)}
+                return web.Response(status=exc.code, text=str(exc), headers=headers)
+            return web.Response(text=reply_text(reply), content_type='application/json')
+        return endpoint
+
+    async def __open_channel(self, request):
+        """
+        WebSocket /channel.  See drr_server.js for the messages it carries.
+        """
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        peer = ChannelPeer(ws, request.remote)
+        self.open_channels.add(peer)
+        requests = set()
+        try:
+            async for data in ws:
+                peer.last_received = time.monotonic()
+                participant = self.__participant_for(peer.session)
+                if participant is not None:
+                    participant.last_request_time = peer.last_received
+                if data.type != WSMsgType.TEXT:
+                    continue
+                try:
+                    message = json.loads(data.data)
+                except ValueError:
+                    print("channel({}): malformed message".format(peer.ip))
+                    continue
+                if message.get('type') in ('lanes', 'finish'):
+                    self.__publish_event(message.get('session') or peer.session, message)
+                elif message.get('type') != 'heartbeat':
+                    task = asyncio.create_task(self.__channel_request(peer, message))
+                    requests.add(task)
+                    task.add_done_callback(requests.discard)
+        finally:
+            self.open_channels.discard(peer)
+            if peer.session is not None and self.channels.get(peer.session) is peer:
+                del self.channels[peer.session]
+                self.__deregister(peer.session)
+        return ws
+
+    async def __channel_request(self, peer, message):
+        handler = self.channel_handlers.get(message.get('type'))
+        if handler is None:
+            await self.__send(peer, {'type': 'error', 'id': message.get('id'), 'code': 400,
+                                     'text': "unknown request {}".format(message.get('type'))})
+            return
+        session = message.get('session') or peer.session
+        if message['type'] == 'register':
+            if session not in self.session_to_circuit:
+                session = secrets.token_hex(16)
+            self.__bind_channel(peer, session)
+        elif message['type'] == 'resume' and session in self.session_to_circuit:
+            self.__bind_channel(peer, session)
+        try:
+            body = await handler(session, message.get('body') or {}, peer.ip)
+        except RequestError as exc:
+            await self.__send(peer, {'type': 'error', 'id': message.get('id'), 'code': exc.code,
+                                     'text': str(exc), 'retryAfter': exc.retry_after})
+            return
+        if message['type'] == 'register' and not peer.is_open():
+            self.__deregister(session)  # The track left while its registration was queued
+            return
+        if peer.is_open():
+            await peer.ws.send_str('{{"type":"reply","id":{},"body":{}}}'.format(
+                json.dumps(message.get('id')), reply_text(body)))
+
+    def __bind_channel(self, peer, session):
+        """
+        Tie a channel to the session registered over it, replacing any earlier channel of
+        the same session
+        """
+        if peer.session == session:
+            return
+        previous = self.channels.get(session)
+        if previous is not None:
+            previous.session = None
+            asyncio.get_running_loop().create_task(previous.ws.close())
+        if peer.session is not None:
+            self.channels.pop(peer.session, None)
+        self.channels[session] = peer
+        peer.session = session
+
+    def __publish_event(self, session, message):
+        """
+        Forward a live race event to the other tracks in the sender's circuit: lanes to
+        every track, finishes only to the tracks in the same heat
+        """
+        participant = self.__participant_for(session)
+        if participant is None:
+            return
+        state = self.circuits[self.session_to_circuit[session]]
+        track_name = participant.track_name
+        event = {'type': message['type'], 'trackName': track_name, 'body': message.get('body')}
+        if message['type'] == 'lanes':
+            key = "lanes:{}".format(track_name)
+            recipients = list(state.participants)
+        else:
+            key = "{}:{}:{}".format(message['type'], track_name,
+                                    (message.get('body') or {}).get('laneNumber'))
+            recipients = participant.heat.sessions if participant.heat is not None else []
+        for rsession in recipients:
+            peer = self.channels.get(rsession)
+            if rsession != session and peer is not None:
+                self.__queue_event(peer, key, event)
+
+    def __queue_event(self, peer, key, event):
+        peer.pending_events.pop(key, None)
+        peer.pending_events[key] = event
+        if len(peer.pending_events) > MAX_PENDING_EVENTS:
+            oldest = next(iter(peer.pending_events))
+            print("channel({}): event queue full, dropping {}".format(peer.ip, oldest))
+            del peer.pending_events[oldest]
+        if not peer.flush_scheduled:
+            peer.flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self.__flush_events, peer)
+
+    def __flush_events(self, peer):
+        events = list(peer.pending_events.values())
+        peer.pending_events.clear()
+        peer.flush_scheduled = False
+        if events and peer.is_open():
+            asyncio.get_running_loop().create_task(
+                self.__send(peer, {'type': 'events', 'body': events}))
+
+    @staticmethod
+    async def __send(peer, message):
+        if peer.is_open():
+            try:
+                await peer.ws.send_str(json.dumps(message))
+            except ConnectionError:
+                pass
+
+    async def __heartbeats(self):
+        """
+        Send heartbeats on every channel and drop the tracks that have stopped sending theirs
+        """
+        while True:
+            await asyncio.sleep(HEARTBEAT_SECONDS)
+            now = time.monotonic()
+            for peer in list(self.open_channels):
+                if now - peer.last_received > HEARTBEAT_TIMEOUT:
+                    print("channel({}): no heartbeat in {}s".format(peer.ip, HEARTBEAT_TIMEOUT))
+                    asyncio.get_running_loop().create_task(peer.ws.close())
+                else:
+                    await self.__send(peer, {'type': 'heartbeat'})
+
+def main():
+    """
+    Run the reference coordinator on the port given on the command line, or PORT
+    """
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else PORT
+    coordinator = ReferenceCoordinator(host='0.0.0.0', port=port)
+
+    async def serve():
+        await coordinator.start()
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await coordinator.stop()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
+
+# vim: expandtab sw=4
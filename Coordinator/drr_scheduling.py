@@ -0,0 +1,366 @@
+"""
+Diecast Remote Raceway - Reference Coordinator Scheduling
+
+The asyncio primitives drr_reference.py coordinates races with, mirroring those of
+drr_server.js:
+
+   CyclicBarrier      Releases registrations in groups, like the async-barrier package
+   DeadlineBarrier    Collects the results of each race, up to a grace period
+   HeatScheduler      Forms heats from the ready tracks of a circuit
+   AdmissionQueue     Admits registrations at a bounded rate
+
+Each must be used from the event loop the coordinator runs on.  A wait that can't be
+satisfied fails with RequestError, carrying the HTTP status to answer with.
+
+Author: Tom Quiggle
+tquiggle@gmail.com
+https://github.com/tquiggle/Die-Cast-Remote-Raceway
+
+Copyright (c) Thomas Quiggle. All rights reserved.
+
+Licensed under the MIT license. See LICENSE file in the project root for full license information.
+
+"""
+
+import asyncio
+import math
+import time
+
+class RequestError(Exception):
+    """
+    A request that can't be satisfied, answered with the given HTTP status code and, with
+    status 503, the seconds after which to retry
+    """
+
+    def __init__(self, code, text, retry_after=None):
+        super().__init__(text)
+        self.code = code
+        self.retry_after = retry_after
+
+def settle(future, result=None, error=None):
+    """
+    Resolve future with result, or fail it with error, unless its waiter has gone
+    """
+    if future.done():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+class CyclicBarrier:
+    """
+    Releases waiters in groups of parties, like the async-barrier package drr_server.js
+    synchronizes registrations with
+    """
+
+    def __init__(self, parties):
+        self.parties = parties
+        self.waiting = []
+
+    def wait(self):
+        """
+        Returns a future resolved once parties waiters, including this one, are waiting
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.waiting.append(future)
+        if len(self.waiting) >= self.parties:
+            waiting, self.waiting = self.waiting, []
+            for waiter in waiting:
+                settle(waiter)
+        return future
+
+class DeadlineBarrier:
+    """
+    A barrier with a deadline, used to collect the results of each race.
+
+    Each participant in the expected set calls arrive() and waits on the returned future.
+    The barrier trips when every expected participant has arrived, or grace seconds after
+    the first arrival, whichever comes first.  on_trip(outcome) is then called and every
+    waiter resolved with the same outcome,
+
+      {'generation': <int>, 'arrived': [<session>, ...], 'missing': [<session>, ...]}
+
+    A participant removed while waiting has its wait failed with status 410.
+    """
+
+    def __init__(self, name, grace, on_trip):
+        self.name = name
+        self.grace = grace
+        self.on_trip = on_trip
+        self.generation = 0
+        self.expected = set()
+        self.waiters = {}   # session -> future of each arrived participant
+        self.timer = None
+
+    def expect(self, sessions):
+        """
+        Set the participants the barrier waits for
+        """
+        self.expected = set(sessions)
+        self.__trip_if_complete()
+
+    def remove(self, session):
+        """
+        Stop waiting for session
+        """
+        self.expected.discard(session)
+        waiter = self.waiters.pop(session, None)
+        if waiter is not None:
+            settle(waiter, error=RequestError(
+                410, "{} left the circuit while waiting at {}".format(session, self.name)))
+        if not self.waiters:
+            self.__cancel_timer()
+        self.__trip_if_complete()
+
+    def arrive(self, session):
+        """
+        Returns a future resolved with the outcome once the barrier trips
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.waiters[session] = future
+        if self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.grace, self.__trip)
+        self.__trip_if_complete()
+        return future
+
+    def __trip_if_complete(self):
+        if self.waiters and self.expected.issubset(self.waiters):
+            self.__trip()
+
+    def __cancel_timer(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def __trip(self):
+        self.__cancel_timer()
+        waiters, self.waiters = self.waiters, {}
+        outcome = {'generation': self.generation,
+                   'arrived': list(waiters),
+                   'missing': [session for session in self.expected if session not in waiters]}
+        self.generation += 1
+
+        if outcome['missing']:
+            print("{}: generation {} deadline passed, missing {}".format(
+                self.name, outcome['generation'], outcome['missing']))
+        self.on_trip(outcome)
+        for waiter in waiters.values():
+            settle(waiter, outcome)
+
+class HeatScheduler:
+    """
+    Schedules the heats of a circuit: sub-races of up to heat_size tracks formed from
+    whichever tracks are ready.  Each heat is formed around the longest waiting track, with
+    the ready tracks it has raced least often, and is held up to rotation seconds for a
+    track it has raced less often still that is finishing its own heat.  If enough tracks
+    don't become ready, a short heat is formed from those that are, and the members
+    neither ready nor racing are reported missing.  That waits until the longest waiting
+    track has waited grace seconds, and every missing member has been absent that long
+    since it joined or its last heat finished, and never happens while a member is racing.
+
+    on_heat(outcome) is called as each heat is formed, and then each of its tracks' waits
+    resolved with the same outcome, as for DeadlineBarrier.  Members stay racing until
+    finished() is called for them.
+    """
+
+    def __init__(self, name, heat_size, rotation, grace, on_heat):
+        self.name = name
+        self.heat_size = heat_size
+        self.rotation = rotation
+        self.grace = grace
+        self.on_heat = on_heat
+        self.generation = 0
+        self.members = {}   # session -> {opponent session: heats raced together}
+        self.ready = {}     # session -> (future, since), longest waiting first
+        self.racing = set()
+        self.available = {} # session -> when it joined or its last heat finished
+        self.timer = None
+
+    def add(self, session):
+        """
+        Add a member to the circuit
+        """
+        if session not in self.members:
+            self.members[session] = {}
+            self.available[session] = time.monotonic()
+
+    def remove(self, session):
+        """
+        Remove a member, failing its wait if it is waiting for a heat
+        """
+        met = self.members.pop(session, None)
+        if met is None:
+            return
+        for opponent in met:
+            self.members[opponent].pop(session, None)
+        self.available.pop(session, None)
+        self.racing.discard(session)
+        waiter = self.ready.pop(session, None)
+        if waiter is not None:
+            settle(waiter[0], error=RequestError(
+                410, "{} left the circuit while waiting at {}".format(session, self.name)))
+        self.schedule()     # Fewer members may now fill a heat
+
+    def arrive(self, session):
+        """
+        Returns a future resolved with the outcome once session is drawn into a heat
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.racing.discard(session)
+        self.ready[session] = (future, time.monotonic())
+        self.schedule()
+        return future
+
+    def finished(self, sessions):
+        """
+        Mark the tracks of a heat that has collected its results as no longer racing
+        """
+        now = time.monotonic()
+        for session in sessions:
+            if session in self.racing:
+                self.racing.discard(session)
+                self.available[session] = now
+        self.schedule()
+
+    def schedule(self):
+        """
+        Form every heat that can be formed now, and set a timer for the next that may be
+        """
+        now = time.monotonic()
+        while self.ready:
+            size = min(self.heat_size, len(self.members))
+            first, (_, since) = next(iter(self.ready.items()))
+            heat = None
+            if len(self.ready) >= size:
+                heat = self.__pick(first, self.ready, size)
+                if now - since < self.rotation and \
+                        self.__cost(heat) > self.__cost(self.__pick(first, self.members, size)):
+                    heat = None     # A fairer heat is racing, and will be ready shortly
+            elif now >= self.__grace_deadline(since):
+                heat = list(self.ready)
+            if heat is None:
+                break
+            self.__start(heat)
+
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.ready:
+            size = min(self.heat_size, len(self.members))
+            _, since = next(iter(self.ready.values()))
+            if len(self.ready) >= size:
+                deadline = since + self.rotation
+            else:
+                deadline = self.__grace_deadline(since)
+            if deadline != math.inf:
+                self.timer = asyncio.get_running_loop().call_later(
+                    max(0, deadline - now), self.schedule)
+
+    def __grace_deadline(self, since):
+        """
+        When a short heat may be formed around the longest waiting track, which arrived at
+        since: grace after the later of that and the latest time a now absent member
+        became available.  Infinite while any member is racing, as finished() schedules
+        again.
+        """
+        if self.racing:
+            return math.inf
+        absent = [available for session, available in self.available.items()
+                  if session not in self.ready]
+        return max([since] + absent) + self.grace
+
+    def __pick(self, first, candidates, size):
+        """
+        Choose size tracks from candidates for a heat with first, greedily adding the
+        candidate that has raced the tracks already chosen least often
+        """
+        heat = [first]
+        others = [session for session in candidates if session != first]
+        while len(heat) < size and others:
+            best = min(range(len(others)), key=lambda index: sum(
+                self.members[others[index]].get(chosen, 0) for chosen in heat))
+            heat.append(others.pop(best))
+        return heat
+
+    def __cost(self, heat):
+        """
+        Number of times the tracks of a heat have already raced one another
+        """
+        return sum(self.members[heat[i]].get(heat[j], 0)
+                   for i in range(len(heat)) for j in range(i + 1, len(heat)))
+
+    def __start(self, heat):
+        waiters = [self.ready.pop(session)[0] for session in heat]
+        for session in heat:
+            self.racing.add(session)
+            met = self.members[session]
+            for opponent in heat:
+                if opponent != session:
+                    met[opponent] = met.get(opponent, 0) + 1
+
+        missing = []
+        if len(heat) < min(self.heat_size, len(self.members)):
+            missing = [session for session in self.members
+                       if session not in self.racing and session not in self.ready]
+        outcome = {'generation': self.generation, 'arrived': heat, 'missing': missing}
+        self.generation += 1
+
+        if missing:
+            print("{}: heat {} deadline passed, missing {}".format(
+                self.name, outcome['generation'], missing))
+        self.on_heat(outcome)
+        for waiter in waiters:
+            settle(waiter, outcome)
+
+class AdmissionQueue:
+    """
+    Admits registrations at up to rate per second, in bursts of up to burst, with up to
+    max_queued more waiting their turn.  Past that, admit() fails with status 503 and a
+    retry-after hint of how long the queue will take to drain.
+    """
+
+    def __init__(self, rate, burst, max_queued):
+        self.rate = rate
+        self.burst = burst
+        self.max_queued = max_queued
+        self.tokens = burst
+        self.refilled = time.monotonic()
+        self.queue = []     # futures of the waiting registrations, in order
+        self.timer = None
+
+    async def admit(self):
+        """
+        Wait until the registration may proceed
+        """
+        self.__refill()
+        if not self.queue and self.tokens >= 1:
+            self.tokens -= 1
+            return
+        if len(self.queue) >= self.max_queued:
+            raise RequestError(503, "Coordinator busy, {} registrations waiting".format(
+                len(self.queue)), math.ceil(len(self.queue) / self.rate))
+        future = asyncio.get_running_loop().create_future()
+        self.queue.append(future)
+        self.__schedule()
+        await future
+
+    def __refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+        self.refilled = now
+
+    def __drain(self):
+        self.timer = None
+        self.__refill()
+        while self.queue and self.tokens >= 1:
+            self.tokens -= 1
+            settle(self.queue.pop(0))
+        self.__schedule()
+
+    def __schedule(self):
+        if self.timer is None and self.queue:
+            self.timer = asyncio.get_running_loop().call_later(
+                max(0, (1 - self.tokens) / self.rate), self.__drain)
+
+# vim: expandtab sw=4
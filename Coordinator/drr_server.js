@@ -7,7 +7,8 @@
  * Linux Installation:
  *
  *    % sudo apt install nodejs
- *    % npm install express async-barrier node-cron log-timestamp connect-timeout --save
+ *    % npm install express async-barrier node-cron log-timestamp connect-timeout ws --save
+ *    % npm install better-sqlite3 --save           # Only to run drr_cluster.js
  *
  * The DRR_Server implements the following service endpoints
  *
@@ -15,10 +16,44 @@
  *    /deregister       Deregister and stop participating in a race circuit
  *    /start            Synchronize the start of a race
  *    /results          Post local race results and collect global results
+ *    /health           Report that the server is up
+ *    /time             Report the server clock for clock synchronization
+ *    /skew             Report start skew statistics for each track
+ *    /metrics          Report request latency, barrier wait and circuit metrics
  *    /DRR              Root of binary download location
+ *    /channel          WebSocket carrying register, start, results, deregister and time
+ *                      requests as messages, in place of the long-polled HTTP endpoints
  *
  * each of which is described in their handler definitions below.
  *
+ * Sessions
+ *
+ *   Each registration is identified by an opaque session token issued by /register, rather
+ *   than by the client's IP address, so any number of tracks may share one address, e.g.
+ *   behind a home router.  Tracks send the token on every later HTTP request in the
+ *   X-DRR-Session header, and in the "session" field of every message on the channel.  A
+ *   track that sends no token over HTTP is identified by its IP address, as before.
+ *
+ * Recovery
+ *
+ *   Circuit membership and the heats in progress are journaled (see drr_journal.js).  A
+ *   restarted coordinator reloads them at boot, and tracks reconnect their channels and
+ *   resume their sessions without registering again.  Tracks that haven't resumed within
+ *   resumeGraceMilliseconds are dropped.
+ *
+ * Scaling
+ *
+ *   drr_cluster.js runs several instances of this server as worker processes behind one
+ *   port, routing each circuit to the worker that owns it.  A worker listens on the loopback
+ *   address only, takes each track's address from the router's X-Forwarded-For header and
+ *   records the circuit of each session in the membership store the router routes by.
+ *
+ * Reference Implementation
+ *
+ *   drr_reference.py implements the same endpoints and channel messages in Python asyncio,
+ *   for testing Starting Gates in-process and as a benchmark target.  Changes to the
+ *   contract here should be made there too.
+ *
  * Release Serving
  *
  *   In addition to coordinating races, the Coordinaton Server provides software artifacts
@@ -45,7 +80,13 @@ require('log-timestamp')
 const express = require('express')
 const bodyParser = require('body-parser')
 const os = require('os')
+const { performance } = require('perf_hooks')
 const cron = require('node-cron')
+const WebSocket = require('ws')
+const crypto = require('crypto')
+const path = require('path')
+const { Journal } = require('./drr_journal')
+const { Registry, waitBuckets } = require('./drr_metrics')
 
 /* Globals */
 const makeAsyncBarrier = require('async-barrier')
@@ -53,108 +94,751 @@ const port = 1968 // The year Mattel introduced Hot Wheels to the market
 const idleTimeoutMilliseconds = 60 * 60 * 1000
 const hostname = os.hostname()
 const defaultCircuit = 'DRR'
+const sessionHeader = 'X-DRR-Session'
+
+// Delay from a heat being formed to its scheduled start.  Tracks run their
+// 3 second countdown first, so it must cover the countdown plus the slowest network path.
+const startLeadMilliseconds = 4000
+
+// Grace periods, from the first track arriving at the start or results barrier of a race,
+// after which the race starts with the tracks that are ready or the results are returned
+// with the missing tracks marked.  Tracks that missed the deadline are evicted from the
+// circuit.  Override with the DRR_START_GRACE_MS and DRR_RESULTS_GRACE_MS environment
+// variables.
+const startGraceMilliseconds = Number(process.env.DRR_START_GRACE_MS) || 60 * 1000
+const resultsGraceMilliseconds = Number(process.env.DRR_RESULTS_GRACE_MS) || 20 * 1000
+
+// Tracks per heat.  A circuit with more tracks runs several heats at once.  A heat waits up
+// to rotationMilliseconds for a track its members have raced less often to finish its own
+// heat, keeping pairings rotating.  Override with the DRR_HEAT_SIZE and DRR_ROTATION_MS
+// environment variables.
+const heatSize = Number(process.env.DRR_HEAT_SIZE) || 2
+const rotationMilliseconds = Number(process.env.DRR_ROTATION_MS) || 10 * 1000
+
+// Lane time reported for the lanes of a track missing from the results, matching the
+// Starting Gate's NOT_FINISHED (the largest double)
+const notFinished = Number.MAX_VALUE
+
+// Interval between heartbeats on a channel, and the silence after which the track at the
+// other end is presumed dead and deregistered
+const heartbeatMilliseconds = 2000
+const heartbeatTimeoutMilliseconds = 3 * heartbeatMilliseconds
+
+// Bounds on the live events waiting to be forwarded to a track.  Past maxPendingEvents the
+// oldest is dropped, and while more than maxBufferedBytes are still unsent on the socket
+// forwarding is deferred, so a slow track can't make the server buffer without limit.
+const maxPendingEvents = 32
+const maxBufferedBytes = 64 * 1024
+const eventRetryMilliseconds = 50
+
+// Registrations are admitted at up to admissionRate per second, in bursts of up to
+// admissionBurst.  Up to admissionQueueLength more wait their turn, and the rest are turned
+// away with a retry-after hint.  Override with the DRR_ADMISSION_RATE, DRR_ADMISSION_BURST
+// and DRR_ADMISSION_QUEUE environment variables.
+const admissionRate = Number(process.env.DRR_ADMISSION_RATE) || 50
+const admissionBurst = Number(process.env.DRR_ADMISSION_BURST) || 2 * admissionRate
+const admissionQueueLength = Number(process.env.DRR_ADMISSION_QUEUE) || 10 * admissionRate
+
+// When run as a worker of drr_cluster.js, the worker's number, the port it listens on,
+// behind the cluster's router, and the membership store shared with the router
+const workerId = process.env.DRR_WORKER_ID === undefined ? undefined : Number(process.env.DRR_WORKER_ID)
+const listenPort = Number(process.env.DRR_PORT) || port
+const store = workerId === undefined ? null :
+    new (require('./drr_store').MembershipStore)(process.env.DRR_STORE)
+
+// Directory of the journal of circuit state that a restarted coordinator recovers from,
+// one per worker of drr_cluster.js, and the time tracks have after a restart to resume
+// their sessions before they are dropped.  Override with the DRR_STATE_DIR and
+// DRR_RESUME_GRACE_MS environment variables.
+const stateDirectory = path.join(process.env.DRR_STATE_DIR || '/var/tmp/drr',
+    workerId === undefined ? 'coordinator' : `worker-${workerId}`)
+const resumeGraceMilliseconds = Number(process.env.DRR_RESUME_GRACE_MS) || 60 * 1000
+
+// Journal records after which the journal is compacted into a fresh snapshot
+const compactionRecords = 1000
 
 // File system path for the root of the release directory. Customize this as you see fit
 const releases_root = '/home/htdocs/DRR'
 
 var server = express() // Server object provided by the Express framework: https://expressjs.com/
 var timeout = require('connect-timeout')
-var ipToCircuit = {} // Map of client IP address to registered circuit
-var circuits = {} // Map of all active circuits
+var sessionToCircuit = new Map() // Map of session token to registered circuit
+var circuits = new Map() // Map of all active circuits, by name
+var channels = new Map() // Map of session token to the channel registered with it
+var openChannels = new Set() // Every open channel, registered or not
+var journal = new Journal(stateDirectory)
+var recovering = false  // Replaying the journal, so changes aren't journaled again
 
+/* Metrics, reported by /metrics */
+var metrics = new Registry(workerId === undefined ? {} : {worker: workerId})
+const metricRoutes = new Set(['/register', '/deregister', '/start', '/results', '/health',
+    '/time', '/skew', '/metrics'])
+const requestDuration = metrics.histogram('drr_request_duration_seconds',
+    'Time to answer a request, including any barrier wait', ['transport', 'route', 'code'])
+const openRequestsGauge = metrics.gauge('drr_open_requests',
+    'Requests, including long polls, not yet answered', ['transport', 'route'])
+const barrierWait = metrics.histogram('drr_barrier_wait_seconds',
+    'Time each track waited at a barrier', ['barrier'], waitBuckets)
+const circuitWaitSeconds = metrics.counter('drr_circuit_barrier_wait_seconds_total',
+    'Total time tracks in the circuit waited at a barrier', ['circuit', 'barrier'])
+const circuitWaits = metrics.counter('drr_circuit_barrier_waits_total',
+    'Number of barrier waits by tracks in the circuit', ['circuit', 'barrier'])
+const trackHoldup = metrics.counter('drr_track_holdup_seconds_total',
+    'Time from the first track of a heat reaching a barrier to this track reaching it',
+    ['circuit', 'track', 'barrier'])
+const racesTotal = metrics.counter('drr_races_total', 'Races completed', ['circuit'])
+const circuitsGauge = metrics.gauge('drr_circuits', 'Active circuits')
+const participantsGauge = metrics.gauge('drr_participants', 'Tracks registered', ['circuit'])
+const heatsGauge = metrics.gauge('drr_heats_racing', 'Heats in progress', ['circuit'])
+const openChannelsGauge = metrics.gauge('drr_open_channels', 'Open channels')
+const admissionQueueGauge = metrics.gauge('drr_admission_queue_length',
+    'Registrations waiting for admission')
+
+// Time every HTTP request, and count those still open
+server.use(function(req, res, next) {
+    const route = routeName(req.path)
+    const started = performance.now()
+    openRequestsGauge.inc({transport: 'http', route: route})
+    res.on('close', function() {
+        openRequestsGauge.inc({transport: 'http', route: route}, -1)
+        requestDuration.observe({transport: 'http', route: route, code: res.statusCode},
+            (performance.now() - started) / 1000)
+    })
+    next()
+})
 server.use(bodyParser.json())
 server.use('/DRR', express.static(releases_root))
 server.use(timeout(86400*1000))  // One day timeout
 
 server.timeout = 86400*1000
 
+/*
+ * A barrier with a deadline, used to synchronize the start of each race and the collection
+ * of its results.
+ *
+ * Participants are keyed by session token.  Each in the expected set calls arrive() and
+ * waits on the returned promise.  The barrier trips when every expected participant has
+ * arrived, or graceMilliseconds after the first arrival, whichever comes first.  Each trip
+ * ends a generation: onTrip(outcome) is called and then every waiter is resolved with the
+ * same outcome,
+ *
+ *   {generation: <int>, arrived: [<session>, ...], missing: [<session>, ...],
+ *    arrivedAt: Map of <session> to the Date.now() it arrived}
+ *
+ * after which the barrier is reset for the next generation.  A participant removed while
+ * waiting has its wait rejected, and no longer holds up the others.
+ */
+class DeadlineBarrier {
+    constructor(name, graceMilliseconds, onTrip) {
+        this.name = name
+        this.graceMilliseconds = graceMilliseconds
+        this.onTrip = onTrip
+        this.generation = 0
+        this.expected = new Set()
+        this.waiters = new Map()    // session -> {resolve, reject} of each arrived participant
+        this.timer = null
+    }
+
+    // Set the participants the barrier waits for, by the session token of each
+    expect(sessions) {
+        this.expected = new Set(sessions)
+        this.tripIfComplete()
+    }
+
+    add(session) {
+        this.expected.add(session)
+    }
+
+    remove(session) {
+        this.expected.delete(session)
+        const waiter = this.waiters.get(session)
+        if (waiter !== undefined) {
+            this.waiters.delete(session)
+            waiter.reject(new RequestError(410, `${session} left the circuit while waiting at ${this.name}`))
+        }
+        if (this.waiters.size == 0) {
+            clearTimeout(this.timer)    // Nobody left waiting on the deadline
+            this.timer = null
+        }
+        this.tripIfComplete()
+    }
+
+    arrive(session) {
+        return new Promise((resolve, reject) => {
+            this.waiters.set(session, {resolve: resolve, reject: reject, since: Date.now()})
+            if (this.timer === null) {
+                this.timer = setTimeout(() => this.trip(), this.graceMilliseconds)
+            }
+            this.tripIfComplete()
+        })
+    }
+
+    tripIfComplete() {
+        if (this.waiters.size == 0) {
+            return
+        }
+        for (const session of this.expected) {
+            if (!this.waiters.has(session)) {
+                return
+            }
+        }
+        this.trip()
+    }
+
+    trip() {
+        clearTimeout(this.timer)
+        this.timer = null
+
+        const waiters = this.waiters
+        const outcome = {
+            generation: this.generation,
+            arrived: Array.from(waiters.keys()),
+            missing: Array.from(this.expected).filter(session => !waiters.has(session)),
+            arrivedAt: new Map(Array.from(waiters, ([session, waiter]) => [session, waiter.since]))
+        }
+        this.waiters = new Map()
+        this.generation++
+
+        if (outcome.missing.length > 0) {
+            console.log(`${this.name}: generation ${outcome.generation} deadline passed, missing ${outcome.missing}`)
+        }
+        this.onTrip(outcome)
+        for (const waiter of waiters.values()) {
+            waiter.resolve(outcome)
+        }
+    }
+}
+
+/*
+ * Schedules the heats of a circuit: sub-races of up to heatSize tracks formed from
+ * whichever tracks are ready, so a circuit runs several heats at once and no track waits
+ * on more than heatSize - 1 others.
+ *
+ * Each member of the circuit calls arrive() when it is ready and waits on the returned
+ * promise.  As soon as enough members are ready, heatSize or every member if the circuit
+ * is smaller, a heat is formed around the longest waiting track.  Its opponents are the
+ * ready tracks it has raced least often, so pairings rotate through the circuit.  When a
+ * track it has met less often is still racing, the heat is held for up to
+ * rotationMilliseconds to let it finish and join.
+ *
+ * If enough tracks don't become ready, a short heat is formed from the tracks that are,
+ * and the members that are neither ready nor racing are reported missing so they can be
+ * evicted.  That happens only once the longest waiting track has waited graceMilliseconds
+ * and every missing member has been absent that long since it joined or its last heat
+ * finished, and never while any member is still racing, as it will be ready shortly.
+ *
+ * onHeat(outcome) is called as each heat is formed, and then each of its tracks' waits is
+ * resolved with the same outcome,
+ *
+ *   {generation: <int>, arrived: [<session>, ...], missing: [<session>, ...],
+ *    arrivedAt: Map of <session> to the Date.now() it arrived}
+ *
+ * where generation numbers the heats of the circuit.  Members stay racing until finished()
+ * is called for them.  A member removed while waiting has its wait rejected.
+ */
+class HeatScheduler {
+    constructor(name, heatSize, rotationMilliseconds, graceMilliseconds, onHeat) {
+        this.name = name
+        this.heatSize = heatSize
+        this.rotationMilliseconds = rotationMilliseconds
+        this.graceMilliseconds = graceMilliseconds
+        this.onHeat = onHeat
+        this.generation = 0
+        this.members = new Map()    // session -> Map of opponent session -> heats raced together
+        this.ready = new Map()      // session -> {resolve, reject, since}, longest waiting first
+        this.racing = new Set()
+        this.available = new Map()  // session -> when it joined or its last heat finished
+        this.timer = null
+    }
+
+    add(session) {
+        if (!this.members.has(session)) {
+            this.members.set(session, new Map())
+            this.available.set(session, Date.now())
+        }
+    }
+
+    remove(session) {
+        const met = this.members.get(session)
+        if (met === undefined) {
+            return
+        }
+        for (const opponent of met.keys()) {
+            this.members.get(opponent).delete(session)
+        }
+        this.members.delete(session)
+        this.available.delete(session)
+        this.racing.delete(session)
+        const waiter = this.ready.get(session)
+        if (waiter !== undefined) {
+            this.ready.delete(session)
+            waiter.reject(new RequestError(410, `${session} left the circuit while waiting at ${this.name}`))
+        }
+        this.schedule()     // Fewer members may now fill a heat
+    }
+
+    arrive(session) {
+        return new Promise((resolve, reject) => {
+            this.racing.delete(session)
+            this.ready.set(session, {resolve: resolve, reject: reject, since: Date.now()})
+            this.schedule()
+        })
+    }
+
+    finished(sessions) {
+        const now = Date.now()
+        for (const session of sessions) {
+            if (this.racing.delete(session)) {
+                this.available.set(session, now)
+            }
+        }
+        this.schedule()
+    }
+
+    /*
+     * Reinstate a heat recovered from the journal, whose tracks are still racing
+     */
+    restore(heat, generation) {
+        for (const session of heat) {
+            this.racing.add(session)
+        }
+        this.generation = Math.max(this.generation, generation + 1)
+    }
+
+    schedule() {
+        const now = Date.now()
+        while (this.ready.size > 0) {
+            const size = Math.min(this.heatSize, this.members.size)
+            const [first, waiter] = this.ready.entries().next().value
+            let heat = null
+            if (this.ready.size >= size) {
+                heat = this.pick(first, this.ready.keys(), size)
+                if (now - waiter.since < this.rotationMilliseconds &&
+                        this.cost(heat) > this.cost(this.pick(first, this.members.keys(), size))) {
+                    heat = null     // A fairer heat is racing, and will be ready shortly
+                }
+            } else if (now >= this.graceDeadline(waiter)) {
+                heat = Array.from(this.ready.keys())
+            }
+            if (heat === null) {
+                break
+            }
+            this.start(heat)
+        }
+
+        clearTimeout(this.timer)
+        this.timer = null
+        if (this.ready.size > 0) {
+            const size = Math.min(this.heatSize, this.members.size)
+            const waiter = this.ready.values().next().value
+            const deadline = this.ready.size >= size ?
+                waiter.since + this.rotationMilliseconds : this.graceDeadline(waiter)
+            if (deadline !== Infinity) {
+                this.timer = setTimeout(() => this.schedule(), Math.max(0, deadline - now))
+            }
+        }
+    }
+
+    /*
+     * When a short heat may be formed around the longest waiting track: graceMilliseconds
+     * after the later of its arrival and the latest time a now absent member became
+     * available.  Infinity while any member is racing, as finished() schedules again.
+     */
+    graceDeadline(waiter) {
+        if (this.racing.size > 0) {
+            return Infinity
+        }
+        let since = waiter.since
+        for (const [session, available] of this.available) {
+            if (!this.ready.has(session)) {
+                since = Math.max(since, available)
+            }
+        }
+        return since + this.graceMilliseconds
+    }
+
+    /*
+     * Choose size tracks from candidates for a heat with first, greedily adding the
+     * candidate that has raced the tracks already chosen least often.  Ties go to the
+     * earlier candidate, which among ready tracks is the one that has waited longest.
+     */
+    pick(first, candidates, size) {
+        const heat = [first]
+        const others = Array.from(candidates).filter(session => session !== first)
+        while (heat.length < size && others.length > 0) {
+            let best = 0
+            let bestCost = Infinity
+            others.forEach((session, index) => {
+                const met = this.members.get(session)
+                const cost = heat.reduce((sum, chosen) => sum + (met.get(chosen) || 0), 0)
+                if (cost < bestCost) {
+                    best = index
+                    bestCost = cost
+                }
+            })
+            heat.push(others.splice(best, 1)[0])
+        }
+        return heat
+    }
+
+    /*
+     * Number of times the tracks of a heat have already raced one another
+     */
+    cost(heat) {
+        let total = 0
+        for (let i = 0; i < heat.length; i++) {
+            const met = this.members.get(heat[i])
+            for (let j = i + 1; j < heat.length; j++) {
+                total += met.get(heat[j]) || 0
+            }
+        }
+        return total
+    }
+
+    start(heat) {
+        const waiters = heat.map(session => this.ready.get(session))
+        for (const session of heat) {
+            this.ready.delete(session)
+            this.racing.add(session)
+            const met = this.members.get(session)
+            for (const opponent of heat) {
+                if (opponent !== session) {
+                    met.set(opponent, (met.get(opponent) || 0) + 1)
+                }
+            }
+        }
+
+        const missing = heat.length < Math.min(this.heatSize, this.members.size) ?
+            Array.from(this.members.keys()).filter(session =>
+                !this.racing.has(session) && !this.ready.has(session)) : []
+        const outcome = {generation: this.generation++, arrived: heat, missing: missing,
+            arrivedAt: new Map(heat.map((session, i) => [session, waiters[i].since]))}
+
+        if (missing.length > 0) {
+            console.log(`${this.name}: heat ${outcome.generation} deadline passed, missing ${missing}`)
+        }
+        this.onHeat(outcome)
+        for (const waiter of waiters) {
+            waiter.resolve(outcome)
+        }
+    }
+}
+
+/*
+ * Create the state maintained for each circuit
+ */
+function newCircuit(circuit) {
+    let state = {}
+    state.participants = new Map()  // Registered tracks, by session
+    state.rosters = new Map()   // Cached registration reply for each session
+    state.heats = new Map()     // Heats in progress, by race number
+    state.scheduler = new HeatScheduler(`${circuit} start`, heatSize, rotationMilliseconds,
+        startGraceMilliseconds, outcome => heatStarting(circuit, outcome))
+    return state
+}
+
 /* The following state is maintained for each circuit */
-circuits[defaultCircuit] = {}
-circuits[defaultCircuit].numParticipants = 0
-circuits[defaultCircuit].participants = []
-circuits[defaultCircuit].results = []
-circuits[defaultCircuit].startBarrier = null
-circuits[defaultCircuit].resultsBarrier = null
-circuits[defaultCircuit].registerBarrier = null
-
-/* Schedule a periodic task to run every minute looking for lost/disconnected tracks 
-cron.schedule('* * * * *', function() {
-    now = Date.now()
-    for (circuit in circuits) {
-        for (ip in circuits[circuit].participants) {
-            if (now - circuits[circuit].participants[ip].lastRequestTime > idleTimeoutMilliseconds) {
-                console.log(`ip ${ip} timed out from cicuit ${circuit}`)
-                deregister(ip)
+circuits.set(defaultCircuit, newCircuit(defaultCircuit))
+
+/*
+ * Admission control for registrations.  When the coordinator restarts, every Starting Gate
+ * in the field registers again at once.  Registrations are admitted at up to ratePerSecond,
+ * with bursts of up to burst, and the rest wait their turn in a queue of at most maxQueued.
+ * Past that, admit() fails at once with status 503 and a retry-after hint of how long the
+ * queue will take to drain, so the herd spreads itself out instead of piling up long polls.
+ */
+class AdmissionQueue {
+    constructor(ratePerSecond, burst, maxQueued) {
+        this.ratePerSecond = ratePerSecond
+        this.burst = burst
+        this.maxQueued = maxQueued
+        this.tokens = burst
+        this.refilled = Date.now()
+        this.queue = []             // resolve functions of the waiting registrations, in order
+        this.timer = null
+    }
+
+    admit() {
+        this.refill()
+        if (this.queue.length == 0 && this.tokens >= 1) {
+            this.tokens--
+            return Promise.resolve()
+        }
+        if (this.queue.length >= this.maxQueued) {
+            const retryAfter = Math.ceil(this.queue.length / this.ratePerSecond)
+            return Promise.reject(new RequestError(503,
+                `Coordinator busy, ${this.queue.length} registrations waiting`, retryAfter))
+        }
+        return new Promise(resolve => {
+            this.queue.push(resolve)
+            this.schedule()
+        })
+    }
+
+    refill() {
+        const now = Date.now()
+        this.tokens = Math.min(this.burst,
+            this.tokens + (now - this.refilled) * this.ratePerSecond / 1000)
+        this.refilled = now
+    }
+
+    drain() {
+        this.timer = null
+        this.refill()
+        while (this.queue.length > 0 && this.tokens >= 1) {
+            this.tokens--
+            this.queue.shift()()
+        }
+        this.schedule()
+    }
+
+    schedule() {
+        if (this.timer === null && this.queue.length > 0) {
+            const wait = (1 - this.tokens) * 1000 / this.ratePerSecond
+            this.timer = setTimeout(() => this.drain(), Math.max(0, wait))
+        }
+    }
+}
+
+var admissions = new AdmissionQueue(admissionRate, admissionBurst, admissionQueueLength)
+
+/*
+ * Idle tracks
+ *
+ *   A track that has made no request for idleTimeoutMilliseconds is evicted.  Any message
+ *   received on a track's channel, heartbeats included, counts as a request, and a track
+ *   waiting for a heat to form is never idle, however long the wait.  Rather than
+ *   scanning every participant, the sweeper keeps a min-heap holding one entry per
+ *   registered track, ordered by when that track would next become idle.  Requests only
+ *   update the track's lastRequestTime.  When an entry reaches the top of the heap the
+ *   sweeper either evicts the track or, if it has been active since, pushes the entry back
+ *   with its new deadline.  Entries for tracks that have since deregistered are dropped,
+ *   including those of a track that deregistered and then registered again, which has a
+ *   newer entry of its own.
+ */
+class MinHeap {
+    constructor(key) {
+        this.key = key
+        this.items = []
+    }
+
+    get size() {
+        return this.items.length
+    }
+
+    peek() {
+        return this.items[0]
+    }
+
+    push(item) {
+        const items = this.items
+        items.push(item)
+        let index = items.length - 1
+        while (index > 0) {
+            const parent = (index - 1) >> 1
+            if (this.key(items[parent]) <= this.key(item)) {
+                break
             }
+            items[index] = items[parent]
+            index = parent
         }
+        items[index] = item
     }
-})
-*/
-
-/*
- * Remove regitration for ip
- */
-function deregister(ip) {
-    if (ip in ipToCircuit) {
-        const circuit = ipToCircuit[ip]
-        delete ipToCircuit[ip]
-        const index = circuits[circuit].participants.indexOf(ip)
-        if (index > -1) {
-            circuits[circuit].participants.splice(index, 1)
-            //circuits[circuit].participants.delete(ip)
-            circuits[circuit].numParticipants--
-            circuits[circuit].results = []
-            circuits[circuit].startBarrier = makeAsyncBarrier(circuits[circuit].numParticipants)
-            delete circuits[circuit].registerBarrier;
+
+    pop() {
+        const items = this.items
+        const top = items[0]
+        const last = items.pop()
+        if (items.length > 0) {
+            let index = 0
+            for (;;) {
+                let child = 2 * index + 1
+                if (child >= items.length) {
+                    break
+                }
+                if (child + 1 < items.length && this.key(items[child + 1]) < this.key(items[child])) {
+                    child++
+                }
+                if (this.key(last) <= this.key(items[child])) {
+                    break
+                }
+                items[index] = items[child]
+                index = child
+            }
+            items[index] = last
+        }
+        return top
+    }
+}
+
+var idleHeap = new MinHeap(entry => entry.deadline) // {deadline, session, participant}
+
+function watchIdle(session, participant) {
+    idleHeap.push({deadline: participant.lastRequestTime + idleTimeoutMilliseconds,
+        session: session, participant: participant})
+}
+
+/*
+ * Returns the participant record for session, or undefined if it isn't registered
+ */
+function participantFor(session) {
+    const circuit = sessionToCircuit.get(session)
+    return circuit === undefined ? undefined : circuits.get(circuit).participants.get(session)
+}
+
+function sweepIdle() {
+    const now = Date.now()
+    while (idleHeap.size > 0 && idleHeap.peek().deadline <= now) {
+        const entry = idleHeap.pop()
+        if (participantFor(entry.session) !== entry.participant) {
+            continue    // Deregistered, or registered again with a newer entry
+        }
+        const circuit = sessionToCircuit.get(entry.session)
+        const waiting = circuits.get(circuit).scheduler.ready.has(entry.session)
+        const deadline = waiting ? now + idleTimeoutMilliseconds :
+            entry.participant.lastRequestTime + idleTimeoutMilliseconds
+        if (deadline > now) {
+            entry.deadline = deadline
+            idleHeap.push(entry)
+        } else {
+            evict(entry.session, `idle for ${idleTimeoutMilliseconds / 1000} seconds`)
+        }
+    }
+}
+
+/* Schedule a periodic task to run every minute looking for lost/disconnected tracks */
+cron.schedule('* * * * *', sweepIdle)
+
+/*
+ * Remove regitration for session.  A circuit is removed once its last track leaves.
+ */
+function deregister(session) {
+    if (sessionToCircuit.has(session)) {
+        const circuit = sessionToCircuit.get(session)
+        const state = circuits.get(circuit)
+        sessionToCircuit.delete(session)
+        if (store !== null) {
+            store.leave(session)
+        }
+        record({op: 'leave', session: session})
+        const participant = state.participants.get(session)
+        if (participant !== undefined) {
+            state.participants.delete(session)
+            state.rosters.clear()
+            const heat = participant.heat
+            if (heat !== undefined && !heat.concluded) {
+                leaveHeat(circuit, heat, session)
+            }
+            state.scheduler.remove(session)
+            trackHoldup.remove({circuit: circuit, track: participant.trackName})
         } else {
-            console.log(`ip ${ip} found in ipToCircuit, but not in circuit ${circuit}.participants`)
+            console.log(`session ${session} found in sessionToCircuit, but not in circuit ${circuit}.participants`)
+        }
+        if (state.participants.size == 0) {
+            console.log(`removing empty circuit ${circuit}`)
+            circuits.delete(circuit)
+            for (const metric of [circuitWaitSeconds, circuitWaits, racesTotal]) {
+                metric.remove({circuit: circuit})
+            }
         }
     }
 }
 
 /*
- * Regitration ip in circuit based on registration information
+ * Remove session from a heat in progress, ending the heat if no track remains to post
+ * results
+ */
+function leaveHeat(circuit, heat, session) {
+    heat.sessions = heat.sessions.filter(member => member !== session)
+    heat.resultsBarrier.remove(session)
+    if (heat.resultsBarrier.expected.size == 0) {
+        endHeat(circuit, heat)
+    }
+}
+
+/*
+ * Returns the heat session was drawn into and has yet to post results for, if any
+ */
+function pendingHeat(participant, session) {
+    const heat = participant.heat
+    if (heat === undefined || heat.concluded || heat.resultsWaiters.has(session)) {
+        return undefined
+    }
+    return heat
+}
+
+/*
+ * Remove a track that missed a barrier deadline from its circuit, closing its channel so
+ * the Starting Gate returns to its menu
+ */
+function evict(session, reason) {
+    console.log(`evicting session ${session}: ${reason}`)
+    deregister(session)
+    if (channels.has(session)) {
+        channels.get(session).close(4000, reason)
+    }
+}
+
+/*
+ * Returns a new, unguessable session token
+ */
+function newSession() {
+    return crypto.randomBytes(16).toString('hex')
+}
+
+/*
+ * Regitration session in circuit based on registration information
  */
-function register(ip, registration) {
+function register(session, ip, registration) {
     const circuit = 'circuit' in registration ? registration.circuit : defaultCircuit
-    console.log(`registering ip ${ip} in circuit ${circuit}`)
+    console.log(`registering session ${session} in circuit ${circuit}`)
 
     // Check to see if the registrant is already registered in a different circuit
-    if (ip in ipToCircuit && ipToCircuit[ip] !== circuit) {
-        console.log(`ip ${ip} registered in another circuit ${ipToCircuit[ip]}.  Deregistering`)
-        deregister(ip)
+    if (sessionToCircuit.has(session) && sessionToCircuit.get(session) !== circuit) {
+        console.log(`session ${session} registered in another circuit ${sessionToCircuit.get(session)}.  Deregistering`)
+        deregister(session)
     }
 
-    if (!(circuit in circuits)) {
+    if (!circuits.has(circuit)) {
         console.log('creating new circuit ' + circuit + ' from registration')
-        circuits[circuit] = {}
-        circuits[circuit].numParticipants = 0
-        circuits[circuit].participants = []
-        circuits[circuit].results = []
+        circuits.set(circuit, newCircuit(circuit))
     }
+    const state = circuits.get(circuit)
 
-    if ((ip in circuits[circuit].participants)) {
-        console.log(`ip ${ip} already registered in circuit ${circuit}`)
+    let participant = state.participants.get(session)
+    if (participant !== undefined) {
+        console.log(`session ${session} already registered in circuit ${circuit}`)
+        participant.lastRequestTime = Date.now()
     } else {
-        circuits[circuit].participants[ip] = {}
-        circuits[circuit].numParticipants++
-        circuits[circuit].joinBarrier = makeAsyncBarrier(2)
-        circuits[circuit].startBarrier = makeAsyncBarrier(circuits[circuit].numParticipants)
+        participant = {ip: ip, lastRequestTime: Date.now()}
+        state.participants.set(session, participant)
+        state.scheduler.add(session)
+        watchIdle(session, participant)
     }
 
     const trackName = 'trackName' in registration ? registration.trackName :
-        'Track ' + circuits[circuit].numParticipants
-    circuits[circuit].participants[ip].trackName = trackName
-    circuits[circuit].participants[ip].numLanes = registration.numLanes
-    circuits[circuit].participants[ip].carIcons = registration.carIcons
-    circuits[circuit].participants[ip].lastRequestTime = Date.now()
-    ipToCircuit[ip] = circuit
-
-    numParticipants = circuits[circuit].numParticipants
+        'Track ' + state.participants.size
+    participant.trackName = trackName
+    participant.numLanes = registration.numLanes
+    participant.carIcons = registration.carIcons
+    participant.registration = {
+        trackName: trackName,
+        numLanes: registration.numLanes,
+        carIcons: registration.carIcons
+    }
+    state.rosters.clear()
+    sessionToCircuit.set(session, circuit)
+    if (store !== null) {
+        store.join(session, circuit, workerId)
+    }
+    record({op: 'join', session: session, ip: ip, circuit: circuit,
+        registration: participant.registration})
+
+    const numParticipants = state.participants.size
     if (numParticipants == 1) {
         /* This is the first registration in the circuit.  Create the barrier to syncronize registrations */
-        console.log(`creating registrationBarrier for {circuit}`)
-        circuits[circuit].registrationBarrier = makeAsyncBarrier(2)
+        console.log(`creating registrationBarrier for ${circuit}`)
+        state.registrationBarrier = makeAsyncBarrier(2)
     }
 
     console.log(`Registration complete, numParticipants: ${numParticipants}`)
@@ -164,14 +848,92 @@ function register(ip, registration) {
 
 }
 
-function sendErrorResponse(res, code, text) {
-    res.writeHead(code, {
-        'Content-Type': 'text/plain'
-    })
+function sendErrorResponse(res, code, text, retryAfter) {
+    let headers = {'Content-Type': 'text/plain'}
+    if (retryAfter !== undefined) {
+        headers['Retry-After'] = retryAfter
+    }
+    res.writeHead(code, headers)
     res.write(text)
     res.end()
 }
 
+/*
+ * A request that can't be satisfied, answered with the given HTTP status code
+ */
+class RequestError extends Error {
+    constructor(code, text, retryAfter) {
+        super(text)
+        this.code = code
+        this.retryAfter = retryAfter    // Seconds, for status 503
+    }
+}
+
+/*
+ * A reply serialized once and shared by every request it answers, e.g. the standings sent
+ * to every track in a race
+ */
+class CachedReply {
+    constructor(value) {
+        this.bytes = Buffer.from(JSON.stringify(value))
+    }
+}
+
+/*
+ * Returns the serialized form of a handler's reply
+ */
+function replyBytes(reply) {
+    return reply instanceof CachedReply ? reply.bytes : Buffer.from(JSON.stringify(reply))
+}
+
+/*
+ * Returns the session of an HTTP request: its session token, or for tracks that predate
+ * session tokens, its IP address
+ */
+function requestSession(req) {
+    return req.get(sessionHeader) || clientAddress(req)
+}
+
+/*
+ * The address of the track that sent req.  Behind the cluster's router, connections all come
+ * from the router, which passes the track's address in X-Forwarded-For.
+ */
+function clientAddress(req) {
+    if (workerId !== undefined && req.headers['x-forwarded-for']) {
+        return req.headers['x-forwarded-for']
+    }
+    return req.socket.remoteAddress
+}
+
+/*
+ * Answer an HTTP request with the JSON reply of handler(session, body, ip), or the status
+ * code of the RequestError it throws.  Any other error is a bug, answered with status 500
+ * rather than rethrown, as an unhandled rejection would end the process and lose every
+ * circuit's state.
+ */
+async function sendReply(req, res, handler) {
+    try {
+        const reply = await handler(requestSession(req), req.body, clientAddress(req))
+        const bytes = replyBytes(reply)
+        res.writeHead(200, {
+            'Content-Type': 'application/json'
+        })
+        res.write(bytes)
+        res.end()
+    } catch (err) {
+        if (err instanceof RequestError) {
+            sendErrorResponse(res, err.code, err.message, err.retryAfter)
+            return
+        }
+        console.log(`${req.method} ${req.path} failed:`, err)
+        if (res.headersSent) {
+            res.destroy()
+        } else {
+            sendErrorResponse(res, 500, 'Internal coordinator error')
+        }
+    }
+}
+
 /*
  * POST /register
  *
@@ -206,6 +968,7 @@ function sendErrorResponse(res, code, text) {
  *   the track that originated the POST.  The shared circuit name is also omitted.
  *
  *   {"ip": <string>,
+ *    "session": <string>,
  *    "remoteRegistrations": [
  *       {"trackName": <string>,
  *        "numLanes": <int>,
@@ -214,82 +977,209 @@ function sendErrorResponse(res, code, text) {
  *       <repeated for any additional tracks in the circuit>
  *      ]
  *    }
+ *
+ *   ip is the registering track's address as seen by the coordinator, and session is the
+ *   token identifying its registration.  A track registering over HTTP without a token is
+ *   identified by its IP address, which is returned as its session.
+ *
+ *   Registrations are admitted at a bounded rate (see AdmissionQueue).  When too many are
+ *   already waiting, the request fails at once with status 503 and a Retry-After header
+ *   giving the seconds to wait before trying again.
  */
 
 server.post('/register', async function(req, res) {
-    const ip = req.connection.remoteAddress
     req.setTimeout(86400*100)
-    let registration
+    await sendReply(req, res, registerTrack)
+})
 
-    console.log(`/register(${ip}):`)
-    console.log('req.body = ', req.body)
+async function registerTrack(session, body, ip) {
+    console.log(`/register(${session}, ${ip}):`)
+    console.log('req.body = ', body)
 
-    let circuit = register(ip, req.body)
+    await admissions.admit()
+    let circuit = register(session, ip, body)
 
     console.log('/register, waiting on barrier')
-    await circuits[circuit].registrationBarrier()
+    const waitStarted = Date.now()
+    await circuits.get(circuit).registrationBarrier()
     console.log('/register, back from wait on barrier')
+    observeWait(circuit, 'register', (Date.now() - waitStarted) / 1000)
 
-    let results = {}
-    results.ip = ip
-    results.remoteRegistrations = []
+    // The track may have deregistered, been evicted or lost its channel while it waited,
+    // taking the circuit with it if it was the last track
+    const state = circuits.get(circuit)
+    if (state === undefined || !state.participants.has(session)) {
+        throw new RequestError(409, `${session} left circuit ${circuit} while registering`)
+    }
 
-    for (rip in circuits[circuit].participants) {
-        if (rip != ip) {
-            let registration = {}
-            registration.trackName = circuits[circuit].participants[rip].trackName
-            registration.numLanes = circuits[circuit].participants[rip].numLanes
-            registration.carIcons = circuits[circuit].participants[rip].carIcons
+    console.log("")
+    return roster(circuit, session)
+}
 
-            results.remoteRegistrations.push(registration)
+/*
+ * Returns the registration reply for session: the registrations of every other track in its
+ * circuit.  Each reply is built once and cached until the circuit's membership changes.
+ */
+function roster(circuit, session) {
+    const state = circuits.get(circuit)
+    if (!state.rosters.has(session)) {
+        let remoteRegistrations = []
+        for (const [rsession, participant] of state.participants) {
+            if (rsession != session) {
+                remoteRegistrations.push(participant.registration)
+            }
         }
+        state.rosters.set(session, new CachedReply({ip: state.participants.get(session).ip,
+            session: session, remoteRegistrations: remoteRegistrations}))
     }
+    return state.rosters.get(session)
+}
 
-    res.writeHead(200, {
-        'Content-Type': 'application/json'
-    })
-    res.write(JSON.stringify(results))
-    res.end()
-    console.log("")
+/*
+ * GET /time
+ *
+ *   Report the server's monotonic clock, in milliseconds.  Tracks sample it to convert
+ *   the startTime returned by /start into their local clock.
+ *
+ * Return:
+ *
+ *    {"time": <number>}
+ *
+ */
+server.get('/time', async function(req, res) {
+    await sendReply(req, res, serverTime)
 })
 
+function serverTime() {
+    return {time: serverNow()}
+}
+
+/*
+ * The server's clock, in milliseconds.  It is monotonic like performance.now(), but counts
+ * from the Unix epoch instead of the start of the process, so start times recovered from the
+ * journal keep their meaning after a restart, and every worker of drr_cluster.js agrees.
+ */
+function serverNow() {
+    return performance.timeOrigin + performance.now()
+}
+
 /*
  * GET /start 
  *
  *   Await start of race.
  *
+ *   Races are run in heats of up to heatSize tracks, drawn from the tracks of the circuit
+ *   that are ready, so a large circuit runs several heats at once.  A heat starts as soon as
+ *   enough tracks are ready, heatSize or every track if the circuit is smaller.  Opponents
+ *   rotate: each heat is formed around the longest waiting track with the ready tracks it
+ *   has raced least often, and waits up to rotationMilliseconds for a track it has raced
+ *   less often still to finish its current heat.
+ *
+ *   If not enough tracks are ready within startGraceMilliseconds of the first, the heat
+ *   starts with the tracks that are, and the tracks that are neither ready nor racing are
+ *   evicted from the circuit.
+ *
  * Return:
  *
  *    200 Status Code
  *
- *    "Start the Race!"
+ *    {"startTime": <number>, "race": <int>,
+ *     "opponents": [{"trackName": <string>, "numLanes": <int>, "carIcons": [<string>, ...]}, ...]}
  *
- */
-server.get('/start', async function(req, res) {
-    const ip = req.connection.remoteAddress
-
-    console.log(`/start(${ip}:`)
+ *   Over the channel, the body of a start request may be {"race": <int>}, the race reported
+ *   by a resume reply, to rejoin that heat rather than abandon it.
+ *
+ *   startTime is the instant, on the clock reported by /time, at which every track in the
+ *   heat releases its starting gate.
+ *
+ *   race is the number of the heat, to be posted back with its results.
+ *
+ *   opponents are the registrations of the other tracks in the heat.
+ *
+ */
+server.get('/start', async function(req, res) {
+    await sendReply(req, res, startRace)
+})
 
-    if (!(ip in ipToCircuit)) {
-        sendErrorResponse(res, 424, 'Received /start request prior to registration')
-        return
+async function startRace(session, body) {
+    console.log(`/start(${session}:`)
+
+    if (!sessionToCircuit.has(session)) {
+        throw new RequestError(424, 'Received /start request prior to registration')
     }
-    const circuit = ipToCircuit[ip]
+    const circuit = sessionToCircuit.get(session)
+    const participant = circuits.get(circuit).participants.get(session)
+    participant.lastRequestTime = Date.now()
 
-    console.log(`/start(${ip}: waiting for race ready`)
-    await circuits[circuit].startBarrier()
-    console.log(`/start(${ip}: race is ready`)
-    circuits[circuit].resultsBarrier = makeAsyncBarrier(circuits[circuit].numParticipants)
-    circuits[circuit].results = []
-    circuits[circuit].participants[ip].lastRequestTime = Date.now()
+    // A track that resumed its session after losing the reply to /start, e.g. to a
+    // coordinator restart, asks again for the race the resume reply reported.  Any other
+    // request from a track still in a heat abandons that race, e.g. after the Starting Gate
+    // lost its Finish Line, and waits for a new heat.
+    const state = circuits.get(circuit)
+    let heat = pendingHeat(participant, session)
+    const race = body != null && body.race != null ? Number(body.race) : null
+    if (heat !== undefined && heat.race !== race) {
+        console.log(`/start(${session}: abandoning race ${heat.race}`)
+        leaveHeat(circuit, heat, session)
+        participant.heat = undefined
+        record({op: 'withdraw', circuit: circuit, race: heat.race, session: session})
+        heat = undefined
+    }
+    if (heat === undefined) {
+        console.log(`/start(${session}: waiting for heat`)
+        const outcome = await state.scheduler.arrive(session)
+        console.log(`/start(${session}: race ${outcome.generation} is ready`)
+        participant.lastRequestTime = Date.now()
+        heat = participant.heat
+    }
+
+    const opponents = heat.sessions
+        .filter(opponent => opponent !== session && state.participants.has(opponent))
+        .map(opponent => state.participants.get(opponent).registration)
 
-    res.writeHead(200, {
-        'Content-Type': 'text/plain'
-    })
-    res.write("Start the Race!")
-    res.end()
     console.log("")
-})
+    return {startTime: heat.startTime, race: heat.race, opponents: opponents}
+}
+
+/*
+ * Heat formed: schedule its start, set up the collection of its results and evict the
+ * tracks that held up the start
+ */
+function heatStarting(circuit, outcome) {
+    const heat = beginHeat(circuit, outcome.generation, outcome.arrived,
+        serverNow() + startLeadMilliseconds)
+    record({op: 'heat', circuit: circuit, race: heat.race, sessions: heat.sessions,
+        startTime: heat.startTime})
+    recordBarrier(circuit, 'start', outcome.arrivedAt)
+
+    for (const session of outcome.missing) {
+        evict(session, `not ready for race ${heat.race} in circuit ${circuit}`)
+    }
+}
+
+/*
+ * Set up a heat in progress, and the collection of its results
+ */
+function beginHeat(circuit, race, sessions, startTime) {
+    const state = circuits.get(circuit)
+    const heat = {
+        race: race,
+        sessions: sessions,
+        startTime: startTime,
+        results: [],
+        resultsWaiters: new Map(),
+        concluded: false
+    }
+    heat.resultsBarrier = new DeadlineBarrier(`${circuit} race ${heat.race} results`,
+        resultsGraceMilliseconds, outcome => resultsCollected(circuit, heat, outcome))
+    heat.resultsBarrier.expect(heat.sessions)
+    state.heats.set(heat.race, heat)
+    for (const session of heat.sessions) {
+        state.participants.get(session).heat = heat
+    }
+    console.log(`circuit ${circuit}: race ${heat.race} with ${heat.sessions}, ${state.heats.size} heats racing`)
+    return heat
+}
 
 
 /*
@@ -299,64 +1189,308 @@ server.get('/start', async function(req, res) {
  *
  * POST Body:
  *
- *   The POST body is a JSON array of lane results
- *   [
- *     {"laneNumber": <number>, "laneTime":<number>},
- *     ...
- *     {"laneNumber": <number>, "laneTime":<number>}
- *   ]
+ *   {"results": [
+ *      {"laneNumber": <number>, "laneTime":<number>},
+ *      ...
+ *      {"laneNumber": <number>, "laneTime":<number>}
+ *    ],
+ *    "race": <int>,
+ *    "releaseTime": <number>
+ *   }
+ *
+ *   laneTime is measured from the release of the posting track's own starting gate.
+ *
+ *   race:          (optional) The race number returned by /start.  Results for a race that
+ *                             has already concluded are rejected with status 409.
+ *
+ *   releaseTime:   (optional) The instant the track's starting gate actually released, on
+ *                             the clock reported by /time.  Its difference from the scheduled
+ *                             startTime is the track's start skew, in seconds.
+ *
+ *   A bare JSON array of lane results, as posted by older Starting Gates, is also accepted
+ *   and answered with the bare sorted array described under rawStandings.
  *
  *  Return:
  *
- *   A sorted list of finishers from first to last
+ *   {"standings": [
+ *      {"trackName", "laneNumber": <number>, "laneTime":<number>,
+ *       "skew": <number>, "finishTime": <number>},
+ *      ...
+ *    ],
+ *    "rawStandings": [ <the same results> ],
+ *    "missing": [<trackName>, ...]
+ *   }
+ *
+ *   Results are returned once every track in the heat has posted them, or
+ *   resultsGraceMilliseconds after the first track posted.  Tracks that hadn't posted by
+ *   then are listed in missing, their lanes are included with "missing": true and a
+ *   laneTime of notFinished, and they are evicted from the circuit.
  *
- *   [
- *     {"trackName", "laneNumber": <number>, "laneTime":<number>},
- *     ...
- *     {"trackName", "laneNumber": <number>, "laneTime":<number>}
- *   ]
+ *   standings:     Finishers from first to last by laneTime.  As each track times its lanes
+ *                  from its own release, this ranking is free of the start skew between tracks.
+ *
+ *   rawStandings:  Finishers from first to last by finishTime, the lane's finish relative to
+ *                  the scheduled startTime (laneTime + skew).  This is the order a spectator
+ *                  watching every track would have seen the cars cross the line.
  *
  */
 
 server.post('/results', async function(req, res) {
-    const ip = req.connection.remoteAddress
+    await sendReply(req, res, postResults)
+})
 
-    console.log(`/results(${ip}):`)
-    console.log('req.body = ', req.body)
+async function postResults(session, body) {
+    console.log(`/results(${session}):`)
+    console.log('req.body = ', body)
 
-    if (!(ip in ipToCircuit)) {
-        sendErrorResponse(res, 424, 'Received /results request prior to registration')
-        return
+    if (!sessionToCircuit.has(session)) {
+        throw new RequestError(424, 'Received /results request prior to registration')
     }
 
-    const circuit = ipToCircuit[ip]
-    const trackName = circuits[circuit].participants[ip].trackName
+    const circuit = sessionToCircuit.get(session)
+    const state = circuits.get(circuit)
+    const participant = state.participants.get(session)
+    participant.lastRequestTime = Date.now()
+    const trackName = participant.trackName
+    const legacy = Array.isArray(body)
+    const laneResults = legacy ? body : body.results
+    const heat = participant.heat
 
-    for (index in req.body) {
-        let result = req.body[index]
-        result.trackName = trackName
-        console.log('adding result to circuit', result)
-        circuits[circuit].results.push(result)
+    if (heat === undefined) {
+        throw new RequestError(409, 'Results posted before the start of a race')
+    }
+    if (!legacy && body.race != null && body.race !== heat.race) {
+        throw new RequestError(409, `Results for race ${body.race}, which has already concluded`)
     }
 
-    // Wait for all results
-    await circuits[circuit].resultsBarrier()
-    circuits[circuit].startBarrier = makeAsyncBarrier(circuits[circuit].numParticipants)
-    circuits[circuit].participants[ip].lastRequestTime = Date.now()
+    // Clients retry /results after a network failure.  A retry joins the barrier wait of
+    // the original request instead of adding its results or arriving at the barrier again.
+    if (!heat.resultsWaiters.has(session)) {
+        if (heat.concluded) {
+            throw new RequestError(409, `Results for race ${heat.race}, which has already concluded`)
+        }
+        const skew = startSkew(heat.startTime, legacy ? null : body.releaseTime)
+        if (!legacy && body.releaseTime != null) {
+            recordSkew(participant, skew)
+        }
+        for (const index in laneResults) {
+            const result = laneResults[index]
+            result.trackName = trackName
+            result.skew = skew
+            result.finishTime = result.laneTime + skew
+            console.log('adding result to circuit', result)
+            heat.results.push(result)
+        }
+        heat.resultsWaiters.set(session, heat.resultsBarrier.arrive(session))
+    } else {
+        console.log(`/results(${session}): retried request, awaiting original barrier`)
+    }
+
+    // Wait for all results, or the deadline
+    const outcome = await heat.resultsWaiters.get(session)
+    participant.lastRequestTime = Date.now()
 
-    sortedResults = circuits[circuit].results
-    sortedResults.sort(function(a, b) {
+    console.log("")
+    return legacy ? outcome.legacyReply : outcome.reply
+}
+
+/*
+ * Results barrier trip: mark the lanes of tracks that didn't report as missing, evict
+ * those tracks and end the heat, freeing the others for their next.  The standings are
+ * sorted and serialized here, once, and the same bytes are sent to every track in the heat.
+ */
+function resultsCollected(circuit, heat, outcome) {
+    const state = circuits.get(circuit)
+    const results = heat.results
+    const missingTracks = []
+
+    endHeat(circuit, heat)
+    recordBarrier(circuit, 'results', outcome.arrivedAt)
+    racesTotal.inc({circuit: circuit})
+
+    for (const session of outcome.missing) {
+        const participant = state.participants.get(session)
+        missingTracks.push(participant.trackName)
+        for (let lane = 1; lane <= participant.numLanes; lane++) {
+            results.push({trackName: participant.trackName, laneNumber: lane,
+                laneTime: notFinished, skew: 0, finishTime: notFinished, missing: true})
+        }
+        evict(session, `no results for race ${heat.race} in circuit ${circuit}`)
+    }
+
+    const standings = results.slice()
+    standings.sort(function(a, b) {
         return a.laneTime - b.laneTime
     })
+    const rawStandings = results
+    rawStandings.sort(function(a, b) {
+        return a.finishTime - b.finishTime
+    })
+
+    console.log('standings: ', standings)
+    console.log('rawStandings: ', rawStandings)
+
+    outcome.reply = new CachedReply({standings: standings, rawStandings: rawStandings,
+        missing: missingTracks})
+    outcome.legacyReply = new CachedReply(rawStandings)
+
+    heat.results = []
+    if (circuits.has(circuit)) {
+        state.scheduler.finished(outcome.arrived)
+    }
+}
+
+/*
+ * Remove a heat that has collected its results, or lost all of its tracks
+ */
+function endHeat(circuit, heat) {
+    heat.concluded = true
+    circuits.get(circuit).heats.delete(heat.race)
+    record({op: 'concluded', circuit: circuit, race: heat.race})
+}
+
+/*
+ * Start skew, in seconds, of a track released at releaseTime for a race scheduled to start
+ * at startTime.  Tracks that cannot report their release are assumed to be on time.
+ */
+function startSkew(startTime, releaseTime) {
+    if (startTime == null || releaseTime == null) {
+        return 0
+    }
+    return (releaseTime - startTime) / 1000
+}
+
+/*
+ * Accumulate start skew statistics for a participant
+ */
+function recordSkew(participant, skew) {
+    if (!('skew' in participant)) {
+        participant.skew = {races: 0, sum: 0, sumSquares: 0, max: 0}
+    }
+    participant.skew.races++
+    participant.skew.sum += skew
+    participant.skew.sumSquares += skew * skew
+    participant.skew.max = Math.max(participant.skew.max, Math.abs(skew))
+}
+
+/*
+ * GET /metrics
+ *
+ *   Report the coordinator's metrics in the Prometheus text exposition format.
+ *
+ *   drr_request_duration_seconds        Histogram of the time to answer each request, by
+ *                                       transport (http or channel), route and status code.
+ *                                       Long polls include their barrier wait.
+ *   drr_open_requests                   Requests, including long polls, not yet answered
+ *   drr_barrier_wait_seconds            Histogram of each track's wait at the register,
+ *                                       start and results barriers
+ *   drr_circuit_barrier_wait_seconds_total,
+ *   drr_circuit_barrier_waits_total     Total and number of barrier waits in each circuit
+ *   drr_track_holdup_seconds_total      How long after the first track of its heat each
+ *                                       track reached the start and results barriers, i.e.
+ *                                       how long it kept the others waiting
+ *   drr_races_total                     Races completed in each circuit
+ *   drr_circuits, drr_participants,
+ *   drr_heats_racing, drr_open_channels,
+ *   drr_admission_queue_length          Current state
+ *
+ *   Series for a circuit or track are removed when it leaves.
+ *
+ */
+server.get('/metrics', function(req, res) {
+    res.writeHead(200, {
+        'Content-Type': 'text/plain; version=0.0.4'
+    })
+    res.write(metrics.render())
+    res.end()
+})
 
-    console.log('sortedResults: ', sortedResults)
+/*
+ * Name of the route of an HTTP request, for metrics labels
+ */
+function routeName(path) {
+    if (metricRoutes.has(path)) {
+        return path
+    }
+    return path.startsWith('/DRR') ? '/DRR' : 'other'
+}
+
+/*
+ * Record the waits of the tracks released together by a barrier.  arrivedAt maps each
+ * track's session to the time it arrived.
+ */
+function recordBarrier(circuit, barrier, arrivedAt) {
+    const now = Date.now()
+    const first = Math.min(...arrivedAt.values())
+    for (const [session, since] of arrivedAt) {
+        observeWait(circuit, barrier, (now - since) / 1000)
+        const participant = participantFor(session)
+        if (participant !== undefined) {
+            trackHoldup.inc({circuit: circuit, track: participant.trackName, barrier: barrier},
+                (since - first) / 1000)
+        }
+    }
+}
+
+function observeWait(circuit, barrier, seconds) {
+    barrierWait.observe({barrier: barrier}, seconds)
+    circuitWaitSeconds.inc({circuit: circuit, barrier: barrier}, seconds)
+    circuitWaits.inc({circuit: circuit, barrier: barrier})
+}
+
+metrics.onCollect(function() {
+    circuitsGauge.set({}, circuits.size)
+    participantsGauge.reset()
+    heatsGauge.reset()
+    for (const [circuit, state] of circuits) {
+        participantsGauge.set({circuit: circuit}, state.participants.size)
+        heatsGauge.set({circuit: circuit}, state.heats.size)
+    }
+    openChannelsGauge.set({}, openChannels.size)
+    admissionQueueGauge.set({}, admissions.queue.length)
+})
+
+/*
+ * GET /skew
+ *
+ *   Report how far each track's starting gate released from the scheduled start, accumulated
+ *   over the races it reported a releaseTime for.  All values are in seconds.
+ *
+ * Return:
+ *
+ *   {"<circuit>": {
+ *      "<trackName>": {"races": <int>, "meanSkew": <number>, "rmsSkew": <number>,
+ *                      "maxSkew": <number>},
+ *      ...
+ *    },
+ *    ...
+ *   }
+ *
+ *   maxSkew is the largest skew magnitude.  A positive meanSkew means the track releases late.
+ *
+ */
+server.get('/skew', function(req, res) {
+    let report = {}
+    for (const [circuit, state] of circuits) {
+        report[circuit] = {}
+        for (const participant of state.participants.values()) {
+            if ('skew' in participant) {
+                const stats = participant.skew
+                report[circuit][participant.trackName] = {
+                    races: stats.races,
+                    meanSkew: stats.sum / stats.races,
+                    rmsSkew: Math.sqrt(stats.sumSquares / stats.races),
+                    maxSkew: stats.max
+                }
+            }
+        }
+    }
 
     res.writeHead(200, {
         'Content-Type': 'application/json'
     })
-    res.write(JSON.stringify(sortedResults))
+    res.write(JSON.stringify(report))
     res.end()
-    console.log("")
 })
 
 
@@ -374,12 +1508,12 @@ server.post('/results', async function(req, res) {
  *    Goodbye message
  *
  */
-server.post('/deregister', async function(req, res) {
-    const ip = req.connection.remoteAddress
+server.post('/deregister', function(req, res) {
+    const session = requestSession(req)
 
-    console.log(`/deregister(${ip}):`)
+    console.log(`/deregister(${session}):`)
 
-    deregister(ip)
+    deregister(session)
     res.writeHead(200, {
         'Content-Type': 'text/plain'
     })
@@ -388,7 +1522,442 @@ server.post('/deregister', async function(req, res) {
     console.log("")
 })
 
+/*
+ * GET /health
+ *
+ *   Lightweight liveness probe used by the Starting Gate to decide whether to offer
+ *   multi-track racing.  Does not log, as tracks probe it every few seconds.
+ *
+ * Return:
+ *
+ *    200 Status Code
+ *
+ *    "OK"
+ *
+ */
+server.get('/health', function(req, res) {
+    res.writeHead(200, {
+        'Content-Type': 'text/plain'
+    })
+    res.write('OK')
+    res.end()
+})
+
+/*
+ * WebSocket /channel
+ *
+ *   A persistent channel between a track and the coordinator.  Each message is a JSON object:
+ *
+ *   Requests, from the track:
+ *
+ *     {"type": <string>, "id": <int>, "session": <string>, "body": <JSON value>}
+ *
+ *     type is one of "register", "start", "results", "deregister" or "time", and body is the
+ *     POST body of the corresponding HTTP endpoint, if any.  session is the token returned
+ *     by register.  A register request without a known session token is issued a new one.
+ *     The channel remains tied to the session it registered, and closing it deregisters
+ *     that session.
+ *
+ *     A "resume" request ties a new channel to the session of one that was lost, e.g. when
+ *     the coordinator restarted, and is answered with the register reply.  If the track was
+ *     drawn into a heat it has yet to post results for, the reply also carries the number
+ *     of that heat as "race", for the track to send with its next start request.  A session the
+ *     coordinator doesn't know is rejected with code 404, and the track must register.
+ *
+ *   Replies, from the coordinator:
+ *
+ *     {"type": "reply", "id": <int>, "body": <JSON value>}
+ *     {"type": "error", "id": <int>, "code": <int>, "text": <string>, "retryAfter": <int>}
+ *
+ *     id is that of the request, and body is what the HTTP endpoint would have returned.
+ *     retryAfter accompanies code 503, as the Retry-After header does over HTTP.
+ *     Replies to register are sent once all tracks in the circuit are ready, and replies
+ *     to start once the track's heat is formed.
+ *
+ *   Live race events, from the track:
+ *
+ *     {"type": "lanes", "body": {"occupied": <int>}}
+ *     {"type": "finish", "body": {"laneNumber": <number>, "laneTime": <number>}}
+ *
+ *     occupied is a bitmask of the lanes with cars in the starting gate, bit 0 for lane 1,
+ *     sent whenever it changes.  finish is sent as soon as a lane finishes.
+ *
+ *   Forwarded events, to the track:
+ *
+ *     {"type": "events", "body": [{"type": <string>, "trackName": <string>, "body": ...}, ...]}
+ *
+ *     Each event received from the other tracks in the circuit, with the sending track's
+ *     name.  Lanes events come from every track in the circuit, and finish events from the
+ *     tracks in the same heat.  Events arriving together are forwarded in one batch, and a lanes event
+ *     replaces any lanes event from the same track still waiting to be forwarded.
+ *
+ *   Heartbeats, in both directions:
+ *
+ *     {"type": "heartbeat"}
+ *
+ *   Both ends send a heartbeat every heartbeatMilliseconds.  A track that has sent nothing
+ *   for heartbeatTimeoutMilliseconds is disconnected, and closing the channel deregisters it.
+ */
+const channelHandlers = {
+    register: registerTrack,
+    start: startRace,
+    results: postResults,
+    deregister: function(session) {
+        console.log(`/deregister(${session}):`)
+        deregister(session)
+        return 'Deregistration complete. Bye.'
+    },
+    time: serverTime,
+    resume: resumeSession
+}
+
+/*
+ * Resume a session on a new channel after the track lost its channel, e.g. when the
+ * coordinator restarted, without registering again
+ */
+function resumeSession(session) {
+    console.log(`resume(${session}):`)
+    if (!sessionToCircuit.has(session)) {
+        throw new RequestError(404, `Unknown session ${session}`)
+    }
+    const circuit = sessionToCircuit.get(session)
+    const participant = circuits.get(circuit).participants.get(session)
+    participant.lastRequestTime = Date.now()
+    const heat = pendingHeat(participant, session)
+    if (heat === undefined) {
+        return roster(circuit, session)
+    }
+    // Resumes are rare, so the shared roster is copied rather than cached with the race
+    return Object.assign(JSON.parse(roster(circuit, session).bytes), {race: heat.race})
+}
+
+function sendMessage(ws, message) {
+    if (ws.readyState === WebSocket.OPEN) {
+        ws.send(JSON.stringify(message))
+    }
+}
+
+/*
+ * Send a reply, splicing in the bytes of a CachedReply rather than serializing it again
+ */
+function sendChannelReply(ws, id, body) {
+    if (ws.readyState === WebSocket.OPEN) {
+        const header = Buffer.from(`{"type":"reply","id":${JSON.stringify(id === undefined ? null : id)},"body":`)
+        ws.send(Buffer.concat([header, replyBytes(body), Buffer.from('}')]), {binary: false})
+    }
+}
+
+/*
+ * Forward a live race event from the track with the given session to every other track in
+ * its circuit
+ */
+function publishEvent(session, message) {
+    if (!sessionToCircuit.has(session)) {
+        return
+    }
+    const state = circuits.get(sessionToCircuit.get(session))
+    const participant = state.participants.get(session)
+    const trackName = participant.trackName
+    const event = {type: message.type, trackName: trackName, body: message.body}
+
+    // Lane occupancy is state, so only its latest value matters.  Finishes each count.
+    const key = message.type === 'lanes' ? `lanes:${trackName}` :
+        `${message.type}:${trackName}:${message.body && message.body.laneNumber}`
+
+    // Lane occupancy goes to the whole circuit, as any track may be drawn into the next
+    // heat with it.  Finishes only matter to the tracks racing in the same heat.
+    const heat = participant.heat
+    const recipients = message.type === 'lanes' ? state.participants.keys() :
+        heat !== undefined ? heat.sessions : []
+
+    for (const rsession of recipients) {
+        if (rsession != session && channels.has(rsession)) {
+            queueEvent(channels.get(rsession), key, event)
+        }
+    }
+}
+
+function queueEvent(ws, key, event) {
+    ws.pendingEvents.set(key, event)
+    if (ws.pendingEvents.size > maxPendingEvents) {
+        const oldest = ws.pendingEvents.keys().next().value
+        console.log(`channel(${ws.ip}): event queue full, dropping ${oldest}`)
+        ws.pendingEvents.delete(oldest)
+    }
+    if (!ws.flushScheduled) {
+        ws.flushScheduled = true
+        setImmediate(flushEvents, ws)
+    }
+}
+
+function flushEvents(ws) {
+    if (ws.readyState !== WebSocket.OPEN) {
+        ws.pendingEvents.clear()
+        ws.flushScheduled = false
+        return
+    }
+    if (ws.bufferedAmount > maxBufferedBytes) {
+        setTimeout(flushEvents, eventRetryMilliseconds, ws)
+        return
+    }
+    ws.flushScheduled = false
+    sendMessage(ws, {type: 'events', body: Array.from(ws.pendingEvents.values())})
+    ws.pendingEvents.clear()
+}
+
+async function channelRequest(ws, message) {
+    const handler = channelHandlers[message.type]
+    if (handler === undefined) {
+        sendMessage(ws, {type: 'error', id: message.id, code: 400, text: `unknown request ${message.type}`})
+        return
+    }
+    let session = message.session || ws.session
+    if (message.type === 'register') {
+        if (!sessionToCircuit.has(session)) {
+            session = newSession()
+        }
+        bindChannel(ws, session)
+    } else if (message.type === 'resume' && sessionToCircuit.has(session)) {
+        bindChannel(ws, session)
+    }
+    const labels = {transport: 'channel', route: message.type}
+    const started = performance.now()
+    let code = 200
+    openRequestsGauge.inc(labels)
+    try {
+        const body = await handler(session, message.body, ws.ip)
+        if (message.type === 'register' && ws.readyState !== WebSocket.OPEN) {
+            deregister(session)     // The track left while its registration was queued
+            return
+        }
+        sendChannelReply(ws, message.id, body)
+    } catch (err) {
+        code = err instanceof RequestError ? err.code : 500
+        console.log(`channel(${ws.ip}): ${message.type} failed: ${err.message}`)
+        sendMessage(ws, {type: 'error', id: message.id, code: code, text: err.message,
+            retryAfter: err.retryAfter})
+    } finally {
+        openRequestsGauge.inc(labels, -1)
+        requestDuration.observe(Object.assign({code: code}, labels),
+            (performance.now() - started) / 1000)
+    }
+}
+
+/*
+ * Tie a channel to the session registered over it, replacing any earlier channel of the
+ * same session
+ */
+function bindChannel(ws, session) {
+    if (ws.session === session) {
+        return
+    }
+    const previous = channels.get(session)
+    if (previous !== undefined) {
+        previous.session = null
+        previous.terminate()
+    }
+    if (ws.session !== null) {
+        channels.delete(ws.session)
+    }
+    channels.set(session, ws)
+    ws.session = session
+}
+
+function openChannel(ws, req) {
+    const ip = clientAddress(req)
+    console.log(`channel(${ip}): opened`)
+
+    openChannels.add(ws)
+    ws.ip = ip
+    ws.session = null
+    ws.lastReceived = Date.now()
+    ws.pendingEvents = new Map()    // Events to forward, by coalescing key, oldest first
+    ws.flushScheduled = false
+
+    ws.on('message', function(data) {
+        ws.lastReceived = Date.now()
+        if (ws.session !== null) {
+            const participant = participantFor(ws.session)
+            if (participant !== undefined) {
+                participant.lastRequestTime = ws.lastReceived
+            }
+        }
+        let message
+        try {
+            message = JSON.parse(data)
+        } catch (err) {
+            console.log(`channel(${ip}): malformed message`)
+            return
+        }
+        if (message.type === 'lanes' || message.type === 'finish') {
+            publishEvent(message.session || ws.session, message)
+        } else if (message.type !== 'heartbeat') {
+            channelRequest(ws, message)
+        }
+    })
+
+    ws.on('close', function() {
+        console.log(`channel(${ip}): closed`)
+        openChannels.delete(ws)
+        if (ws.session !== null && channels.get(ws.session) === ws) {
+            channels.delete(ws.session)
+            deregister(ws.session)
+        }
+    })
+}
+
+/* Send heartbeats on every channel and drop the tracks that have stopped sending theirs */
+setInterval(function() {
+    const now = Date.now()
+    for (const ws of openChannels) {
+        if (now - ws.lastReceived > heartbeatTimeoutMilliseconds) {
+            console.log(`channel(${ws.ip}): no heartbeat in ${heartbeatTimeoutMilliseconds}ms`)
+            ws.terminate()
+        } else {
+            sendMessage(ws, {type: 'heartbeat'})
+        }
+    }
+}, heartbeatMilliseconds)
+
+/*
+ * Journal a change to the circuit state, compacting the journal once it has grown
+ */
+function record(entry) {
+    if (recovering) {
+        return
+    }
+    journal.append(entry)
+    if (journal.records >= compactionRecords) {
+        compact()
+    }
+}
+
+function compact() {
+    journal.compact(snapshotState())
+}
+
+/*
+ * The state recovered after a restart: each circuit's members and heats in progress, and
+ * the number of its next heat so race numbers aren't reused
+ */
+function snapshotState() {
+    let snapshot = {circuits: {}}
+    for (const [circuit, state] of circuits) {
+        let participants = {}
+        for (const [session, participant] of state.participants) {
+            participants[session] = {ip: participant.ip, registration: participant.registration}
+        }
+        snapshot.circuits[circuit] = {
+            nextRace: state.scheduler.generation,
+            participants: participants,
+            heats: Array.from(state.heats.values(), heat =>
+                ({race: heat.race, sessions: heat.sessions, startTime: heat.startTime}))
+        }
+    }
+    return snapshot
+}
+
+function restoreHeat(circuit, race, sessions, startTime) {
+    if (!circuits.has(circuit)) {
+        return
+    }
+    const state = circuits.get(circuit)
+    const racing = sessions.filter(session => state.participants.has(session))
+    if (racing.length == 0) {
+        return
+    }
+    beginHeat(circuit, race, racing, startTime)
+    state.scheduler.restore(racing, race)
+}
+
+function applyRecord(entry) {
+    if (entry.op === 'join') {
+        register(entry.session, entry.ip,
+            Object.assign({circuit: entry.circuit}, entry.registration))
+    } else if (entry.op === 'leave') {
+        deregister(entry.session)
+    } else if (entry.op === 'heat') {
+        restoreHeat(entry.circuit, entry.race, entry.sessions, entry.startTime)
+    } else if (entry.op === 'withdraw' && circuits.has(entry.circuit)) {
+        const state = circuits.get(entry.circuit)
+        const heat = state.heats.get(entry.race)
+        if (heat !== undefined) {
+            leaveHeat(entry.circuit, heat, entry.session)
+            state.participants.get(entry.session).heat = undefined
+        }
+    } else if (entry.op === 'concluded' && circuits.has(entry.circuit)) {
+        const state = circuits.get(entry.circuit)
+        const heat = state.heats.get(entry.race)
+        if (heat !== undefined) {
+            heat.concluded = true
+            state.heats.delete(entry.race)
+            state.scheduler.finished(heat.sessions)
+        }
+    }
+}
+
+/*
+ * Reload the circuit state journaled before the coordinator restarted.  Tracks then have
+ * resumeGraceMilliseconds to resume their sessions, over a new channel or with any HTTP
+ * request, before they are dropped.
+ */
+function recover() {
+    const {snapshot, records} = journal.load()
+    recovering = true
+    if (snapshot !== null) {
+        for (const [circuit, saved] of Object.entries(snapshot.circuits)) {
+            for (const [session, participant] of Object.entries(saved.participants)) {
+                register(session, participant.ip,
+                    Object.assign({circuit: circuit}, participant.registration))
+            }
+            for (const heat of saved.heats) {
+                restoreHeat(circuit, heat.race, heat.sessions, heat.startTime)
+            }
+            if (circuits.has(circuit)) {
+                const scheduler = circuits.get(circuit).scheduler
+                scheduler.generation = Math.max(scheduler.generation, saved.nextRace)
+            }
+        }
+    }
+    for (const entry of records) {
+        applyRecord(entry)
+    }
+    recovering = false
+    compact()
+
+    const recoveredAt = Date.now()
+    const recovered = Array.from(sessionToCircuit.keys())
+    console.log(`recovered ${recovered.length} sessions in ${circuits.size} circuits from ${stateDirectory}`)
+    if (store !== null) {
+        for (const circuit of circuits.keys()) {
+            store.assign(circuit, workerId)
+        }
+    }
+
+    setTimeout(function() {
+        for (const session of recovered) {
+            const participant = participantFor(session)
+            if (participant !== undefined && !channels.has(session) &&
+                    participant.lastRequestTime <= recoveredAt) {
+                evict(session, 'did not resume after restart')
+            }
+        }
+    }, resumeGraceMilliseconds)
+}
+
+// Compact the journal every minute that it has changed
+cron.schedule('* * * * *', function() {
+    if (journal.records > 0) {
+        compact()
+    }
+})
+
 /* Ladies and gentlemen, start your server! */
-server.listen(port, () => console.log(`Raceway server listening at http://${hostname}:${port}`))
+recover()
+const listenOptions = workerId === undefined ? {port: listenPort} :
+    {port: listenPort, host: '127.0.0.1', exclusive: true}
+const httpServer = server.listen(listenOptions, () => console.log(`Raceway server listening at http://${hostname}:${listenPort}`))
+const channelServer = new WebSocket.Server({server: httpServer, path: '/channel'})
+channelServer.on('connection', openChannel)
 
 // vim: expandtab: sw=4
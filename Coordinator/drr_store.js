@@ -0,0 +1,116 @@
+/*
+ * Diecast Remote Raceway - Coordinator Membership Store
+ *
+ * When the coordinator runs as several worker processes (see drr_cluster.js), circuit
+ * membership is kept in a SQLite database shared by the router and every worker on the
+ * host:
+ *
+ *    circuits          The worker that owns each circuit.  The router assigns an owner the
+ *                      first time it sees a circuit and routes every later request for it
+ *                      to that worker.
+ *    sessions          The circuit each registered session belongs to, written by the
+ *                      owning worker on registration and removed on deregistration, so the
+ *                      router can route requests that only carry a session token.
+ *
+ * Ownership is sticky: a circuit stays with its worker for as long as it has members,
+ * however the set of workers changes, so barriers already waiting in a worker are never
+ * split.  Circuits left without members are released by sweep().
+ *
+ * The database runs in WAL mode, so the router's lookups don't wait on workers' writes.
+ *
+ * Linux Installation:
+ *
+ *    % npm install better-sqlite3 --save
+ *
+ */
+
+/* Imports */
+const Database = require('better-sqlite3')
+
+class MembershipStore {
+    constructor(path) {
+        this.db = new Database(path)
+        this.db.pragma('journal_mode = WAL')
+        this.db.pragma('busy_timeout = 5000')
+        this.db.exec(`
+            CREATE TABLE IF NOT EXISTS circuits (
+                circuit TEXT PRIMARY KEY,
+                worker INTEGER NOT NULL,
+                assigned INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS sessions (
+                session TEXT PRIMARY KEY,
+                circuit TEXT NOT NULL,
+                worker INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS sessions_by_circuit ON sessions (circuit);
+        `)
+
+        this.ownerQuery = this.db.prepare('SELECT worker FROM circuits WHERE circuit = ?')
+        this.assignQuery = this.db.prepare(
+            'INSERT OR IGNORE INTO circuits (circuit, worker, assigned) VALUES (?, ?, ?)')
+        this.circuitQuery = this.db.prepare('SELECT circuit FROM sessions WHERE session = ?')
+        this.joinQuery = this.db.prepare(
+            'INSERT OR REPLACE INTO sessions (session, circuit, worker) VALUES (?, ?, ?)')
+        this.leaveQuery = this.db.prepare('DELETE FROM sessions WHERE session = ?')
+        this.sweepQuery = this.db.prepare(`
+            DELETE FROM circuits WHERE assigned < ?
+                AND NOT EXISTS (SELECT 1 FROM sessions WHERE sessions.circuit = circuits.circuit)`)
+    }
+
+    /*
+     * The worker that owns circuit, or undefined if it has none
+     */
+    ownerOf(circuit) {
+        const row = this.ownerQuery.get(circuit)
+        return row === undefined ? undefined : row.worker
+    }
+
+    /*
+     * Make worker the owner of circuit unless it already has one.  Returns the owner.
+     */
+    assign(circuit, worker) {
+        this.assignQuery.run(circuit, worker, Date.now())
+        return this.ownerOf(circuit)
+    }
+
+    /*
+     * The circuit session is registered in, or undefined
+     */
+    circuitOf(session) {
+        const row = this.circuitQuery.get(session)
+        return row === undefined ? undefined : row.circuit
+    }
+
+    join(session, circuit, worker) {
+        this.joinQuery.run(session, circuit, worker)
+    }
+
+    leave(session) {
+        this.leaveQuery.run(session)
+    }
+
+    /*
+     * Release circuits assigned more than ageMilliseconds ago that no longer have members,
+     * so that they are placed on the current set of workers when next used.  The age covers
+     * a registration that has been routed but not yet recorded by its worker.
+     */
+    sweep(ageMilliseconds) {
+        return this.sweepQuery.run(Date.now() - ageMilliseconds).changes
+    }
+
+    /*
+     * Forget all membership, left behind by an earlier run of the coordinator
+     */
+    reset() {
+        this.db.exec('DELETE FROM sessions; DELETE FROM circuits;')
+    }
+
+    close() {
+        this.db.close()
+    }
+}
+
+module.exports = { MembershipStore }
+
+// vim: expandtab: sw=4
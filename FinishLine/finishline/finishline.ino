@@ -39,7 +39,7 @@ full license information.
 #include <SPIFFS.h>
 
 // Hard coded config
-const char* FW_VERSION = "21012000";
+const char* FW_VERSION = "26101701";
                        // YYMMDDVV Last two digits of Year, Month, Day, Version
 const char* fwVersionURLtemplate = "http://%s:%d/DRR/FL/version.txt";
 const char* fwURLtemplate = "http://%s:%d/DRR/FL/finish-line-%0d.bin";
@@ -89,14 +89,12 @@ enum Commands {
 };
 
 #define DEBOUNCE_MILLIS 100
+#define MAX_MESSAGE_LENGTH 48
 unsigned long lastFinish[MAX_LANES] = {0, 0, 0, 0};
-const int finishMessageLength = 4;
-const uint8_t* finishMessages[MAX_LANES] = {
-  (uint8_t*)"FIN1",
-  (uint8_t*)"FIN2",
-  (uint8_t*)"FIN3",
-  (uint8_t*)"FIN4"
-};
+
+// Every message exchanged with the Starting Gate is terminated with a newline so
+// messages that arrive coalesced or fragmented can be split apart.
+const uint8_t MESSAGE_TERMINATOR = '\n';
 
 /* Mapping for command string received over Bluetooth to enum */
 static const std::map<String, Commands> commandTable = {
@@ -121,6 +119,12 @@ Commands toCommand(String str) {
 BluetoothSerial SerialBT;
 bool raceRunning = false;
 
+// Send a newline terminated message to the Starting Gate
+void sendMessage(const uint8_t* message, size_t length) {
+  SerialBT.write(message, length);
+  SerialBT.write(MESSAGE_TERMINATOR);
+}
+
 bool saveConfig(const char* filename) {
   if (!SPIFFS.begin(true)) {
     Serial.println("saveConfig(): SPIFFS.begin() failed.");
@@ -257,10 +261,11 @@ bool getConfig(String configStr) {
   }
 
   String configJson;
-  if (serializeJsonPretty(doc, configJson)) {
+  if (serializeJson(doc, configJson)) {
     Serial.printf("config = %s\n", configJson.c_str());
   }
-  SerialBT.write((const uint8_t*)configJson.c_str(), configJson.length());
+  // Compact serialization, as a newline within the JSON would split the message
+  sendMessage((const uint8_t*)configJson.c_str(), configJson.length());
 
 }
 
@@ -389,8 +394,27 @@ void checkForUpdates() {
 }
 
 
+/*
+ * Timestamps sent to the Starting Gate are micros() readings.  The HELLO reply carries
+ * the time the HELO command was received, letting the Starting Gate estimate the offset
+ * and drift between the two clocks from the round trip, and FIN# messages carry the time
+ * the car crossed the finish line so Bluetooth latency doesn't count against lane times.
+ */
+void sendHello(unsigned long receivedMicros, String argument) {
+  char message[MAX_MESSAGE_LENGTH];
+  int length = snprintf(message, MAX_MESSAGE_LENGTH, "HELLO %lu %s", receivedMicros,
+                        argument.c_str());
+  if (length >= MAX_MESSAGE_LENGTH) {
+    length = MAX_MESSAGE_LENGTH - 1;  // Truncated by an overly long argument
+  }
+  sendMessage((const uint8_t*)message, length);
+}
+
 void processMessage() {
-  String data = SerialBT.readString();
+  // Commands are newline terminated, so readStringUntil() returns as soon as the
+  // command arrives rather than waiting out the stream timeout like readString().
+  String data = SerialBT.readStringUntil('\n');
+  unsigned long receivedMicros = micros();
   Serial.println("Received '" + data + "' from Starting Line");
   if (data.length() < 3) {
     Serial.println("Command too short");
@@ -405,7 +429,7 @@ void processMessage() {
 
   switch (toCommand(command)) {
     case HELLO:
-      SerialBT.write((const uint8_t*)"HELLO", 5);
+      sendHello(receivedMicros, argument);
       break;
     case RESTART:
       ESP.restart();
@@ -414,7 +438,7 @@ void processMessage() {
       checkForUpdates();
       break;
     case VERSION:
-      SerialBT.write((const uint8_t*)FW_VERSION, strlen(FW_VERSION));
+      sendMessage((const uint8_t*)FW_VERSION, strlen(FW_VERSION));
       break;
     case BEGIN_RACE:
       raceRunning = true;
@@ -438,8 +462,11 @@ void processMessage() {
 }
 
 void sendResult(Lanes lane) {
+  unsigned long finishMicros = micros();
+  char message[MAX_MESSAGE_LENGTH];
+  int length = snprintf(message, MAX_MESSAGE_LENGTH, "FIN%d %lu", lane + 1, finishMicros);
+  sendMessage((const uint8_t*)message, length);
   Serial.printf("LANE%0d finished.\n", lane + 1);
-  SerialBT.write(finishMessages[lane], finishMessageLength);
   lastFinish[lane] = millis();
 }
 
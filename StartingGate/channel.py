@@ -0,0 +1,277 @@
+#! /usr/bin/python3
+
+"""
+Diecast Remote Raceway - Coordinator Channel
+
+Persistent WebSocket connection to the race coordinator.
+
+Registering, starting a race, reporting results and deregistering used to each take an
+HTTP request, and /register and /start were long polls the coordinator could hold open
+for up to a day.  A Channel instead holds a single WebSocket open to the coordinator for
+as long as the track is registered, and carries each of those interactions as a JSON
+message over it.  The coordinator's start signal reaches the track over the open socket,
+with no connection setup on the critical path.
+
+Every message is a JSON object with a "type".  Requests carry an "id" that the
+coordinator echoes in its "reply" or "error" message, so a reply that arrives after its
+request was abandoned is simply dropped.  Once registered, requests and notifications
+also carry the session token the coordinator issued, which identifies the track even
+when several share one IP address.  Notifications carry no id and get no reply.
+They stream live race events between tracks while they happen.
+
+Both ends send a heartbeat message every HEARTBEAT_SECONDS.  If nothing at all is
+received for HEARTBEAT_TIMEOUT seconds the peer is presumed dead and the channel is
+closed, failing any outstanding requests within seconds rather than never.
+
+Author: Tom Quiggle
+tquiggle@gmail.com
+https://github.com/tquiggle/Die-Cast-Remote-Raceway
+
+Copyright (c) Thomas Quiggle. All rights reserved.
+
+Licensed under the MIT license. See LICENSE file in the project root for full license information.
+
+"""
+
+import itertools
+import json
+import threading
+import time
+
+import websocket
+
+from config import Config
+
+# Path of the channel endpoint on the coordinator
+CHANNEL_PATH = "/channel"
+
+# Interval between heartbeats, and the silence after which the coordinator is presumed dead
+HEARTBEAT_SECONDS = 2.0
+HEARTBEAT_TIMEOUT = 3 * HEARTBEAT_SECONDS
+
+class ChannelError(Exception):
+    """
+    Raised when the coordinator rejects a request sent over the channel.  code is the status
+    the coordinator gave, and retry_after, with status 503, the seconds it asked the track to
+    wait before trying again.
+    """
+
+    def __init__(self, message, code=None, retry_after=None):
+        super().__init__(message)
+        self.code = code
+        self.retry_after = retry_after
+
+class ChannelClosed(ChannelError):
+    """
+    Raised when the channel closes, or is found dead, before a request is answered
+    """
+
+class Channel:
+    """
+    A WebSocket connection to the race coordinator carrying request/reply messages.
+
+    A reader thread receives messages, hands replies to the waiting requests and
+    notifications to their listeners, and sends heartbeats.  request() and notify() may be
+    called from any thread.
+    """
+
+# PUBLIC:
+
+    def open(self, timeout):
+        """
+        Connect to the coordinator, waiting at most timeout seconds, and start the reader
+        thread.  Raises websocket.WebSocketException or OSError if the connection fails.
+        """
+        self.socket = websocket.create_connection(self.url, timeout=timeout)
+        self.socket.settimeout(HEARTBEAT_SECONDS)
+        self.last_received = time.monotonic()
+        self.last_sent = self.last_received
+        self.reader = threading.Thread(target=self.__read, daemon=True)
+        self.reader.start()
+
+    def is_open(self):
+        """
+        Returns True while the channel is connected
+        """
+        return self.socket is not None and not self.closed
+
+    def request(self, message_type, body=None, timeout=None):
+        """
+        Send a request and wait up to timeout seconds, or indefinitely if None, for the
+        coordinator's reply.
+
+        Returns the body of the reply.  Raises ChannelError if the coordinator rejects the
+        request and ChannelClosed if the channel closes or the reply doesn't arrive in time.
+        """
+        request_id = next(self.ids)
+        waiter = {'event': threading.Event()}
+        with self.lock:
+            if self.closed:
+                raise ChannelClosed("channel is closed")
+            self.waiters[request_id] = waiter
+
+        try:
+            self.__send({'type': message_type, 'id': request_id, 'body': body})
+            if not waiter['event'].wait(timeout):
+                raise ChannelClosed("no reply to {} within {}s".format(message_type, timeout))
+        finally:
+            with self.lock:
+                self.waiters.pop(request_id, None)
+
+        if 'error' in waiter:
+            raise waiter['error']
+        return waiter['body']
+
+    def notify(self, message_type, body=None):
+        """
+        Send a notification, which the coordinator doesn't reply to.  Raises ChannelClosed
+        if the channel is closed.
+        """
+        if self.closed:
+            raise ChannelClosed("channel is closed")
+        self.__send({'type': message_type, 'body': body})
+
+    def listen(self, message_type, listener):
+        """
+        Call listener(body) on the reader thread for each notification of message_type
+        received from the coordinator
+        """
+        self.listeners[message_type] = listener
+
+    def close(self):
+        """
+        Close the channel, failing any outstanding requests
+        """
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            waiters = list(self.waiters.values())
+            self.waiters.clear()
+
+        for waiter in waiters:
+            waiter['error'] = ChannelClosed("channel closed")
+            waiter['event'].set()
+
+        # Send the close frame without waiting for the coordinator to echo it, then shut
+        # down the socket, which also wakes the reader thread.
+        if self.socket is not None:
+            try:
+                with self.send_lock:
+                    self.socket.send_close()
+            except (websocket.WebSocketException, OSError):
+                pass
+            self.socket.shutdown()
+
+# PRIVATE:
+
+    def __init__(self, url):
+        self.url = url
+        self.session = None             # Session token issued at registration
+        self.socket = None
+        self.reader = None
+        self.closed = False
+        self.ids = itertools.count(1)
+        self.waiters = {}               # request id -> waiter dict, guarded by lock
+        self.listeners = {}             # notification type -> listener
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        self.last_received = 0.0
+        self.last_sent = 0.0
+
+    def __send(self, message):
+        """
+        Send a message, serializing writers from the reader and requesting threads
+        """
+        if self.session is not None and message['type'] != 'heartbeat':
+            message['session'] = self.session
+        data = json.dumps(message)
+        try:
+            with self.send_lock:
+                self.socket.send(data)
+                self.last_sent = time.monotonic()
+        except (websocket.WebSocketException, OSError) as exc:
+            self.close()
+            raise ChannelClosed("send failed: {}".format(exc)) from exc
+
+    def __read(self):
+        """
+        Reader thread.  Dispatches received messages, sends heartbeats and closes the
+        channel once the coordinator has been silent for HEARTBEAT_TIMEOUT.
+        """
+        while not self.closed:
+            try:
+                data = self.socket.recv()
+                self.last_received = time.monotonic()
+                if data:
+                    self.__dispatch(json.loads(data))
+            except websocket.WebSocketTimeoutException:
+                pass
+            except (websocket.WebSocketException, OSError, ValueError) as exc:
+                if not self.closed:
+                    print("Channel: connection lost", exc)
+                break
+
+            now = time.monotonic()
+            if now - self.last_received > HEARTBEAT_TIMEOUT:
+                print("Channel: no heartbeat from coordinator in", HEARTBEAT_TIMEOUT, "seconds")
+                break
+            if now - self.last_sent >= HEARTBEAT_SECONDS:
+                try:
+                    self.__send({'type': 'heartbeat'})
+                except ChannelClosed:
+                    break
+
+        self.close()
+
+    def __dispatch(self, message):
+        """
+        Hand a reply or error to the request waiting on it, or a notification to its
+        listener
+        """
+        message_type = message.get('type')
+        if message_type not in ('reply', 'error'):
+            listener = self.listeners.get(message_type)
+            if listener is not None:
+                # A listener that fails on a bad notification must not kill the reader
+                # thread, which would leave every request waiting forever
+                try:
+                    listener(message.get('body'))
+                except Exception as exc: #pylint: disable=broad-except
+                    print("Channel: {} listener failed".format(message_type), repr(exc))
+            return
+
+        with self.lock:
+            waiter = self.waiters.get(message.get('id'))
+        if waiter is None:
+            return  # The request was abandoned
+
+        if message_type == 'error':
+            waiter['error'] = ChannelError("{} {}".format(message.get('code'),
+                                                          message.get('text')),
+                                           message.get('code'), message.get('retryAfter'))
+        else:
+            waiter['body'] = message.get('body')
+        waiter['event'].set()
+
+def main():
+    """
+    At some point I should write legitimate unit tests.  But for now, I just exercise
+    some basic functionality if the class is invoked as the Python main.
+    """
+
+    main_config = Config("config/starting_gate.json")
+    main_channel = Channel("ws://{}:{}{}".format(main_config.coord_host,
+                                                 main_config.coord_port, CHANNEL_PATH))
+    main_channel.open(3.05)
+    for _ in range(3):
+        sent = time.monotonic()
+        reply = main_channel.request('time', timeout=1.0)
+        print("coordinator time", reply['time'], "rtt", time.monotonic() - sent)
+    main_channel.close()
+
+
+if __name__ == '__main__':
+    main()
+
+# vim: expandtab sw=4
@@ -70,6 +70,8 @@ MULTI_TRACK = "multi_track"             # Tracks in the current racing session,
 REMOTE_TRACK_NAME = "remote_track_name" # Name of the remote track we are racing against
 REMOTE_NUM_LANES = "remote_num_lanes"   # Number of lanes in the track we are racing against
 REMOTE_CAR_ICONS = "remote_car_icons"   # Car icons to use for remote lanes
+REMOTE_LANES_OCCUPIED = "remote_lanes_occupied" # Bitmask of remote lanes with cars present
+REMOTE_FINISH_TIMES = "remote_finish_times"     # Remote lane times reported during the race
 
 PERSISTED_CONFIGS = [CAR_ICONS,
                      CIRCUIT,
@@ -89,7 +91,9 @@ EPHEMERAL_CONFIGS = [ALLOW_MULTI_TRACK,
                      MULTI_TRACK,
                      REMOTE_TRACK_NAME,
                      REMOTE_NUM_LANES,
-                     REMOTE_CAR_ICONS]
+                     REMOTE_CAR_ICONS,
+                     REMOTE_LANES_OCCUPIED,
+                     REMOTE_FINISH_TIMES]
 
 class Config:
 
@@ -131,6 +135,8 @@ class Config:
     DEFAULT[NUM_LANES] = 2
     DEFAULT[RACE_TIMEOUT] = 5.0
     DEFAULT[REMOTE_CAR_ICONS] = ["question", "question", "question", "question"]
+    DEFAULT[REMOTE_FINISH_TIMES] = [None, None, None, None]
+    DEFAULT[REMOTE_LANES_OCCUPIED] = 0
     DEFAULT[REMOTE_NUM_LANES] = 2
     DEFAULT[REMOTE_TRACK_NAME] = "UNKNOWN"
     DEFAULT[SERVO_DOWN_VALUE] = 1.0
@@ -15,30 +15,139 @@ Licensed under the MIT license. See LICENSE file in the project root for full li
 
 """
 
-import errno
 import json
-import sys
+import random
+import socket
+import threading
+import time
+import urllib.parse
 import requests
+import websocket
 
-import deviceio
-from deviceio import DeviceIO
+from channel import Channel, ChannelClosed, ChannelError, CHANNEL_PATH
 
 from config import Config, CAR1, CAR2, CAR3, CAR4 #pylint: disable=unused-import
 
-def key_pressed():
+# Timeouts, in seconds.  Requests made over HTTP take (connect, read) tuples.  Replies to
+# register and start requests on the channel only arrive once the other tracks in the
+# circuit are ready, so they have no timeout. The user can abort them with a key press,
+# and the channel's heartbeats detect a coordinator that has gone away.
+CONNECT_TIMEOUT = 3.05
+RESULTS_TIMEOUT = 60
+DEREGISTER_TIMEOUT = (CONNECT_TIMEOUT, 5)
+
+# Health probes use short timeouts so an unreachable coordinator is detected quickly. While
+# the menu is displayed the coordinator is probed about every PROBE_INTERVAL seconds,
+# jittered so a field of tracks restarted together doesn't probe in step.
+PROBE_TIMEOUT = (1.0, 1.0)
+PROBE_INTERVAL = 5.0
+
+# Number of time request round trips used to estimate the offset to the coordinator's clock
+# for each multi-track race
+CLOCK_PROBES = 5
+
+NANOSECONDS_PER_MILLISECOND = 1000000
+
+# HTTP header carrying the session token issued at registration
+SESSION_HEADER = "X-DRR-Session"
+
+# Idempotent requests are retried up to RETRIES times with jittered exponential backoff
+RETRIES = 3
+BACKOFF_SECONDS = 0.5
+
+# Registration is retried up to REGISTER_RETRIES times while the coordinator is unreachable
+# or asks the track to retry later, as it does when every track in the field registers at
+# once after it restarts.  Backoff grows from BACKOFF_SECONDS up to BACKOFF_CAP_SECONDS.
+REGISTER_RETRIES = 8
+BACKOFF_CAP_SECONDS = 30.0
+
+# HTTP status with which the coordinator turns registrations away when too many are waiting
+SERVICE_UNAVAILABLE = 503
+
+# Requests sent again after the channel is lost and the session resumed on a new one.  The
+# coordinator answers a repeated start with the heat the track is already in, and adds
+# repeated results to the heat's collection only once.
+RESUMABLE_REQUESTS = ('start', 'results')
+RESUME_TIMEOUT = 5
+
+# Status with which the coordinator rejects resuming a session it doesn't know
+SESSION_UNKNOWN = 404
+
+def backoff_delay(attempt, retry_after=None):
+    """
+    Returns the seconds to wait before retry number attempt, counting from 0.  The delay is
+    drawn at random up to an exponentially growing bound, so tracks that failed together
+    retry at different times.  A retry_after hint from the coordinator sets the least delay,
+    and the jitter spreads the retries over the same time again.
+    """
+    if retry_after:
+        return retry_after + random.uniform(0, retry_after)
+    return random.uniform(0, min(BACKOFF_CAP_SECONDS, BACKOFF_SECONDS * 2 ** attempt))
+
+class CoordinatorCancelled(Exception):
+    """
+    Raised when the user presses a key to abort a request blocked on the coordinator.
+    """
+
+class ServerClock:
     """
-    Callback invoked when a key is pressed while blocked on communication with
-    the coordinator.  Aborts the current execution.  The wrapper will restart.
+    Estimates the offset between the coordinator's clock and time.monotonic_ns().
+
+    Each time request round trip pairs the coordinator's clock reading with the midpoint of
+    the local send and receive times.  The sample with the smallest round trip time has
+    the least uncertainty, at most half its round trip, and determines the offset.  The
+    race start is only a few seconds after synchronizing, so drift is ignored.
     """
-    print("key_pressed(): sys.exit(errno.ERESTART)")
-    sys.exit(errno.ERESTART)
+
+# PUBLIC:
+
+    def reset(self):
+        """
+        Discard all samples. The coordinator's clock restarts along with the coordinator.
+        """
+        self.best = None
+
+    def add_sample(self, server_ms, sent_ns, received_ns):
+        """
+        Record a round trip in which the coordinator read server_ms from its clock
+        """
+        rtt = received_ns - sent_ns
+        if self.best is None or rtt < self.best[2]:
+            self.best = (server_ms, (sent_ns + received_ns) // 2, rtt)
+
+    def is_synchronized(self):
+        """
+        Returns True once at least one sample has been recorded
+        """
+        return self.best is not None
+
+    def to_server_ms(self, local_ns):
+        """
+        Convert a time.monotonic_ns() reading to the coordinator's clock
+        """
+        best_server_ms, best_local_ns, _ = self.best
+        return best_server_ms + (local_ns - best_local_ns) / NANOSECONDS_PER_MILLISECOND
+
+    def to_local_ns(self, server_ms):
+        """
+        Convert a coordinator clock reading to the time.monotonic_ns() timebase
+        """
+        best_server_ms, best_local_ns, _ = self.best
+        return best_local_ns + round((server_ms - best_server_ms) * NANOSECONDS_PER_MILLISECOND)
+
+# PRIVATE:
+
+    def __init__(self):
+        self.best = None    # (server_ms, local_ns, rtt_ns) of the smallest round trip
+
 
 class Coordinator:
     """
 
     Provides all communication between the Starting Gate and the Race Coordinator
 
-    The local race controller communicates with the Race Coordinator at via 4 interactions:
+    The local race controller communicates with the Race Coordinator at via 4 interactions,
+    each carried as a message on a persistent Channel opened at registration:
 
     * register:   upon startup, if multi-track racing is selected, the local track registers
                   with the Race Coordinator providing the track_name, number of lanes, and
@@ -48,21 +157,109 @@ class Coordinator:
                   removes its registration with the Race Coordinator.
 
     * start:      Indicates that the local track is ready to start a race.  The Race
-                  Coordinator will only respond to the request once all tracks are ready
+                  Coordinator responds once it has drawn the track into a heat with the
+                  other ready tracks it has raced least often.  The first opponent in the
+                  heat becomes the remote track shown on the display.
 
     * results:    The local track reports its results and awaits the global results.
 
+    While registered, the local track also streams its lane occupancy and each lane's finish
+    to the coordinator as they happen, via lanes_changed() and lane_finished().  The
+    coordinator forwards them to the other tracks in the circuit, and the corresponding
+    events from the current remote track are kept in config.remote_lanes_occupied and
+    config.remote_finish_times for the race display.
+
+    The coordinator answers start with a shared start instant a few seconds in the future.
+    The local track then samples the coordinator's clock with time request round trips and
+    start_race() converts the instant to the local time.monotonic_ns() timebase, so every
+    track releases its gate at the same real time, whatever its network latency.
+
+    Requests to the coordinator run on a worker thread while the caller waits for the
+    response or a key press.  A key press cancels the wait and raises CoordinatorCancelled
+    so the Starting Gate returns to the menu with its Bluetooth link and display intact.
+    The abandoned request is left to finish on its own.  Its reply, if any, is dropped.
+
+    If the channel is lost while a start or results request is outstanding, e.g. because
+    the coordinator restarted, the session is resumed on a new channel and the request sent
+    again, so the race carries on without registering again.
+
+    A health monitor thread deregisters in the background, closing the channel, each
+    time the Starting Gate returns to the menu and then probes the coordinator while the
+    menu is displayed.  It keeps config.allow_multi_track current, so the menu greys out
+    Multi Track as the coordinator becomes unreachable without ever waiting on the network.
     """
 
 # PUBLIC:
 
-    def __init__(self, config):
+    def __init__(self, config, device=None):
         self.config = config
-        self.register_url = "http://{}:{}/register".format(config.coord_host, config.coord_port)
-        self.start_url = "http://{}:{}/start".format(config.coord_host, config.coord_port)
-        self.results_url = "http://{}:{}/results".format(config.coord_host, config.coord_port)
-        self.deregister_url = "http://{}:{}/deregister".format(config.coord_host, config.coord_port)
-        self.device = DeviceIO()
+
+        # Key handlers and lane sensors.  The Starting Gate's own unless given, e.g. the
+        # virtual device of a simulated track.
+        if device is None:
+            from deviceio import DeviceIO #pylint: disable=import-outside-toplevel
+            device = DeviceIO()
+        self.device = device
+
+        # A single session reuses its keep-alive connection to the coordinator, avoiding
+        # a new TCP handshake for every request.
+        self.session = self.__new_session()
+        self.address = None
+
+        # Open from registration until deregistration, at channel_url
+        self.channel = None
+        self.channel_url = None
+
+        # Session token the coordinator issued at registration.  It identifies this track,
+        # so tracks sharing an IP address don't collide.
+        self.session_token = None
+
+        # Number the coordinator assigned to the race in progress
+        self.race = None
+
+        # Latest lane occupancy reported by each track in the circuit, by track name
+        self.remote_lanes = {}
+
+        # Latest local lane occupancy not yet sent, handed from the lane sensor callback
+        # thread to the lanes thread, which does the sending
+        self.lanes_pending = None
+        self.lanes_event = threading.Event()
+        self.lanes_event.clear()
+        self.lanes_thread = threading.Thread(target=self.__send_lanes, daemon=True)
+        self.lanes_thread.start()
+
+        # Set by the key handlers, or by completion of the request, to wake the caller
+        self.wake_event = threading.Event()
+        self.wake_event.clear()
+
+        self.clock = ServerClock()
+
+        # State shared with the health monitor thread
+        self.in_menu = False
+        self.deregister_pending = False
+        self.probe_event = threading.Event()
+        self.probe_event.clear()
+        self.deregistered_event = threading.Event()
+        self.deregistered_event.set()
+        self.monitor = threading.Thread(target=self.__monitor, daemon=True)
+
+    def menu_entered(self):
+        """
+        Called each time the Starting Gate displays the top level menu.  Deregisters from
+        the coordinator in the background and probes it periodically until menu_exited().
+        """
+        self.deregistered_event.clear()
+        self.deregister_pending = True
+        self.in_menu = True
+        self.probe_event.set()
+        if not self.monitor.is_alive():
+            self.monitor.start()
+
+    def menu_exited(self):
+        """
+        Called when the user leaves the top level menu.  Stops the periodic health probes.
+        """
+        self.in_menu = False
 
     def register(self):
         """
@@ -71,89 +268,504 @@ class Coordinator:
         See Coordinator/drr_server.js for detail of the json request/response format
         """
 
-        # Install key handler to abort action
-        self.device.push_key_handlers(key_pressed, key_pressed, key_pressed,
-                                 deviceio.default_joystick_handler)
-
-        headers = {'Content-Type': 'application/json'}
-
         registration = {}
         registration['circuit'] = self.config.circuit
         registration['trackName'] = self.config.track_name
         registration['numLanes'] = self.config.num_lanes
         registration['carIcons'] = self.config.car_icons
 
-        json_string = json.dumps(registration).encode('utf-8')
-
-        print("register: url=", self.register_url, "  data=", json_string)
-        response = requests.post(self.register_url, data=json_string, headers=headers)
-        print("response=", response)
-
-        reply = response.json()
+        print("register: data=", json.dumps(registration))
+        reply = self.__cancellable(self.__channel_registration, registration)
 
         print("reply=", reply)
 
         remote = reply['remoteRegistrations'][0]
 
         self.config.ip_address = reply['ip']
+        self.session_token = reply.get('session')
+        self.channel.session = self.session_token
         self.config.remote_track_name = remote['trackName']
         self.config.remote_num_lanes = remote['numLanes']
         self.config.remote_car_icons = remote['carIcons']
 
-        self.device.pop_key_handlers()
+        # Let the remote track show which of our lanes already have cars
+        self.lanes_changed(self.device.lanes_occupied())
 
-    def deregister(self):
+    def deregister(self, session=None):
         """
         Deregister from the race coordinator, thus leaving the circuit
         Returns True if deregistration request succeeded, False otherwise.
+
+        A track registered over the channel deregisters over it and closes it. Otherwise
+        deregistration is POSTed with the session token, if any, which also clears a
+        registration left behind by an earlier run of the Starting Gate.
         """
+        channel, self.channel = self.channel, None
+        if channel is not None and channel.is_open():
+            try:
+                print("deregister: over channel")
+                channel.request('deregister', timeout=DEREGISTER_TIMEOUT[1])
+                self.session_token = None
+                return True
+            except ChannelError as exc:
+                print("Exception during deregister", exc)
+            finally:
+                channel.close()
+
         try:
             print("deregister: ")
-            response = requests.post(self.deregister_url, data="")
+            headers = {SESSION_HEADER: self.session_token} if self.session_token else {}
+            response = self.__retry("POST", "/deregister", DEREGISTER_TIMEOUT, data="",
+                                    session=session, headers=headers)
             print("response=", response)
+            self.session_token = None
             return True
-        except:
-            print("Exception during deregister")
+        except requests.RequestException as exc:
+            print("Exception during deregister", exc)
             return False
 
+    def lanes_changed(self, occupied):
+        """
+        LaneMonitor listener that streams the local lane occupancy bitmask to the other
+        tracks in the circuit.  Called on the sensor callback thread, so it only hands the
+        bitmask to the lanes thread rather than sending it.
+        """
+        self.lanes_pending = occupied
+        self.lanes_event.set()
+
+    def lane_finished(self, lane, lane_time):
+        """
+        Stream the elapsed time of the lane with the given index to the other tracks in
+        the circuit as soon as it finishes
+        """
+        self.__notify('finish', {'laneNumber': lane + 1, 'laneTime': lane_time})
+
     def start_race(self):
         """
         Send message to coordinator that the local track is ready for the start of the
-        race.  The GET request only returns when all tracks in the circuit are ready.
+        race.  The coordinator replies once it has formed a heat with enough ready tracks,
+        or its start deadline has passed.  The remote track in config is updated to the
+        first opponent in the heat.
+
+        Returns the time, in the time.monotonic_ns() timebase, at which to release the
+        starting gate, or None to release it immediately if the coordinator did not
+        provide a start time or its clock could not be sampled.
         """
 
-        # Install key handler to abort action
-        self.device.push_key_handlers(key_pressed, key_pressed, key_pressed,
-                                 deviceio.default_joystick_handler)
+        self.config.remote_finish_times = [None, None, None, None]
 
-        print("start_race: GET ", self.start_url)
-        response = requests.get(self.start_url)
-        print("response=", response)
-        self.device.pop_key_handlers()
+        print("start_race: start")
+        reply = self.__cancellable(self.__start_request)
+        print("reply=", reply)
+
+        try:
+            self.race = reply.get('race')
+            self.__set_opponent(reply.get('opponents'))
+            start_ms = reply['startTime']
+        except (KeyError, AttributeError, TypeError):
+            print("start_race: no start time in response, starting immediately")
+            return None
+
+        if not self.clock.is_synchronized():
+            print("start_race: coordinator clock not synchronized, starting immediately")
+            return None
 
-    def results(self, local_results):
+        return self.clock.to_local_ns(start_ms)
+
+    def results(self, local_results, released):
         """
         Send local race results to the race coordintor and collect circuit-wide results
         in the response.
-        """
-        self.device.push_key_handlers(key_pressed, key_pressed, key_pressed,
-                                 deviceio.default_joystick_handler)
 
-        headers = {'Content-Type': 'application/json'}
+        released is the measured release instant of the local gate in the
+        time.monotonic_ns() timebase. It is reported on the coordinator's clock so the
+        coordinator can measure how far each track's start was from the scheduled start.
 
-        json_string = json.dumps(local_results).encode('utf-8')
+        Returns the circuit-wide standings, ranked by each lane's elapsed time from its
+        own track's release, which removes the start skew between tracks.
+        """
+        results = {}
+        results['results'] = local_results
+        results['race'] = self.race
+        results['releaseTime'] = self.clock.to_server_ms(released) \
+            if self.clock.is_synchronized() else None
 
-        print("register: ", json_string)
-        response = requests.post(self.results_url, data=json_string, headers=headers)
-        print("response=", response)
+        print("results: ", json.dumps(results))
+        reply = self.__cancellable(self.__channel_request, 'results', results, RESULTS_TIMEOUT)
 
-        print("response.text=", response.text)
-        result_string = response.text
-        self.device.pop_key_handlers()
-        return result_string
+        print("reply=", reply)
+        print("raw standings: ", reply['rawStandings'])
+        if reply.get('missing'):
+            print("no results from: ", reply['missing'])
+        return reply['standings']
 
 # PRIVATE:
 
+    def __monitor(self):
+        """
+        Health monitor thread.  Performs pending deregistrations and, while the menu is
+        displayed, periodic health probes, updating config.allow_multi_track with whether
+        the coordinator responded.
+        """
+        session = self.__new_session()
+        while True:
+            self.probe_event.wait(PROBE_INTERVAL * random.uniform(0.5, 1.5)
+                                  if self.in_menu else None)
+            self.probe_event.clear()
+
+            if self.deregister_pending:
+                self.deregister_pending = False
+                reachable = self.deregister(session)
+                self.deregistered_event.set()
+            elif self.in_menu:
+                reachable = self.__probe(session)
+            else:
+                continue
+
+            if reachable != self.config.allow_multi_track:
+                print("Coordinator: allow_multi_track =", reachable)
+                self.config.allow_multi_track = reachable
+
+    def __probe(self, session):
+        """
+        Returns True if the coordinator responds to GET /health
+        """
+        try:
+            self.__request("GET", "/health", PROBE_TIMEOUT, session=session)
+            return True
+        except requests.RequestException:
+            return False
+
+    def __synchronize_clock(self):
+        """
+        Sample the coordinator's clock with time request round trips over the channel.
+        Failures leave the clock unsynchronized rather than delaying the race.
+        """
+        self.clock.reset()
+        try:
+            for _ in range(CLOCK_PROBES):
+                sent = time.monotonic_ns()
+                reply = self.__channel_request('time', timeout=PROBE_TIMEOUT[1])
+                received = time.monotonic_ns()
+                self.clock.add_sample(reply['time'], sent, received)
+        except (ChannelError, KeyError, TypeError) as exc:
+            print("Unable to sample coordinator clock", exc)
+
+    def __start_request(self):
+        """
+        Wait for a heat to be formed, then synchronize with the coordinator's clock.
+        Sampling after the wait keeps drift during it out of the estimate; the scheduled
+        start leaves ample time for the round trips.
+        """
+        reply = self.__channel_request('start')
+        self.__synchronize_clock()
+        return reply
+
+    def __channel_registration(self, registration):
+        """
+        Open the channel and register over it once any background deregistration has
+        completed, so the coordinator can't process them out of order.
+
+        Failures to connect, and the coordinator asking the track to retry later, are
+        retried with jittered exponential backoff until the user cancels.
+        """
+        cancelled = self.wake_event
+        self.deregistered_event.wait()
+        for attempt in range(REGISTER_RETRIES + 1):
+            try:
+                return self.__register_over_channel(registration, cancelled)
+            except ChannelError as exc:
+                retriable = isinstance(exc, ChannelClosed) or exc.code == SERVICE_UNAVAILABLE
+                if attempt == REGISTER_RETRIES or not retriable:
+                    raise
+                delay = backoff_delay(attempt, exc.retry_after)
+                print("register failed: {}. Retrying in {:.2f}s".format(exc, delay))
+                if cancelled.wait(delay):
+                    raise CoordinatorCancelled() from exc
+        return None # Dead code, but makes pylint happy
+
+    def __register_over_channel(self, registration, cancelled):
+        """
+        Open a new channel and send the registration over it.
+
+        The channel only becomes self.channel once registration succeeds.  If the user
+        cancelled in the meantime, the request was abandoned, so the registration is
+        withdrawn over the channel and the channel closed instead.
+        """
+        self.remote_lanes = {}
+        self.config.remote_lanes_occupied = 0
+        self.config.remote_finish_times = [None, None, None, None]
+        # The circuit lets a coordinator running several workers route the channel to the
+        # worker that owns the circuit
+        query = urllib.parse.urlencode({'circuit': registration['circuit']})
+        self.channel_url = self.__url("{}?{}".format(CHANNEL_PATH, query), "ws")
+        channel = Channel(self.channel_url)
+        channel.listen('events', self.__remote_events)
+        try:
+            channel.open(CONNECT_TIMEOUT)
+        except (websocket.WebSocketException, OSError) as exc:
+            self.address = None
+            raise ChannelClosed("unable to open channel: {}".format(exc)) from exc
+
+        try:
+            if cancelled.is_set():
+                raise CoordinatorCancelled()
+            reply = channel.request('register', registration)
+        except (ChannelError, CoordinatorCancelled):
+            channel.close()
+            raise
+
+        if cancelled.is_set():
+            print("register: cancelled, withdrawing the registration")
+            channel.session = reply.get('session')
+            try:
+                channel.request('deregister', timeout=DEREGISTER_TIMEOUT[1])
+            except ChannelError as exc:
+                print("Exception during deregister", exc)
+            finally:
+                channel.close()
+            raise CoordinatorCancelled()
+
+        self.channel = channel
+        return reply
+
+    def __send_lanes(self):
+        """
+        Lanes thread.  Sends the latest lane occupancy each time it changes.  Changes made
+        while a send is in progress are coalesced, as only the latest bitmask matters.
+        """
+        while True:
+            self.lanes_event.wait()
+            self.lanes_event.clear()
+            self.__notify('lanes', {'occupied': self.lanes_pending})
+
+    def __notify(self, message_type, body):
+        """
+        Send a live race event over the channel, if open.  Events are best effort, so
+        failures are only logged; the channel's reader detects a lost coordinator.
+        """
+        channel = self.channel
+        if channel is None or not channel.is_open():
+            return
+        try:
+            channel.notify(message_type, body)
+        except ChannelError as exc:
+            print("Unable to send", message_type, "event", exc)
+
+    def __remote_events(self, events):
+        """
+        Channel listener for the batches of events the coordinator forwards from the other
+        tracks in the circuit.  Each config attribute is only ever replaced, never updated
+        in place, so the display thread reads a consistent value without locking.
+        """
+        for event in events:
+            body = event.get('body') or {}
+            is_remote = event.get('trackName') == self.config.remote_track_name
+            if event.get('type') == 'lanes':
+                self.remote_lanes[event.get('trackName')] = body.get('occupied', 0)
+                if is_remote:
+                    self.config.remote_lanes_occupied = body.get('occupied', 0)
+            elif event.get('type') == 'finish' and is_remote:
+                finish_times = list(self.config.remote_finish_times)
+                lane_number = body.get('laneNumber')
+                if not isinstance(lane_number, int) or isinstance(lane_number, bool) or \
+                        not 1 <= lane_number <= len(finish_times) or 'laneTime' not in body:
+                    print("Ignoring malformed finish event", event)
+                    continue
+                finish_times[lane_number - 1] = body['laneTime']
+                self.config.remote_finish_times = finish_times
+
+    def __set_opponent(self, opponents):
+        """
+        Make the first opponent of the heat the remote track shown on the display.  A heat
+        without opponents, or a coordinator that doesn't report them, leaves it unchanged.
+        """
+        if not opponents:
+            return
+        remote = opponents[0]
+        self.config.remote_track_name = remote['trackName']
+        self.config.remote_num_lanes = remote['numLanes']
+        self.config.remote_car_icons = remote['carIcons']
+        self.config.remote_lanes_occupied = self.remote_lanes.get(remote['trackName'], 0)
+
+    def __channel_request(self, message_type, body=None, timeout=None):
+        """
+        Send a request over the channel opened at registration and return the reply body
+        """
+        if self.channel is None:
+            raise ChannelError("not registered with the coordinator")
+        cancelled = self.wake_event
+        try:
+            return self.channel.request(message_type, body, timeout)
+        except ChannelClosed:
+            # A request that timed out on a channel still open met a slow coordinator,
+            # not a lost one, so there is nothing to resume
+            if message_type not in RESUMABLE_REQUESTS or self.channel.is_open():
+                raise
+            resumed = self.__resume(cancelled)
+            if resumed is None:
+                raise
+        if message_type == 'start' and resumed.get('race') is not None:
+            # The coordinator drew the track into a heat while the reply was lost.  Ask for
+            # that race, as a start request without it abandons the race.
+            body = {'race': resumed['race']}
+        if cancelled.is_set():
+            raise CoordinatorCancelled()
+        return self.channel.request(message_type, body, timeout)
+
+    def __resume(self, cancelled):
+        """
+        Open a new channel after losing the last one and resume the registered session on
+        it, retrying with jittered exponential backoff while the coordinator restarts.
+
+        Returns the resume reply, or None if the coordinator no longer knows the session,
+        doesn't come back, or the user cancels.
+        """
+        if self.session_token is None or self.channel_url is None:
+            return None
+        for attempt in range(REGISTER_RETRIES + 1):
+            delay = backoff_delay(attempt)
+            print("Channel lost. Resuming session in {:.2f}s".format(delay))
+            if cancelled.wait(delay):
+                return None
+            channel = Channel(self.channel_url)
+            channel.session = self.session_token
+            channel.listen('events', self.__remote_events)
+            try:
+                channel.open(CONNECT_TIMEOUT)
+                reply = channel.request('resume', timeout=RESUME_TIMEOUT)
+            except (websocket.WebSocketException, OSError, ChannelError) as exc:
+                channel.close()
+                if isinstance(exc, ChannelError) and exc.code == SESSION_UNKNOWN:
+                    print("Coordinator no longer knows the session", exc)
+                    return None
+                print("Unable to resume session", exc)
+                continue
+            if cancelled.is_set():
+                # The menu's background deregistration withdraws the session
+                channel.close()
+                return None
+            previous, self.channel = self.channel, channel
+            if previous is not None:
+                previous.close()
+            return reply
+        return None
+
+    @staticmethod
+    def __new_session():
+        """
+        Create the requests session used for all coordinator requests
+        """
+        session = requests.Session()
+        session.headers.update({'Content-Type': 'application/json'})
+        return session
+
+    def __cancel(self):
+        """
+        Key handler used while waiting on the coordinator
+        """
+        print("Coordinator: key pressed, cancelling request")
+        self.wake_event.set()
+
+    def __joystick_cancel(self, btn): #pylint: disable=unused-argument
+        self.__cancel()
+
+    def __cancellable(self, func, *args, **kwargs):
+        """
+        Call func on a worker thread and wait for it to complete, or for the user to
+        cancel by pressing a key.
+
+        Returns the result of func, or raises any exception it raised.  Raises
+        CoordinatorCancelled if the user pressed a key first.
+        """
+        outcome = {}
+        wake_event = self.wake_event
+        wake_event.clear()
+
+        def worker():
+            try:
+                outcome['result'] = func(*args, **kwargs)
+            except Exception as exc: #pylint: disable=broad-except
+                outcome['exception'] = exc
+            wake_event.set()
+
+        self.device.push_key_handlers(self.__cancel, self.__cancel, self.__cancel,
+                                      self.__joystick_cancel)
+        try:
+            threading.Thread(target=worker, daemon=True).start()
+            wake_event.wait()
+        finally:
+            self.device.pop_key_handlers()
+
+        if 'result' in outcome:
+            return outcome['result']
+        if 'exception' in outcome:
+            raise outcome['exception']
+
+        # Leave the abandoned request to finish on its own. Start a fresh wake event so its
+        # completion can't wake a later request.
+        self.wake_event = threading.Event()
+        raise CoordinatorCancelled()
+
+    def __url(self, path, scheme="http"):
+        """
+        Build the URL for path on the coordinator.
+
+        The coordinator's address is resolved once and reused, so requests don't each
+        pay for a DNS lookup.  It is resolved again after a connection failure in case
+        the coordinator moved.
+        """
+        if self.address is None:
+            try:
+                info = socket.getaddrinfo(self.config.coord_host, self.config.coord_port,
+                                          type=socket.SOCK_STREAM)
+                address = info[0][4][0]
+                self.address = "[{}]".format(address) if ':' in address else address
+            except OSError as exc:
+                print("Unable to resolve ", self.config.coord_host, exc)
+                return "{}://{}:{}{}".format(scheme, self.config.coord_host,
+                                             self.config.coord_port, path)
+        return "{}://{}:{}{}".format(scheme, self.address, self.config.coord_port, path)
+
+    def __request(self, method, path, timeout, session=None, **kwargs):
+        """
+        Issue a single request to the coordinator on the pooled session, or on the given
+        session for requests made from the health monitor thread.
+        """
+        if session is None:
+            session = self.session
+        try:
+            response = session.request(method, self.__url(path), timeout=timeout, **kwargs)
+        except requests.ConnectionError:
+            self.address = None
+            raise
+        response.raise_for_status()
+        return response
+
+    def __retry(self, method, path, timeout, session=None, **kwargs):
+        """
+        Issue an idempotent request, retrying connection failures, timeouts and server
+        errors with jittered exponential backoff.
+        """
+        for attempt in range(RETRIES + 1):
+            try:
+                return self.__request(method, path, timeout, session, **kwargs)
+            except (requests.ConnectionError, requests.Timeout, requests.HTTPError) as exc:
+                retriable = not isinstance(exc, requests.HTTPError) or \
+                    exc.response.status_code >= 500
+                if attempt == RETRIES or not retriable:
+                    raise
+                retry_after = None
+                if isinstance(exc, requests.HTTPError):
+                    try:
+                        retry_after = float(exc.response.headers.get('Retry-After', ''))
+                    except ValueError:
+                        pass
+                delay = backoff_delay(attempt, retry_after)
+                print("{} {} failed: {}. Retrying in {:.2f}s".format(method, path, exc, delay))
+                time.sleep(delay)
+        return None # Dead code, but makes pylint happy
+
 def main():
     """
     At some point I should write legitimate unit tests.  But for now, I just exercise
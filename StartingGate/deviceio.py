@@ -13,7 +13,9 @@ Copyright (c) Thomas Quiggle. All rights reserved.
 Licensed under the MIT license. See LICENSE file in the project root for full license information.
 """
 
+import threading
 import time
+import pigpio
 from gpiozero import Device, DigitalInputDevice, Button, Servo
 from gpiozero.pins.pigpio import PiGPIOFactory
 
@@ -45,29 +47,232 @@ LANE4 = DigitalInputDevice(pin="GPIO4",  bounce_time=0.200)        # Pin 07
 
 SERVO = Servo("GPIO12")                                            # Pin 32
 
+LANES = [LANE1, LANE2, LANE3, LANE4]
+
+class LaneMonitor:
+    """
+    The LaneMonitor tracks which starting gate lanes have cars present without polling
+    the IR sensors.
+
+    The gpiozero when_activated/when_deactivated callbacks for each lane sensor update
+    a bitmask of occupied lanes, bit 0 for LANE1 through bit 3 for LANE4. After every
+    change the monitor compares the bitmask against the lanes in use for the current
+    race session and sets or clears two events:
+
+        ready_event:    set when every configured lane has a car present
+        car_event:      set when any configured lane has a car present, i.e. the
+                        lanes are no longer all empty
+
+    Waiters block on an event and are woken by the sensor edge that completes the
+    condition, or by abort() when the user presses a key to leave the race.
+
+    A listener may be set to be told of each change to the bitmask, e.g. to stream it to
+    other tracks in a multi-track race.
+
+    The bitmask doubles as the sensor-state cache shared by the display and the race
+    loop. It is only replaced with a single integer assignment, so readers sample it
+    through lanes_occupied() without taking the lock. Resynchronizing from the hardware
+    fetches all lane pins with one pigpio bank read rather than one read per lane.
+
+    The monitor also records when each car leaves the starting gate, so lane times can
+    run from each car's actual departure rather than from the servo command. pigpiod
+    timestamps each falling edge with its microsecond tick when the level change is
+    detected, independent of callback delivery latency. The glitch filter that gpiozero
+    uses to implement bounce_time delays each reported edge by exactly the filter
+    period, so that is subtracted from the tick.
+    """
+
+# PUBLIC:
+
+    def configure(self, num_lanes):
+        """
+        Set the number of lanes in use for a new race session and clear any prior abort.
+        """
+        with self.lock:
+            self.num_lanes = num_lanes
+            self.aborted = False
+            self.__read_sensors()
+            self.__update_events()
+
+    def set_listener(self, listener):
+        """
+        Call listener(mask) with the new bitmask after each change, on the sensor callback
+        thread, so the listener must not block. Pass None to remove the listener.
+        """
+        self.listener = listener
+
+    def abort(self):
+        """
+        Wake all waiters. Events remain set until the next call to configure().
+        """
+        with self.lock:
+            self.aborted = True
+            self.__update_events()
+
+    def wait_ready(self):
+        """
+        Block until all configured lanes have cars present or the monitor is aborted.
+        """
+        self.ready_event.wait()
+
+    def wait_for_car(self):
+        """
+        Block until at least one car is placed in a configured lane or the monitor
+        is aborted.
+        """
+        self.car_event.wait()
+
+    def arm_departures(self):
+        """
+        Forget previously recorded departures and sample the pigpiod tick clock. Call
+        immediately before releasing the starting gate.
+        """
+        connection = Device.pin_factory.connection
+        with self.lock:
+            self.departure_ticks = [None] * len(self.lanes)
+            sent = time.monotonic_ns()
+            tick = connection.get_current_tick()
+            received = time.monotonic_ns()
+            self.tick_sample = (tick, (sent + received) // 2)
+
+    def departure_ns(self, index):
+        """
+        Returns the time.monotonic_ns() time at which the car left the lane with the
+        given index, or None if no departure was detected since arm_departures().
+        """
+        with self.lock:
+            tick = self.departure_ticks[index]
+            if tick is None or self.tick_sample is None:
+                return None
+            sample_tick, sample_ns = self.tick_sample
+        steady_us = int((self.lanes[index].pin.bounce or 0) * 1000000)
+        elapsed_us = pigpio.tickDiff(sample_tick, tick) - steady_us
+        return sample_ns + elapsed_us * 1000
+
+# PRIVATE:
+
+    def __init__(self, lanes):
+        self.lanes = lanes
+        self.num_lanes = len(lanes)
+        self.mask = 0
+        self.aborted = False
+        self.lock = threading.Lock()
+        self.ready_event = threading.Event()
+        self.car_event = threading.Event()
+
+        self.departure_ticks = [None] * len(lanes)
+        self.tick_sample = None
+        self.listener = None
+
+        connection = Device.pin_factory.connection
+        for lane in lanes:
+            lane.when_activated = self.__lane_activated
+            lane.when_deactivated = self.__lane_deactivated
+            connection.callback(lane.pin.number, pigpio.FALLING_EDGE, self.__lane_departed)
+
+        with self.lock:
+            self.__read_sensors()
+            self.__update_events()
+
+    def __read_sensors(self):
+        """
+        Rebuild the bitmask from a single read of GPIO bank 1. Called with self.lock held.
+        """
+        bank = Device.pin_factory.connection.read_bank_1()
+        mask = 0
+        for index, lane in enumerate(self.lanes):
+            if bank & (1 << lane.pin.number):
+                mask |= 1 << index
+        self.mask = mask
+
+    def __update_events(self):
+        """
+        Set or clear the events based on the lanes in use. Called with self.lock held.
+        """
+        if self.aborted:
+            self.ready_event.set()
+            self.car_event.set()
+            return
+
+        in_use = (1 << self.num_lanes) - 1
+        occupied = self.mask & in_use
+
+        if occupied == in_use:
+            self.ready_event.set()
+        else:
+            self.ready_event.clear()
+
+        if occupied:
+            self.car_event.set()
+        else:
+            self.car_event.clear()
+
+    def __lane_activated(self, lane):
+        with self.lock:
+            self.mask |= 1 << self.lanes.index(lane)
+            self.__update_events()
+        self.__notify()
+
+    def __lane_deactivated(self, lane):
+        with self.lock:
+            self.mask &= ~(1 << self.lanes.index(lane))
+            self.__update_events()
+        self.__notify()
+
+    def __notify(self):
+        """
+        Pass the current bitmask to the listener, if any. Called without self.lock held,
+        as the listener may take locks of its own.
+        """
+        listener = self.listener
+        if listener is not None:
+            listener(self.mask)
+
+    def __lane_departed(self, gpio, level, tick): #pylint: disable=unused-argument
+        """
+        pigpio callback for a falling edge on a lane sensor, i.e. a car leaving the lane.
+        Only the first departure after arm_departures() is recorded.
+        """
+        for index, lane in enumerate(self.lanes):
+            if lane.pin.number == gpio:
+                with self.lock:
+                    if self.departure_ticks[index] is None:
+                        self.departure_ticks[index] = tick
+                return
+
+LANE_MONITOR = LaneMonitor(LANES)
+
+def lanes_occupied():
+    """
+    Returns a snapshot of the lane occupancy bitmask, bit 0 for LANE1 through bit 3 for
+    LANE4. The LaneMonitor keeps the bitmask current from sensor edge callbacks, so any
+    number of readers can sample it without a round trip to pigpiod.
+    """
+    return LANE_MONITOR.mask
+
 def car_1_present():
     """
     Returns True if the LANE1 sensor detects a car in the lane 1 starting gate
     """
-    return LANE1.value
+    return bool(lanes_occupied() & (1 << 0))
 
 def car_2_present():
     """
     Returns True if the LANE2 sensor detects a car in the lane 2 starting gate
     """
-    return LANE2.value
+    return bool(lanes_occupied() & (1 << 1))
 
 def car_3_present():
     """
     Returns True if the LANE3 sensor detects a car in the lane 3 starting gate
     """
-    return LANE3.value
+    return bool(lanes_occupied() & (1 << 2))
 
 def car_4_present():
     """
     Returns True if the LANE4 sensor detects a car in the lane 4 starting gate
     """
-    return LANE4.value
+    return bool(lanes_occupied() & (1 << 3))
 
 def default_key_1_handler():
     """
@@ -123,6 +328,12 @@ class DeviceIO:
         print("DeviceIO.pop_key_handlers, self=", self, " instance=", DeviceIO.instance)
         DeviceIO.instance.pop_key_handlers()
 
+    def lanes_occupied(self): #pylint: disable=no-self-use
+        """
+        Returns the bitmask of lanes with cars in the starting gate.  See lanes_occupied().
+        """
+        return lanes_occupied()
+
 # PRIVATE:
 
     instance = None
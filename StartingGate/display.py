@@ -32,7 +32,7 @@ import pyray
 from pyray import WHITE, RAYWHITE, GRAY, BLACK, ORANGE
 
 from config import CAR1, CAR2, CAR3, CAR4, Config, NOT_FINISHED #pylint: disable=unused-import
-from deviceio import car_1_present, car_2_present
+from deviceio import lanes_occupied
 from menu import Menu
 
 @enum.unique
@@ -107,11 +107,11 @@ class Display(threading.Thread):
         """
         In this state, the display places an overlay on the track saying "Waiting for Cars"
 
-        The car_#_present() functions from the DeviceIO module read the
-        appropriate IR sensor to determine if a car is present in the
-        indicated lane. In the WAIT_LOCAL_READY state, the Display loop
-        checks for cars via these callbacks and updates the display to
-        show car icons at the start of lanes that have cars present.
+        The lanes_occupied() function from the DeviceIO module returns the
+        cached state of the IR sensors that the race loop also waits on.
+        In the WAIT_LOCAL_READY state, the Display loop samples it once per
+        frame and updates the display to show car icons at the start of
+        lanes that have cars present.
         """
         self.__reset_car_positions()
         self.state = RaceState.WAIT_LOCAL_READY
@@ -122,6 +122,8 @@ class Display(threading.Thread):
 
            "Waiting for <other track name>"
 
+        In this and the WAIT_LOCAL_READY state, remote lanes show the car icon once the
+        remote track reports a car present, from config.remote_lanes_occupied.
         """
         self.state = RaceState.WAIT_REMOTE_READY
 
@@ -141,7 +143,9 @@ class Display(threading.Thread):
 
     def race_started(self):
         """
-        The race is running. Display cars moving randomly down the tracks.
+        The race is running. Display cars moving randomly down the tracks.  Remote cars
+        stay at the gate until the remote track reports they left and jump to the finish
+        line as soon as it reports their lane finished.
         """
         self.start = time.monotonic()
         self.state = RaceState.RACE_STARTED
@@ -506,11 +510,22 @@ class Display(threading.Thread):
         self.remote_icons_loaded = True
         self.registration_event.set()
 
+    def __remote_car_textures(self):
+        """
+        Returns the textures for the remote cars: the car icon for lanes the remote track
+        reports occupied, otherwise a question mark
+        """
+        occupied = self.config.remote_lanes_occupied
+        texture3 = self.remote_textures[CAR1] if occupied & (1 << CAR1) else self.question_texture
+        texture4 = self.remote_textures[CAR2] if occupied & (1 << CAR2) else self.question_texture
+        return texture3, texture4
+
     def __wait_local_ready(self):
-        texture1 = self.local_textures[0] if car_1_present() else self.question_texture
-        texture2 = self.local_textures[1] if car_2_present() else self.question_texture
+        occupied = lanes_occupied()
+        texture1 = self.local_textures[CAR1] if occupied & (1 << CAR1) else self.question_texture
+        texture2 = self.local_textures[CAR2] if occupied & (1 << CAR2) else self.question_texture
         if self.config.multi_track:
-            self.__draw_cars(texture1, texture2, self.question_texture, self.question_texture)
+            self.__draw_cars(texture1, texture2, *self.__remote_car_textures())
         else:
             self.__draw_cars(texture1, texture2, self.question_texture, self.question_texture)
         self.__text_message("Waiting for: Cars")
@@ -518,7 +533,7 @@ class Display(threading.Thread):
     def __wait_remote_ready(self):
         wait_msg = "Waiting for: " + self.config.remote_track_name
         self.__draw_cars(self.local_textures[CAR1], self.local_textures[CAR2],
-                         self.question_texture, self.question_texture)
+                         *self.__remote_car_textures())
         self.__text_message(wait_msg)
 
     def __countdown(self):
@@ -546,8 +561,14 @@ class Display(threading.Thread):
         for car in range(self.config.num_lanes):
             if random.random() < self.progress_threshold and self.local_y[car] < Display._MAX_Y:
                 self.local_y[car] += 1
+        remote_occupied = self.config.remote_lanes_occupied
+        remote_finish_times = self.config.remote_finish_times
         for car in range(self.config.remote_num_lanes):
-            if random.random() < self.progress_threshold and self.remote_y[car] < Display._MAX_Y:
+            if remote_finish_times[car] is not None:
+                self.remote_y[car] = Display._MAX_Y
+            elif remote_occupied & (1 << car):
+                continue    # Still in the remote starting gate
+            elif random.random() < self.progress_threshold and self.remote_y[car] < Display._MAX_Y:
                 self.remote_y[car] += 1
 
     def __race_finished(self):
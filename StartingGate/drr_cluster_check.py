@@ -0,0 +1,468 @@
+#! /usr/bin/python3
+
+"""
+Diecast Remote Raceway - Coordinator Cluster Check
+
+Runs the Race Coordination Cluster (drr_cluster.js) on localhost, with its workers and
+membership store (drr_store.js) in a scratch directory, and races real Coordinator clients
+(coordinator.py) through its router to check that:
+
+   proxy      /health and /time reach a worker, and /skew and /metrics are gathered from
+              every worker, labelled by worker
+   upgrade    Two circuits, placed on different workers, register, start and post results
+              over their channels, which the router forwards to the owning worker
+   failover   The worker owning a circuit is killed while a track waits on its start, and
+              again while both tracks race.  Each time it is restarted, recovers the circuit
+              from its journal, and the tracks resume their sessions and finish the race.
+
+Each check prints PASS or FAIL, and the exit status is the number that failed.  The
+cluster's output is written to cluster.log in the scratch directory, which is kept with
+--keep, or on failure.
+
+The cluster needs Node.js and the coordinator's modules, installed in the Coordinator
+directory:
+
+   % cd ../Coordinator
+   % npm install express body-parser connect-timeout ws node-cron log-timestamp \\
+         async-barrier better-sqlite3
+
+Usage:
+
+   % python3 drr_cluster_check.py
+   % python3 drr_cluster_check.py --workers 3 --keep
+
+Author: Tom Quiggle
+tquiggle@gmail.com
+https://github.com/tquiggle/Die-Cast-Remote-Raceway
+
+Copyright (c) Thomas Quiggle. All rights reserved.
+
+Licensed under the MIT license. See LICENSE file in the project root for full license information.
+
+"""
+
+import argparse
+import contextlib
+import hashlib
+import os
+import shutil
+import signal
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+from config import Config
+from coordinator import Coordinator
+from drr_load import VirtualDevice, in_parallel
+
+COORDINATOR_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Coordinator')
+
+# Modules drr_cluster.js and drr_server.js require
+NODE_MODULES = ('express', 'body-parser', 'connect-timeout', 'ws', 'node-cron',
+                'log-timestamp', 'async-barrier', 'better-sqlite3')
+
+# Must match virtualNodes in drr_cluster.js
+VIRTUAL_NODES = 64
+
+# Seconds allowed for the cluster to start, and a killed worker to be restarted
+STARTUP_TIMEOUT = 30
+
+# Seconds allowed for a track's request, including resuming after a worker is killed
+REQUEST_TIMEOUT = 60
+
+# Coordinator settings for the run, short enough that a lost track fails the check quickly
+CLUSTER_SETTINGS = {
+    'DRR_START_GRACE_MS': '15000',
+    'DRR_RESULTS_GRACE_MS': '15000',
+    'DRR_RESUME_GRACE_MS': '30000',
+}
+
+class CheckFailed(Exception):
+    """
+    A check found the cluster misbehaving
+    """
+
+class Cluster:
+    """
+    drr_cluster.js running as a child process, with its store and journals in directory
+    """
+
+# PUBLIC:
+
+    def start(self):
+        """
+        Start the router and its workers, and wait until every worker is routable
+        """
+        env = dict(os.environ, DRR_PORT=str(self.port), DRR_WORKERS=str(self.workers),
+                   DRR_WORKER_BASE_PORT=str(self.worker_base_port), DRR_STORE=self.store,
+                   DRR_STATE_DIR=self.directory, **CLUSTER_SETTINGS)
+        self.process = subprocess.Popen( #pylint: disable=consider-using-with
+            ['node', 'drr_cluster.js'], cwd=COORDINATOR_DIR, env=env,
+            stdout=self.log, stderr=subprocess.STDOUT)
+        self.wait_ready()
+
+    def stop(self):
+        """
+        Stop the router, which stops its workers
+        """
+        if self.process is not None and self.process.poll() is None:
+            self.process.send_signal(signal.SIGTERM)
+            try:
+                self.process.wait(10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        self.log.close()
+
+    def wait_ready(self, worker=None):
+        """
+        Wait until every worker, or just the given worker, answers /health
+        """
+        workers = range(self.workers) if worker is None else [worker]
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        for number in workers:
+            while not self.__healthy(self.worker_base_port + number):
+                if self.process.poll() is not None:
+                    raise CheckFailed("drr_cluster.js exited ({})".format(self.process.returncode))
+                if time.monotonic() > deadline:
+                    raise CheckFailed("worker {} did not start".format(number))
+                time.sleep(0.2)
+
+    def get(self, path):
+        """
+        GET path through the router
+        """
+        response = requests.get(self.url + path, timeout=10)
+        response.raise_for_status()
+        return response
+
+    def owner(self, circuit):
+        """
+        The worker owning circuit, as recorded in the membership store
+        """
+        with sqlite3.connect(self.store) as db:
+            row = db.execute('SELECT worker FROM circuits WHERE circuit = ?', (circuit,)).fetchone()
+        return None if row is None else row[0]
+
+    def kill_worker(self, worker):
+        """
+        SIGKILL the worker process, as a crash would end it
+        """
+        pid = self.__worker_pid(worker)
+        if pid is None:
+            raise CheckFailed("no process for worker {}".format(worker))
+        os.kill(pid, signal.SIGKILL)
+        return pid
+
+    def worker_pid(self, worker):
+        """
+        The pid of the worker's process, or None if it isn't running
+        """
+        return self.__worker_pid(worker)
+
+# PRIVATE:
+
+    def __init__(self, directory, workers):
+        self.directory = directory
+        self.workers = workers
+        self.port = free_port()
+        self.worker_base_port = free_port_block(workers)
+        self.store = os.path.join(directory, 'membership.sqlite')
+        self.url = "http://127.0.0.1:{}".format(self.port)
+        log_path = os.path.join(directory, 'cluster.log')
+        self.log = open(log_path, 'w') #pylint: disable=consider-using-with
+        self.process = None
+
+    @staticmethod
+    def __healthy(port):
+        try:
+            return requests.get("http://127.0.0.1:{}/health".format(port), timeout=2).ok
+        except requests.RequestException:
+            return False
+
+    def __worker_pid(self, worker):
+        """
+        Workers are forked children of the router, told apart by DRR_WORKER_ID
+        """
+        marker = "DRR_WORKER_ID={}".format(worker).encode()
+        for entry in os.listdir('/proc'):
+            if not entry.isdigit():
+                continue
+            try:
+                with open('/proc/{}/stat'.format(entry)) as stat:
+                    parent = int(stat.read().rsplit(')', 1)[1].split()[1])
+                if parent != self.process.pid:
+                    continue
+                with open('/proc/{}/environ'.format(entry), 'rb') as environ:
+                    if marker in environ.read().split(b'\0'):
+                        return int(entry)
+            except (OSError, IndexError, ValueError):
+                continue
+        return None
+
+def free_port():
+    """
+    A TCP port on localhost that nothing is listening on
+    """
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def free_port_block(count):
+    """
+    The first of count consecutive free TCP ports on localhost
+    """
+    while True:
+        base = free_port()
+        sockets = []
+        try:
+            for offset in range(count):
+                sock = socket.socket()
+                sockets.append(sock)
+                sock.bind(('127.0.0.1', base + offset))
+            return base
+        except OSError:
+            continue
+        finally:
+            for sock in sockets:
+                sock.close()
+
+def ring_owner(circuit, workers):
+    """
+    The worker drr_cluster.js's hash ring places a new circuit on
+    """
+    def ring_hash(key):
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:4], 'big')
+    points = sorted((ring_hash("{}#{}".format(worker, i)), worker)
+                    for worker in range(workers) for i in range(VIRTUAL_NODES))
+    key = ring_hash(circuit)
+    for point, worker in points:
+        if point >= key:
+            return worker
+    return points[0][1]
+
+def circuits_by_worker(workers, prefix):
+    """
+    A circuit name that the ring places on each worker
+    """
+    circuits = {}
+    index = 0
+    while len(circuits) < workers:
+        circuit = "{}-{}".format(prefix, index)
+        circuits.setdefault(ring_owner(circuit, workers), circuit)
+        index += 1
+    return [circuits[worker] for worker in range(workers)]
+
+def missing_modules():
+    """
+    Returns the Node.js modules the cluster needs that can't be resolved, or None if Node.js
+    itself is missing
+    """
+    if shutil.which('node') is None:
+        return None
+    missing = []
+    for module in NODE_MODULES:
+        if subprocess.run(['node', '-e', "require.resolve('{}')".format(module)],
+                          cwd=COORDINATOR_DIR, capture_output=True, check=False).returncode:
+            missing.append(module)
+    return missing
+
+def make_track(cluster, circuit, track_name):
+    """
+    A Coordinator client of the cluster, with a virtual device in place of the Starting Gate
+    """
+    config = Config(None)
+    config.coord_host = '127.0.0.1'
+    config.coord_port = cluster.port
+    config.circuit = circuit
+    config.track_name = track_name
+    config.num_lanes = 2
+    return Coordinator(config, VirtualDevice())
+
+def post_results(tracks):
+    """
+    Post lane times from every track at once, and check they all get the same standings
+    """
+    released = time.monotonic_ns()
+    calls = [lambda track=track, offset=offset: track.results(
+                 [{'laneNumber': 1, 'laneTime': 2.0 + offset},
+                  {'laneNumber': 2, 'laneTime': 2.5 + offset}], released)
+             for offset, track in enumerate(tracks)]
+    standings = in_parallel(*calls, timeout=REQUEST_TIMEOUT)
+    if any(len(ranking) != 2 * len(tracks) for ranking in standings):
+        raise CheckFailed("standings are missing lanes: {}".format(standings))
+    if any(ranking != standings[0] for ranking in standings):
+        raise CheckFailed("tracks got different standings: {}".format(standings))
+
+def check_same_race(tracks):
+    """
+    Check the tracks were all drawn into the same heat
+    """
+    races = [track.race for track in tracks]
+    if None in races or len(set(races)) != 1:
+        raise CheckFailed("tracks were not drawn into one heat: races {}".format(races))
+
+def check_proxy(cluster):
+    """
+    Plain HTTP through the router: one worker, or all of them gathered
+    """
+    cluster.get('/health')
+    if 'time' not in cluster.get('/time').json():
+        raise CheckFailed("/time has no time")
+    cluster.get('/skew').json()
+    metrics = cluster.get('/metrics').text
+    for worker in range(cluster.workers):
+        if 'worker="{}"'.format(worker) not in metrics:
+            raise CheckFailed("/metrics has nothing from worker {}".format(worker))
+
+def check_upgrade(cluster, circuits):
+    """
+    A circuit on each worker races over channels forwarded by the router.  Returns the
+    registered tracks of each circuit.
+    """
+    circuit_tracks = [[make_track(cluster, circuit, "{}-{}".format(circuit, name))
+                       for name in ('A', 'B')] for circuit in circuits]
+    everyone = [track for tracks in circuit_tracks for track in tracks]
+    in_parallel(*[track.register for track in everyone], timeout=REQUEST_TIMEOUT)
+    for worker, circuit in enumerate(circuits):
+        owner = cluster.owner(circuit)
+        if owner != worker:
+            raise CheckFailed("circuit {} went to worker {}, not {}".format(circuit, owner, worker))
+    in_parallel(*[track.start_race for track in everyone], timeout=REQUEST_TIMEOUT)
+    for tracks in circuit_tracks:
+        check_same_race(tracks)
+    in_parallel(*[lambda tracks=tracks: post_results(tracks) for tracks in circuit_tracks],
+                timeout=REQUEST_TIMEOUT)
+    return circuit_tracks
+
+def check_failover_waiting(cluster, circuit, tracks):
+    """
+    Kill the owner of circuit while track A waits for its heat, then start track B
+    """
+    owner = cluster.owner(circuit)
+    first, second = tracks
+    started = []
+    waiting = threading.Thread(target=lambda: started.append(first.start_race()), daemon=True)
+    waiting.start()
+    time.sleep(1)
+    cluster.kill_worker(owner)
+    cluster.wait_ready(owner)
+    if cluster.owner(circuit) != owner:
+        raise CheckFailed("circuit {} moved off its restarted worker".format(circuit))
+    second.start_race()
+    waiting.join(REQUEST_TIMEOUT)
+    if waiting.is_alive():
+        raise CheckFailed("track A never resumed its start")
+    check_same_race(tracks)
+    post_results(tracks)
+
+def check_failover_racing(cluster, circuit, tracks):
+    """
+    Kill the owner of circuit after the heat is drawn, before the tracks post results
+    """
+    owner = cluster.owner(circuit)
+    in_parallel(*[track.start_race for track in tracks], timeout=REQUEST_TIMEOUT)
+    check_same_race(tracks)
+    pid = cluster.kill_worker(owner)
+    while cluster.worker_pid(owner) in (pid, None):
+        time.sleep(0.1)
+    post_results(tracks)
+
+def run_checks(cluster, prefix):
+    """
+    Run every check in turn.  Returns (name, exception or None) for each check, or for
+    each check run until one needed by the rest failed.
+    """
+    circuits = circuits_by_worker(cluster.workers, prefix)
+    state = {}
+    checks = [
+        ('proxy', lambda: check_proxy(cluster)),
+        ('upgrade', lambda: state.update(tracks=check_upgrade(cluster, circuits))),
+        ('failover while waiting', lambda: check_failover_waiting(
+            cluster, circuits[0], state['tracks'][0])),
+        ('failover while racing', lambda: check_failover_racing(
+            cluster, circuits[-1], state['tracks'][-1])),
+    ]
+    outcomes = []
+    for name, check in checks:
+        if name.startswith('failover') and 'tracks' not in state:
+            outcomes.append((name, CheckFailed("skipped, as no tracks registered")))
+            continue
+        try:
+            check()
+            outcomes.append((name, None))
+        except Exception as exc: #pylint: disable=broad-except
+            outcomes.append((name, exc))
+    for tracks in state.get('tracks', []):
+        in_parallel(*[track.deregister for track in tracks], timeout=REQUEST_TIMEOUT)
+    return outcomes
+
+def parse_arguments():
+    """
+    Returns the settings of the run from the command line
+    """
+    parser = argparse.ArgumentParser(description="Check drr_cluster.js on localhost")
+    parser.add_argument('--workers', type=int, default=2,
+                        help="workers to run, at least two")
+    parser.add_argument('--keep', action='store_true',
+                        help="keep the scratch directory, with the cluster's log")
+    parser.add_argument('--verbose', action='store_true',
+                        help="show the Coordinator clients' logging")
+    settings = vars(parser.parse_args())
+    if settings['workers'] < 2:
+        parser.error("--workers must be at least 2")
+    return settings
+
+def main():
+    """
+    Run the cluster and check it
+    """
+    settings = parse_arguments()
+    missing = missing_modules()
+    if missing is None:
+        print("drr_cluster_check: node is not installed")
+        sys.exit(2)
+    if missing:
+        print("drr_cluster_check: missing Node.js modules:", " ".join(missing))
+        print("install them in {} with: npm install {}".format(
+            os.path.abspath(COORDINATOR_DIR), " ".join(missing)))
+        sys.exit(2)
+
+    directory = tempfile.mkdtemp(prefix='drr-cluster-')
+    cluster = Cluster(directory, settings['workers'])
+    outcomes = [('cluster', None)]
+    try:
+        cluster.start()
+        # The Coordinator clients log every request, which would bury the report
+        with open(os.devnull if not settings['verbose'] else '/dev/stdout', 'a') as log_file, \
+                contextlib.redirect_stdout(log_file):
+            outcomes += run_checks(cluster, "check-{}".format(os.getpid()))
+    except Exception as exc: #pylint: disable=broad-except
+        outcomes.append(('cluster', exc))
+    finally:
+        cluster.stop()
+
+    failures = 0
+    for name, exc in outcomes[1:]:
+        if exc is None:
+            print("PASS", name)
+        else:
+            failures += 1
+            print("FAIL {} - {}: {}".format(name, type(exc).__name__, exc))
+    if settings['keep'] or failures:
+        print("cluster log:", os.path.join(directory, 'cluster.log'))
+    else:
+        shutil.rmtree(directory)
+    sys.exit(failures)
+
+
+if __name__ == '__main__':
+    main()
+
+# vim: expandtab sw=4
@@ -0,0 +1,556 @@
+#! /usr/bin/python3
+
+"""
+Diecast Remote Raceway - Coordinator Load Generator
+
+Drives a race coordinator with many virtual tracks, to find out how many tracks it can
+handle and to compare one version of the coordinator with another.
+
+Each virtual track is a real Coordinator client (coordinator.py) with a virtual device in
+place of the Starting Gate's buttons and lane sensors.  It registers in its circuit and
+then races like a Starting Gate: it stages its cars after a jittered pause, waits for its
+heat, releases its gate at the scheduled start, streams its lane finishes and posts its
+results.  Now and then a track drops out mid-race, as a Starting Gate losing power or WiFi
+would, and registers again after a jittered pause.
+
+The tracks run as threads, as the Coordinator client blocks, spread over a pool of worker
+processes so thousands of them can run from one machine.
+
+Usage:
+
+   % python3 drr_load.py --host coordinator.example.com --layout 100x2,20x6 --duration 300
+   % python3 drr_load.py --reference --layout 50x2        # Against drr_reference.py
+   % python3 drr_load.py --json new.json --baseline old.json ...
+
+--layout gives the circuits as COUNTxTRACKS, comma separated, e.g. 100x2 is 100 circuits of
+two tracks.  See --help for the jitter and dropout settings.
+
+Report
+
+   throughput     Results returned to tracks, and heats completed, per second
+   latency        Seconds each track waited for the reply to register, start and results,
+                  i.e. the register, start and results barriers, and the smallest time
+                  request round trip of each race, which is the coordinator's overhead
+                  with no barrier wait
+   start skew     Milliseconds between the first and last track of a heat releasing its
+                  gate.  Every worker process reads the same monotonic clock, so this is
+                  the true spread, including clock synchronization error.
+   dropouts       Races abandoned by a track dropping out
+   errors         Requests that failed, by exception and status code
+
+The report is printed, and written as JSON with --json together with the settings of the
+run.  --baseline prints each figure beside that of an earlier run's JSON report, so runs
+against two versions of the coordinator with the same settings can be compared directly.
+Worker output, including the Coordinator client's logging, is discarded unless --log names
+a file for it.
+
+Author: Tom Quiggle
+tquiggle@gmail.com
+https://github.com/tquiggle/Die-Cast-Remote-Raceway
+
+Copyright (c) Thomas Quiggle. All rights reserved.
+
+Licensed under the MIT license. See LICENSE file in the project root for full license information.
+
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import contextlib
+import json
+import multiprocessing
+import os
+import random
+import sys
+import threading
+import time
+
+from config import Config
+from coordinator import Coordinator, CoordinatorCancelled
+from channel import ChannelError
+
+NANOSECONDS_PER_SECOND = 1000000000
+NANOSECONDS_PER_MILLISECOND = 1000000
+
+# Barriers, and the time request round trip, whose latency is reported
+LATENCIES = ('register', 'start', 'results', 'time')
+
+# Percentiles reported for each latency and for start skew
+PERCENTILES = (50, 90, 99)
+
+# Settings that shape the workload, which must match for two runs to be comparable
+WORKLOAD_SETTINGS = ('layout', 'lanes', 'duration', 'ramp', 'ready', 'race', 'dropout', 'rejoin')
+
+# Interval at which tracks still waiting on the coordinator when the run ends are cancelled
+CANCEL_INTERVAL = 0.5
+
+class VirtualDevice:
+    """
+    Stands in for the Starting Gate's DeviceIO: holds the key handlers the Coordinator
+    client pushes while it waits on the coordinator, and the lane occupancy it reports
+    """
+
+# PUBLIC:
+
+    def push_key_handlers(self, key_1_fn, key_2_fn, key_3_fn, joystick):
+        """
+        Push new set of handlers for the input keys onto the handler stack
+        """
+        with self.lock:
+            self.handlers.append((key_1_fn, key_2_fn, key_3_fn, joystick))
+
+    def pop_key_handlers(self):
+        """
+        Pop current set of handlers for the input keys from the handler stack
+        """
+        with self.lock:
+            self.handlers.pop()
+
+    def press_key(self):
+        """
+        Press key 1, which cancels any request the Coordinator client is waiting on
+        """
+        with self.lock:
+            handler = self.handlers[-1][0] if self.handlers else None
+        if handler is not None:
+            handler()
+
+    def lanes_occupied(self):
+        """
+        Returns the bitmask of lanes with cars in the starting gate
+        """
+        return self.occupied
+
+# PRIVATE:
+
+    def __init__(self):
+        self.handlers = []
+        self.lock = threading.Lock()
+        self.occupied = 0
+
+class VirtualTrack:
+    """
+    A simulated Starting Gate, racing in its circuit until stopped
+    """
+
+# PUBLIC:
+
+    def run(self):
+        """
+        Register and race until stop() is called or a request is cancelled, then
+        deregister
+        """
+        try:
+            if self.stopping.wait(self.rng.uniform(0, self.settings['ramp'])):
+                return
+            registered = False
+            while not self.stopping.is_set():
+                try:
+                    if not registered:
+                        self.__register()
+                        registered = True
+                    if not self.__race():
+                        registered = False
+                        self.__rejoin_pause()
+                except CoordinatorCancelled:
+                    break
+                except Exception as exc: #pylint: disable=broad-except
+                    self.__count_error(exc)
+                    registered = False
+                    self.__rejoin_pause()
+        finally:
+            if self.coordinator.session_token is not None:
+                self.coordinator.deregister()
+
+    def stop(self):
+        """
+        Stop racing once the race in progress is over
+        """
+        self.stopping.set()
+
+    def cancel(self):
+        """
+        Cancel the request the track is waiting on, if any
+        """
+        self.device.press_key()
+
+# PRIVATE:
+
+    def __init__(self, circuit, track_name, settings, samples):
+        self.settings = settings
+        self.samples = samples
+        self.rng = random.Random()
+        self.stopping = threading.Event()
+        self.device = VirtualDevice()
+
+        config = Config(None)
+        config.coord_host = settings['host']
+        config.coord_port = settings['port']
+        config.circuit = circuit
+        config.track_name = track_name
+        config.num_lanes = settings['lanes']
+        self.config = config
+        self.coordinator = Coordinator(config, self.device)
+
+    def __jittered(self, seconds):
+        """
+        seconds, jittered by up to half either way
+        """
+        return seconds * self.rng.uniform(0.5, 1.5)
+
+    def __rejoin_pause(self):
+        self.stopping.wait(self.__jittered(self.settings['rejoin']))
+
+    def __register(self):
+        # As the Starting Gate does: deregister any earlier session from the menu first
+        self.coordinator.menu_entered()
+        self.coordinator.menu_exited()
+        started = time.monotonic()
+        self.coordinator.register()
+        self.samples.latency('register', time.monotonic() - started)
+
+    def __race(self):
+        """
+        Race once.  Returns False if the track dropped out.
+        """
+        if self.stopping.wait(self.__jittered(self.settings['ready'])):
+            raise CoordinatorCancelled()
+        all_lanes = (1 << self.config.num_lanes) - 1
+        self.device.occupied = all_lanes
+        self.coordinator.lanes_changed(all_lanes)
+
+        started = time.monotonic()
+        start_at = self.coordinator.start_race()
+        self.samples.latency('start', time.monotonic() - started)
+        if self.coordinator.clock.is_synchronized():
+            self.samples.latency('time', self.coordinator.clock.best[2] / NANOSECONDS_PER_SECOND)
+
+        if start_at is not None:
+            time.sleep(max(0, start_at - time.monotonic_ns()) / NANOSECONDS_PER_SECOND)
+        released = time.monotonic_ns()
+        self.samples.release(self.config.circuit, self.coordinator.race, released)
+        self.device.occupied = 0
+        self.coordinator.lanes_changed(0)
+
+        if self.rng.random() < self.settings['dropout']:
+            self.samples.count('dropouts')
+            self.coordinator.channel.close()    # Gone without a word, like a power cut
+            return False
+
+        lane_times = sorted((self.rng.uniform(*self.settings['race']), lane)
+                            for lane in range(self.config.num_lanes))
+        for lane_time, lane in lane_times:
+            time.sleep(max(0, released / NANOSECONDS_PER_SECOND + lane_time - time.monotonic()))
+            self.coordinator.lane_finished(lane, lane_time)
+
+        results = [{'laneNumber': lane + 1, 'laneTime': lane_time}
+                   for lane_time, lane in lane_times]
+        started = time.monotonic()
+        self.coordinator.results(results, released)
+        self.samples.latency('results', time.monotonic() - started)
+        self.samples.count('results')
+        return True
+
+    def __count_error(self, exc):
+        name = type(exc).__name__
+        if isinstance(exc, ChannelError) and exc.code is not None:
+            name = "{} {}".format(name, exc.code)
+        self.samples.error(name)
+
+class Samples:
+    """
+    The measurements of the tracks run by one worker process, shared by its tracks' threads
+    """
+
+# PUBLIC:
+
+    def latency(self, name, seconds):
+        """
+        Record the latency of a request
+        """
+        with self.lock:
+            self.latencies[name].append(seconds)
+
+    def release(self, circuit, race, released):
+        """
+        Record the time.monotonic_ns() at which a track released its gate for a race
+        """
+        with self.lock:
+            self.releases.append((circuit, race, released))
+
+    def count(self, name):
+        """
+        Count an event
+        """
+        with self.lock:
+            self.counts[name] += 1
+
+    def error(self, name):
+        """
+        Count a failed request
+        """
+        with self.lock:
+            self.errors[name] += 1
+
+    def to_dict(self):
+        """
+        The samples, in a form that can be returned from a worker process
+        """
+        with self.lock:
+            return {'latencies': dict(self.latencies), 'releases': list(self.releases),
+                    'counts': dict(self.counts), 'errors': dict(self.errors)}
+
+# PRIVATE:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = collections.defaultdict(list)
+        self.releases = []
+        self.counts = collections.Counter()
+        self.errors = collections.Counter()
+
+def run_tracks(tracks, settings):
+    """
+    Worker process: race the given (circuit, track_name) tracks until the run's duration
+    has passed, then give their races in progress up to settings['drain'] seconds to finish
+    before cancelling them.  Returns the samples.
+    """
+    sys.stdout = open(settings['log'] or os.devnull, 'a') #pylint: disable=consider-using-with
+    samples = Samples()
+    virtual_tracks = [VirtualTrack(circuit, track_name, settings, samples)
+                      for circuit, track_name in tracks]
+    threads = [threading.Thread(target=track.run, daemon=True) for track in virtual_tracks]
+    for thread in threads:
+        thread.start()
+
+    time.sleep(settings['duration'])
+    for track in virtual_tracks:
+        track.stop()
+    drain_until = time.monotonic() + settings['drain']
+    while any(thread.is_alive() for thread in threads):
+        if time.monotonic() >= drain_until:
+            for track in virtual_tracks:
+                track.cancel()
+        time.sleep(CANCEL_INTERVAL)
+
+    sys.stdout.flush()
+    return samples.to_dict()
+
+def in_parallel(*calls, timeout=None):
+    """
+    Make each call on a thread of its own, as the requests of the tracks in a circuit wait
+    on one another at the coordinator's barriers.  Returns a tuple of their results, in
+    order.  Raises the first exception any call raised, or TimeoutError if any is still
+    running after timeout seconds.
+    """
+    results = {}    # index -> result of that call
+    errors = []
+
+    def run(index, call):
+        try:
+            results[index] = call()
+        except Exception as exc: #pylint: disable=broad-except
+            errors.append(exc)
+
+    threads = [threading.Thread(target=run, args=(index, call), daemon=True)
+               for index, call in enumerate(calls)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout)
+    if errors:
+        raise errors[0]
+    if any(thread.is_alive() for thread in threads):
+        raise TimeoutError("calls still running after {}s".format(timeout))
+    return tuple(results[index] for index in range(len(calls)))
+
+def parse_layout(layout, prefix):
+    """
+    Returns the (circuit, track_name) of every track in a layout of COUNTxTRACKS terms
+    """
+    tracks = []
+    circuits = 0
+    for term in layout.split(','):
+        count, size = (int(number) for number in term.lower().split('x'))
+        if size < 2:
+            raise ValueError("circuits need at least 2 tracks to race: {}".format(term))
+        for _ in range(count):
+            circuit = "{}-{}".format(prefix, circuits)
+            circuits += 1
+            tracks += [(circuit, "{}-{}".format(circuit, track)) for track in range(size)]
+    return tracks
+
+def percentiles(values):
+    """
+    Returns the count, mean, PERCENTILES and maximum of values, by nearest rank
+    """
+    if not values:
+        return {'count': 0}
+    ordered = sorted(values)
+    summary = {'count': len(ordered), 'mean': sum(ordered) / len(ordered)}
+    for percentile in PERCENTILES:
+        rank = max(0, -(-percentile * len(ordered) // 100) - 1)
+        summary['p{}'.format(percentile)] = ordered[rank]
+    summary['max'] = ordered[-1]
+    return summary
+
+def summarize(results, settings, elapsed):
+    """
+    Combine the samples of every worker into the report
+    """
+    latencies = collections.defaultdict(list)
+    releases = collections.defaultdict(list)
+    counts = collections.Counter()
+    errors = collections.Counter()
+    for samples in results:
+        for name, values in samples['latencies'].items():
+            latencies[name] += values
+        for circuit, race, released in samples['releases']:
+            if race is not None:
+                releases[(circuit, race)].append(released)
+        counts.update(samples['counts'])
+        errors.update(samples['errors'])
+
+    heats = [released for released in releases.values() if len(released) > 1]
+    return {
+        'settings': settings,
+        'elapsed': elapsed,
+        'throughput': {'resultsPerSecond': counts['results'] / elapsed,
+                       'heatsPerSecond': len(heats) / elapsed},
+        'latency': {name: percentiles(latencies[name]) for name in LATENCIES},
+        'startSkew': percentiles([(max(released) - min(released)) / NANOSECONDS_PER_MILLISECOND
+                                  for released in heats]),
+        'dropouts': counts['dropouts'],
+        'errors': dict(errors)
+    }
+
+def print_report(report, baseline=None):
+    """
+    Print a report, with the figures of a baseline report beside its own
+    """
+    def figure(value, base):
+        text = "{:9.4f}".format(value) if value is not None else "{:>9}".format('-')
+        if base is not None and value is not None:
+            text += " ({:+6.1f}%)".format(100 * (value - base) / base) if base else " (   n/a )"
+        return text
+
+    def row(label, stats, base_stats):
+        fields = [figure(stats.get(field), (base_stats or {}).get(field))
+                  for field in ['p{}'.format(p) for p in PERCENTILES] + ['max']]
+        print("  {:9} {:7}  {}".format(label, stats['count'], "  ".join(fields)))
+
+    settings = report['settings']
+    print("{} tracks, layout {}, {}s against {}:{}{}".format(
+        settings['tracks'], settings['layout'], settings['duration'], settings['host'],
+        settings['port'], " ({})".format(settings['label']) if settings['label'] else ""))
+    if baseline is not None:
+        print("Compared with {}".format(baseline['settings']['label'] or 'baseline'))
+        for name in WORKLOAD_SETTINGS:
+            if baseline['settings'].get(name) != settings[name]:
+                print("  Warning: baseline {} was {}".format(name, baseline['settings'].get(name)))
+
+    base = baseline or {}
+    for name, value in report['throughput'].items():
+        print("  {:18} {}".format(name, figure(value, base.get('throughput', {}).get(name))))
+    print("  {:18} {}".format('dropouts', report['dropouts']))
+    print("  {:18} {}".format('errors', report['errors'] or 'none'))
+
+    header = "  ".join("{:>9}".format(field) + (" " * 11 if baseline else "")
+                       for field in ['p{}'.format(p) for p in PERCENTILES] + ['max'])
+    print("Latency (s)   count  {}".format(header))
+    for name, stats in report['latency'].items():
+        row(name, stats, base.get('latency', {}).get(name))
+    print("Start skew (ms) heats")
+    row('heat', report['startSkew'], base.get('startSkew'))
+
+def start_reference():
+    """
+    Start drr_reference.py in this process on a free port, and return it
+    """
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Coordinator'))
+    from drr_reference import ReferenceCoordinator #pylint: disable=import-outside-toplevel
+    reference = ReferenceCoordinator(port=0)
+    reference.start_in_thread()
+    return reference
+
+def parse_arguments():
+    """
+    Returns the settings of the run from the command line
+    """
+    parser = argparse.ArgumentParser(description="Drive a race coordinator with virtual tracks")
+    parser.add_argument('--host', default='127.0.0.1', help="coordinator host")
+    parser.add_argument('--port', type=int, default=1968, help="coordinator port")
+    parser.add_argument('--reference', action='store_true',
+                        help="run drr_reference.py in-process and drive it instead")
+    parser.add_argument('--layout', default='10x2',
+                        help="circuits, as COUNTxTRACKS terms separated by commas")
+    parser.add_argument('--lanes', type=int, default=2, choices=range(1, 5),
+                        help="lanes per track")
+    parser.add_argument('--duration', type=float, default=60,
+                        help="seconds to race for, from the first registration")
+    parser.add_argument('--ramp', type=float, default=10,
+                        help="seconds over which tracks first register")
+    parser.add_argument('--ready', type=float, default=5,
+                        help="mean seconds between races to stage cars, jittered by half")
+    parser.add_argument('--race', type=float, nargs=2, default=[1.5, 3.5],
+                        metavar=('MIN', 'MAX'), help="range of lane times, in seconds")
+    parser.add_argument('--dropout', type=float, default=0.01,
+                        help="probability of a track dropping out of each race")
+    parser.add_argument('--rejoin', type=float, default=10,
+                        help="mean seconds before a track that dropped out registers again")
+    parser.add_argument('--drain', type=float, default=30,
+                        help="seconds allowed for races in progress to finish at the end")
+    parser.add_argument('--processes', type=int, default=os.cpu_count(),
+                        help="worker processes to spread the tracks over")
+    parser.add_argument('--label', default='', help="name of the coordinator version tested")
+    parser.add_argument('--json', help="write the report as JSON to this file")
+    parser.add_argument('--baseline', help="JSON report of an earlier run to compare against")
+    parser.add_argument('--log', help="append worker output to this file")
+    return vars(parser.parse_args())
+
+def main():
+    """
+    Run the load generator
+    """
+    settings = parse_arguments()
+    tracks = parse_layout(settings['layout'], "load-{:x}".format(random.getrandbits(24)))
+    settings['tracks'] = len(tracks)
+    processes = max(1, min(settings['processes'], len(tracks)))
+    shares = [tracks[index::processes] for index in range(processes)]
+
+    # drr_reference.py's logging goes with the workers', rather than into the report
+    with open(settings['log'] or os.devnull, 'a') as log_file, \
+            contextlib.redirect_stdout(log_file):
+        reference = None
+        if settings['reference']:
+            reference = start_reference()
+            settings['host'] = reference.host
+            settings['port'] = reference.port
+            settings['label'] = settings['label'] or 'drr_reference.py'
+
+        started = time.monotonic()
+        # Spawned, not forked, as this process may be running drr_reference.py's thread
+        with concurrent.futures.ProcessPoolExecutor(
+                processes, mp_context=multiprocessing.get_context('spawn')) as pool:
+            results = list(pool.map(run_tracks, shares, [settings] * processes))
+        report = summarize(results, settings, settings['duration'])
+        report['wallClock'] = time.monotonic() - started
+
+        if reference is not None:
+            reference.stop_in_thread()
+
+    baseline = None
+    if settings['baseline']:
+        with open(settings['baseline']) as baseline_file:
+            baseline = json.load(baseline_file)
+    print_report(report, baseline)
+    if settings['json']:
+        with open(settings['json'], 'w') as json_file:
+            json.dump(report, json_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
+
+# vim: expandtab sw=4
@@ -19,8 +19,10 @@ Licensed under the MIT license. See LICENSE file in the project root for full li
 """
 
 import os
+import random
 import subprocess
 import sys
+import time
 import urllib.request
 
 from config import Config
@@ -34,6 +36,17 @@ if trailing_slash != -1:
 
 DRR_CONFIG = Config("config/starting_gate.json")
 
+# Seconds to wait for the coordinator to serve version.txt
+FETCH_TIMEOUT = 5
+
+# The Starting Gate is restarted after a random delay that doubles, from
+# RESTART_BACKOFF_SECONDS up to RESTART_BACKOFF_CAP_SECONDS, each time it exits within
+# STABLE_SECONDS of starting.  A field of gates restarted together, or one that keeps
+# failing, then spreads out its update checks and registrations with the coordinator.
+STABLE_SECONDS = 60
+RESTART_BACKOFF_SECONDS = 1.0
+RESTART_BACKOFF_CAP_SECONDS = 60.0
+
 def fetch_latest_version():
     """
     Fetches version.txt containing latest release version from the DRR Coordinator
@@ -42,7 +55,7 @@ def fetch_latest_version():
                                                            DRR_CONFIG.coord_port)
     print("Fetching latest version number from ", version_url)
     try:
-        with urllib.request.urlopen(version_url) as response:
+        with urllib.request.urlopen(version_url, timeout=FETCH_TIMEOUT) as response:
             version = response.read().decode("utf-8").rstrip()
             return version
     except:
@@ -101,6 +114,15 @@ def run_starting_gate():
     result = subprocess.run(["./starting_gate.py"], check=False)
     print ("process returned = ", result.returncode)
 
+failures = 0
 while True:
     check_for_updates()
+    started = time.monotonic()
     run_starting_gate()
+    if time.monotonic() - started >= STABLE_SECONDS:
+        failures = 0
+    delay = random.uniform(0, min(RESTART_BACKOFF_CAP_SECONDS,
+                                  RESTART_BACKOFF_SECONDS * 2 ** failures))
+    failures += 1
+    print("restarting in {:.1f}s".format(delay))
+    time.sleep(delay)
@@ -0,0 +1,743 @@
+#! /usr/bin/python3
+
+"""
+Diecast Remote Raceway - Finish Line
+
+Interface to the Finish Line that reports when cars reach the end of each lane.
+
+Locating the Finish Line with a Bluetooth inquiry scan routinely takes 10 to 30 seconds.
+The FinishLine object runs discovery and the RFCOMM connection on a background thread
+that is started when the Starting Gate launches, so the connection is normally
+established while the user is still in the top level menu.  If the link drops during a
+race session, the race loop reports it via link_lost() and the thread reconnects in the
+background.
+
+The Bluetooth address of the Finish Line is cached in config/finish_line.json once found.
+Later connections first try the cached address directly with a short timeout, which
+takes about a second, and only fall back to a full inquiry scan if that fails.
+
+Every message exchanged with the Finish Line is terminated by a newline. A Connection
+object wraps the connected socket and splits the received byte stream back into messages.
+On connecting, the Starting Gate asks the Finish Line for its firmware version. Firmware
+that predates newline terminated messages is still supported: its bare FIN# messages are
+picked out of the byte stream, and finishes are timed on arrival.
+
+The Finish Line timestamps each FIN# message with its own micros() clock. A ClockSync
+object estimates the offset and drift between that clock and time.monotonic_ns() from
+HELO round trips, so lane times are measured from when the car actually crossed the
+finish line rather than when the message arrived over Bluetooth.  The background thread
+performs the round trips between races, keeping them off the critical path of a race.
+
+Author: Tom Quiggle
+tquiggle@gmail.com
+https://github.com/tquiggle/Die-Cast-Remote-Raceway
+
+Copyright (c) Thomas Quiggle. All rights reserved.
+
+Licensed under the MIT license. See LICENSE file in the project root for full license information.
+
+"""
+
+import collections
+import json
+import select
+import socket
+import threading
+import time
+
+import bluetooth
+
+from config import Config
+
+RFCOMM_PORT = 1
+
+# File caching the Bluetooth address of the Finish Line, next to starting_gate.json
+ADDRESS_CACHE = "config/finish_line.json"
+
+# Timeout, in seconds, for connecting directly to the cached address
+DIRECT_CONNECT_SECONDS = 2.0
+
+# Delay before retrying after a Bluetooth error, so a missing or disabled adapter doesn't
+# turn the connect loop into a busy loop.
+RETRY_SECONDS = 1.0
+
+# Size of the receive buffer. Comfortably larger than the longest Finish Line message, the
+# JSON reply to GETC.
+BUFFER_SIZE = 1024
+
+MESSAGE_TERMINATOR = b'\n'
+
+# Oldest Finish Line firmware version, in its YYMMDDVV form, that terminates its messages
+# with a newline
+FRAMED_FIRMWARE_VERSION = 26101700
+
+# Firmware versions are reported as eight digits, YYMMDDVV
+VERSION_LENGTH = 8
+
+# Seconds to wait for the reply to the firmware version request. Legacy firmware reads
+# commands with readString(), so only replies after its 1 second stream timeout.
+VERSION_TIMEOUT_SECONDS = 3.0
+
+# Seconds between connection attempts while the Finish Line runs unsupported firmware
+FIRMWARE_RETRY_SECONDS = 30.0
+
+# Legacy firmware sends each finish as the bare four byte message FIN#
+LEGACY_FINISH = b"FIN"
+LEGACY_FINISH_LENGTH = 4
+
+NANOSECONDS_PER_MICROSECOND = 1000
+
+# The Finish Line's micros() clock is an unsigned 32 bit value that wraps every 71.6 minutes
+MICROS_WRAP = 1 << 32
+
+# Number of HELO round trips performed by Connection.synchronize(), and how long to wait
+# for each reply
+SYNC_PROBES = 4
+SYNC_TIMEOUT_MS = 250
+
+# Seconds between clock synchronizations performed by the background thread while no
+# race is running
+SYNC_INTERVAL_SECONDS = 15
+
+# A race blocks to synchronize only if the clock estimate would expire within this long,
+# comfortably more than a race, including the wait for remote tracks, should take
+RACE_SYNC_MARGIN_NS = 4 * 60 * 1000000000
+
+# Number of recent round trip samples used to estimate the clock offset and drift
+SYNC_WINDOW = 16
+
+# Samples older than this are dropped from the drift estimate
+SAMPLE_MAX_AGE_NS = 10 * 60 * 1000000000
+
+# The offset is only trusted while the sample anchoring it is younger than this. Beyond
+# it, error in the drift estimate could amount to milliseconds.
+ANCHOR_MAX_AGE_NS = 5 * 60 * 1000000000
+
+# Samples must span at least this long before drift is estimated from them. Over shorter
+# spans the round trip jitter swamps the drift.
+DRIFT_MIN_SPAN_NS = 30 * 1000000000
+
+# Bound on the estimated drift, in parts per million. Crystal oscillators are within
+# 100ppm, so anything larger is measurement noise.
+MAX_DRIFT_PPM = 200
+
+class FirmwareError(Exception):
+    """
+    Raised when the Finish Line firmware is not one the Starting Gate can talk to
+    """
+
+class ClockSync:
+    """
+    Estimates the mapping from the Finish Line's micros() clock to the Starting Gate's
+    time.monotonic_ns() timebase.
+
+    Each HELO round trip yields a sample pairing the Finish Line clock reading from the
+    HELLO reply with the midpoint of the local send and receive times.  The error in a
+    sample is bounded by half its round trip time, so the sample with the smallest round
+    trip in the window anchors the offset.  Drift between the two clocks is the least
+    squares slope across the window, once the samples span long enough to measure it.
+
+    The micros() clock wraps every 71.6 minutes, so each reading is unwrapped against
+    the most recent sample using the local time elapsed since it, which stays correct
+    however long the Starting Gate sits idle between samples.  Samples expire after
+    SAMPLE_MAX_AGE_NS, and the anchor must be younger than ANCHOR_MAX_AGE_NS for the
+    clocks to be considered synchronized.
+    """
+
+# PUBLIC
+
+    def add_sample(self, device_us, sent_ns, received_ns):
+        """
+        Record a round trip in which the Finish Line read device_us from its clock
+        """
+        local_ns = (sent_ns + received_ns) // 2
+        device = self.__unwrap(device_us, local_ns)
+        self.samples.append((device, local_ns, received_ns - sent_ns))
+
+        while local_ns - self.samples[0][1] > SAMPLE_MAX_AGE_NS:
+            self.samples.popleft()
+        self.__estimate(local_ns)
+
+    def is_synchronized(self, now_ns=None):
+        """
+        Returns True if the anchor sample is younger than ANCHOR_MAX_AGE_NS at now_ns,
+        which defaults to the current time.monotonic_ns()
+        """
+        if self.anchor is None:
+            return False
+        if now_ns is None:
+            now_ns = time.monotonic_ns()
+        return now_ns - self.anchor[1] <= ANCHOR_MAX_AGE_NS
+
+    def to_local_ns(self, device_us, local_ns):
+        """
+        Convert a Finish Line micros() reading to the time.monotonic_ns() timebase.
+        local_ns is a local time close to the reading, such as when the message carrying
+        it was received, and is used to unwrap it.
+        """
+        anchor_device, anchor_local, _ = self.anchor
+        device = self.__unwrap(device_us, local_ns)
+        return anchor_local + round((device - anchor_device) * self.rate)
+
+# PRIVATE
+
+    def __init__(self):
+        self.samples = collections.deque(maxlen=SYNC_WINDOW)  # (device_us, local_ns, rtt_ns)
+        self.anchor = None          # Recent sample with the smallest round trip time
+        self.rate = float(NANOSECONDS_PER_MICROSECOND) # Local nanoseconds per device microsecond
+
+    def __unwrap(self, device_us, local_ns):
+        """
+        Returns the unwrapped value of the micros() reading device_us taken at about
+        local_ns: the value congruent to it modulo MICROS_WRAP that lies closest to the
+        most recent sample advanced by the local time elapsed since that sample.
+        """
+        if not self.samples:
+            return device_us
+        last_device, last_local, _ = self.samples[-1]
+        elapsed_us = (local_ns - last_local) / self.rate
+        delta = (device_us - last_device) % MICROS_WRAP
+        wraps = round((elapsed_us - delta) / MICROS_WRAP)
+        return last_device + delta + wraps * MICROS_WRAP
+
+    def __estimate(self, now_ns):
+        """
+        Update the anchor sample and drift rate from the samples in the window
+        """
+        recent = [sample for sample in self.samples
+                  if now_ns - sample[1] <= ANCHOR_MAX_AGE_NS]
+        self.anchor = min(recent, key=lambda sample: sample[2])
+
+        count = len(self.samples)
+        mean_device = sum(sample[0] for sample in self.samples) / count
+        mean_local = sum(sample[1] for sample in self.samples) / count
+        span = self.samples[-1][1] - self.samples[0][1]
+        variance = sum((sample[0] - mean_device) ** 2 for sample in self.samples)
+        if span < DRIFT_MIN_SPAN_NS or variance == 0:
+            return
+
+        covariance = sum((sample[0] - mean_device) * (sample[1] - mean_local)
+                         for sample in self.samples)
+        nominal = NANOSECONDS_PER_MICROSECOND
+        limit = nominal * MAX_DRIFT_PPM / 1000000
+        self.rate = min(max(covariance / variance, nominal - limit), nominal + limit)
+
+class Connection:
+    """
+    A connected, non-blocking RFCOMM socket to the Finish Line.
+
+    A single recv() may return part of a message or several messages coalesced together,
+    so received bytes accumulate in a preallocated buffer filled with recv_into().
+    receive() returns each complete message as a memoryview slice of that buffer rather
+    than a copy.  The slices remain valid until the next call to receive() or drain().
+
+    Socket errors, and the Finish Line closing the connection, are raised as
+    bluetooth.btcommon.BluetoothError so callers handle a lost link the same way whatever
+    the underlying socket implementation.
+
+    Each Connection has its own ClockSync, as the Finish Line's clock restarts whenever
+    the Finish Line does.
+
+    A legacy Connection talks to firmware older than FRAMED_FIRMWARE_VERSION, which sends
+    unterminated messages and no timestamps. receive() returns only its FIN# messages,
+    and synchronize() does nothing.
+    """
+
+# PUBLIC
+
+    def fileno(self):
+        """
+        Returns the socket file descriptor, allowing a Connection to be registered with
+        select.poll()
+        """
+        return self.sock.fileno()
+
+    def send(self, command):
+        """
+        Send a command string to the Finish Line
+        """
+        try:
+            self.sock.sendall(command.encode('utf-8') + MESSAGE_TERMINATOR)
+        except OSError as exc:
+            raise bluetooth.btcommon.BluetoothError(*exc.args) from exc
+
+    def synchronize(self):
+        """
+        Perform HELO round trips to refresh the clock offset and drift estimate.
+
+        Only call this while no race is running. Any other messages received while
+        waiting for a HELLO reply are discarded.
+        """
+        if self.legacy:
+            return
+
+        poller = select.poll()
+        poller.register(self, select.POLLIN)
+
+        for probe in range(SYNC_PROBES):
+            sent = time.monotonic_ns()
+            self.send("HELO {}".format(probe))
+
+            while poller.poll(SYNC_TIMEOUT_MS):
+                received = time.monotonic_ns()
+                if self.__hello_reply(self.receive(), probe, sent, received):
+                    break
+            else:
+                print("Connection.synchronize(): no reply to HELO", probe)
+
+        self.drain()    # Discard any late replies so they can't be paired with later probes
+
+    def finish_time_ns(self, msg, received_ns):
+        """
+        Returns the time a FIN# message reports the car crossed the finish line, in the
+        time.monotonic_ns() timebase.  Falls back to received_ns, the time the message was
+        received, if the message has no timestamp or the clocks are not yet synchronized.
+        """
+        fields = bytes(msg).split()
+        if len(fields) < 2 or not self.clock.is_synchronized(received_ns):
+            return received_ns
+        return self.clock.to_local_ns(int(fields[1]), received_ns)
+
+    def receive(self):
+        """
+        Read all data currently available from the socket without blocking.
+
+        Returns:
+            messages        List of memoryviews, one per complete message received,
+                            excluding the terminating newline
+        """
+        self.__compact()
+        while self.__fill():
+            pass
+        if self.legacy:
+            return self.__split_legacy()
+        return self.__split()
+
+    def drain(self):
+        """
+        Discard all messages currently available from the socket without blocking.
+
+        Returns:
+            count           Number of messages discarded
+        """
+        count = 0
+        while True:
+            messages = self.receive()
+            if not messages:
+                return count
+            count += len(messages)
+
+    def close(self):
+        """
+        Close the socket, ignoring errors from a dead link.
+        """
+        try:
+            self.sock.close()
+        except OSError as exc:
+            print("Connection: error closing socket =", exc.args)
+
+# PRIVATE
+
+    def __init__(self, sock, legacy=False):
+        self.sock = sock
+        self.legacy = legacy
+        self.sock.setblocking(False)
+        self.buffer = bytearray(BUFFER_SIZE)
+        self.view = memoryview(self.buffer)
+        self.head = 0   # Index of the first byte not yet returned as part of a message
+        self.tail = 0   # Index one past the last byte received
+        self.clock = ClockSync()
+
+    def __hello_reply(self, messages, probe, sent, received):
+        """
+        Search messages for the reply to the HELO probe, "HELLO <micros> <probe>", and
+        record it as a clock sample.  Returns True if the reply was found.
+        """
+        for msg in messages:
+            fields = bytes(msg).split()
+            if len(fields) == 3 and fields[0] == b"HELLO" and fields[2] == str(probe).encode():
+                self.clock.add_sample(int(fields[1]), sent, received)
+                return True
+        return False
+
+    def __compact(self):
+        """
+        Reclaim the space used by messages returned from the previous receive() by moving
+        any partial message to the start of the buffer.
+        """
+        if self.head == self.tail:
+            self.head = self.tail = 0
+        elif self.head > 0:
+            length = self.tail - self.head
+            # The source and destination overlap.  Copying between two slices of the same
+            # memoryview moves the bytes as memmove does, whereas assigning a view of the
+            # buffer to a slice of the buffer itself leaves the result to bytearray's
+            # slice assignment, which makes no such promise for overlapping regions.
+            self.view[:length] = self.view[self.head:self.tail]
+            self.head = 0
+            self.tail = length
+
+    def __fill(self):
+        """
+        Receive available data into the free space at the end of the buffer.
+
+        Returns True if data was received and there may be more available.
+        """
+        if self.tail == len(self.buffer):
+            if self.buffer.find(MESSAGE_TERMINATOR, self.head, self.tail) >= 0:
+                return False    # Return the complete messages first, read the rest later
+            print("Connection: message exceeds buffer size, discarding ", self.tail, " bytes")
+            self.tail = 0
+
+        try:
+            nbytes = self.sock.recv_into(self.view[self.tail:])
+        except BlockingIOError:
+            return False
+        except OSError as exc:
+            raise bluetooth.btcommon.BluetoothError(*exc.args) from exc
+
+        if nbytes == 0:
+            raise bluetooth.btcommon.BluetoothError("Connection closed by Finish Line")
+
+        self.tail += nbytes
+        return True
+
+    def __split(self):
+        """
+        Split the received data into complete messages, leaving any trailing partial
+        message in the buffer.
+        """
+        messages = []
+        while True:
+            end = self.buffer.find(MESSAGE_TERMINATOR, self.head, self.tail)
+            if end < 0:
+                return messages
+            messages.append(self.view[self.head:end])
+            self.head = end + 1
+
+    def __split_legacy(self):
+        """
+        Pick the FIN# messages out of data received from legacy firmware, discarding
+        anything else, and leave any trailing partial FIN# message in the buffer.
+        """
+        messages = []
+        while True:
+            start = self.buffer.find(LEGACY_FINISH, self.head, self.tail)
+            if start < 0:
+                # Keep the last bytes, as they may be the start of a FIN# message
+                self.head = max(self.head, self.tail - len(LEGACY_FINISH) + 1)
+                return messages
+            end = start + LEGACY_FINISH_LENGTH
+            if end > self.tail:
+                self.head = start
+                return messages
+            messages.append(self.view[start:end])
+            self.head = end
+
+class FinishLine(threading.Thread):
+    """
+    Maintains the Bluetooth connection between the Starting Gate and the Finish Line.
+
+    starting_gate.py creates a single instance at startup. The background thread
+    discovers the Finish Line advertising config.finish_line_name, connects to it, and
+    then synchronizes clocks with it every SYNC_INTERVAL_SECONDS until the race loop
+    reports that the connection was lost, at which point it closes the old connection
+    and starts over.  The race loop brackets each race with begin_race() and end_race()
+    so the background thread leaves the connection alone while a race is running.
+    """
+
+# PUBLIC
+
+    def is_connected(self):
+        """
+        Returns True if a Connection is available from wait_connected()
+        """
+        return self.connected_event.is_set()
+
+    def wait_connected(self, timeout=None):
+        """
+        Block until the background thread has connected to the Finish Line.
+
+        Raises FirmwareError if the Finish Line was found but its firmware is unsupported.
+
+        Args:
+            timeout:        Seconds to wait, or None to wait indefinitely
+
+        Returns:
+            connection      The Connection to the Finish Line, or None if the timeout
+                            expired first
+        """
+        if self.failure is not None:
+            raise self.failure
+        if not self.connected_event.wait(timeout):
+            return None
+        return self.connection
+
+    def begin_race(self, connection):
+        """
+        Take over the Connection returned by wait_connected() for a race, waiting for
+        any background synchronization to finish.  Synchronizes clocks now only if the
+        background thread has not kept the estimate fresh enough to last the race.
+        """
+        with self.sync_lock:
+            self.racing = True
+        if not connection.clock.is_synchronized(time.monotonic_ns() + RACE_SYNC_MARGIN_NS):
+            print("FinishLine: clock estimate is stale, synchronizing")
+            connection.synchronize()
+
+    def end_race(self):
+        """
+        Return the Connection to the background thread once no race is running.  Safe
+        to call more than once.
+        """
+        with self.sync_lock:
+            self.racing = False
+
+    def link_lost(self):
+        """
+        Report that the Connection returned by wait_connected() failed. The background
+        thread closes it and reconnects.  Callers must not use the old Connection after
+        this call.
+        """
+        self.connected_event.clear()
+        self.lost_event.set()
+
+# PRIVATE
+
+    def __init__(self, config):
+        threading.Thread.__init__(self, daemon=True)
+
+        self.config = config
+        self.connection = None
+        self.failure = None     # FirmwareError from the last connection attempt, if any
+        self.address = self.__load_address(config.finish_line_name)
+
+        self.connected_event = threading.Event()
+        self.connected_event.clear()
+
+        self.lost_event = threading.Event()
+        self.lost_event.clear()
+
+        self.sync_lock = threading.Lock()  # Held while either thread uses the connection
+        self.racing = False     # Set by begin_race(), cleared by end_race()
+
+        self.start()
+
+    def run(self):
+        """
+        Connect to the Finish Line, then synchronize clocks periodically until the link
+        is reported lost and reconnect.
+        """
+        while True:
+            self.__connect()
+            self.__synchronize()
+            while not self.lost_event.wait(SYNC_INTERVAL_SECONDS):
+                self.__synchronize()
+            self.lost_event.clear()
+            self.__close()
+
+    def __synchronize(self):
+        """
+        Refresh the clock estimate unless a race is running.  A Bluetooth error is
+        handled as a lost link.
+        """
+        with self.sync_lock:
+            if self.racing:
+                return
+            try:
+                self.connection.synchronize()
+            except bluetooth.btcommon.BluetoothError as exc:
+                print("FinishLine: error synchronizing clocks =", exc.args)
+                self.link_lost()
+
+    def __connect(self):
+        """
+        Establish a connection to the Finish Line, retrying until successful. The cached
+        address is tried first, falling back to a bluetooth scan for the Finish Line.
+        """
+        target_name = self.config.finish_line_name
+        print("FinishLine: attempting Bluetooth connection to ", target_name)
+
+        while True:
+            connection = None
+
+            try:
+                if self.address is not None:
+                    print("FinishLine: connecting to cached address ", self.address)
+                    connection = self.__open(self.address, DIRECT_CONNECT_SECONDS)
+
+                if connection is None:
+                    target_address = self.__discover(target_name)
+                    if target_address is None:
+                        print("FinishLine: could not find ", target_name, " nearby")
+                        time.sleep(RETRY_SECONDS)
+                        continue
+
+                    print("FinishLine: found ", target_name, ", connecting...")
+                    connection = self.__open(target_address, None)
+                    if connection is None:
+                        time.sleep(RETRY_SECONDS)
+                        continue
+
+                    if target_address != self.address:
+                        self.address = target_address
+                        self.__save_address(target_name, target_address)
+            except FirmwareError as exc:
+                print("FinishLine: ", exc)
+                self.failure = exc
+                time.sleep(FIRMWARE_RETRY_SECONDS)
+                continue
+
+            self.failure = None
+            self.connection = connection
+            self.connected_event.set()
+            print("FinishLine: connected to finish line")
+            return
+
+    @staticmethod
+    def __open(address, timeout):
+        """
+        Open an RFCOMM connection to address and check the Finish Line firmware version.
+
+        The connection uses the standard library's native Bluetooth socket rather than
+        bluetooth.BluetoothSocket, as the latter does not provide recv_into().
+
+        Args:
+            address:        Bluetooth address of the Finish Line
+            timeout:        Seconds to wait for the connection, or None to block
+
+        Returns:
+            connection      The Connection to the Finish Line, or None on failure
+
+        Raises FirmwareError if the Finish Line does not report a firmware version.
+        """
+        sock = socket.socket(socket.AF_BLUETOOTH, socket.SOCK_STREAM, socket.BTPROTO_RFCOMM)
+        try:
+            sock.settimeout(timeout)
+            sock.connect((address, RFCOMM_PORT))
+            version = FinishLine.__firmware_version(sock)
+        except OSError as exc:
+            print("FinishLine: error connecting to ", address, " =", exc.args)
+            sock.close()
+            return None
+        except FirmwareError:
+            sock.close()
+            raise
+
+        print("FinishLine: firmware version ", version)
+        legacy = version < FRAMED_FIRMWARE_VERSION
+        if legacy:
+            print("FinishLine: legacy firmware, finishes are timed on arrival. Reflash the "
+                  "Finish Line to time them on the Finish Line.")
+        return Connection(sock, legacy)
+
+    @staticmethod
+    def __firmware_version(sock):
+        """
+        Request the firmware version of the Finish Line with FWVS, which every firmware
+        version answers. Legacy firmware replies without a terminating newline, so the
+        reply is read until a newline or a whole version number arrives, or
+        VERSION_TIMEOUT_SECONDS expire.
+
+        Returns the version as an integer. Raises FirmwareError if there is no reply or
+        it is not a version number.
+        """
+        sock.settimeout(VERSION_TIMEOUT_SECONDS)
+        sock.sendall(b"FWVS" + MESSAGE_TERMINATOR)
+
+        reply = b""
+        deadline = time.monotonic() + VERSION_TIMEOUT_SECONDS
+        while MESSAGE_TERMINATOR not in reply and len(reply) < VERSION_LENGTH:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            sock.settimeout(remaining)
+            try:
+                data = sock.recv(BUFFER_SIZE)
+            except socket.timeout:
+                break
+            if not data:
+                raise OSError("Connection closed by Finish Line")
+            reply += data
+
+        version = reply.split(MESSAGE_TERMINATOR)[0].strip()
+        if not version.isdigit():
+            raise FirmwareError("Finish Line firmware did not report its version (replied "
+                                "{!r}). Reflash the Finish Line.".format(reply))
+        return int(version)
+
+    @staticmethod
+    def __discover(target_name):
+        """
+        Perform a single inquiry scan, resolving names as part of the inquiry, and return
+        the address of the device advertising target_name, or None if it was not found.
+        """
+        try:
+            nearby_devices = bluetooth.discover_devices(lookup_names=True)
+        except bluetooth.btcommon.BluetoothError as exc:
+            print("FinishLine: BluetoothError during discovery =", exc.args)
+            return None
+
+        for bdaddr, bdname in nearby_devices:
+            if bdname == target_name:
+                return bdaddr
+        return None
+
+    @staticmethod
+    def __load_address(target_name):
+        """
+        Returns the cached address of the Finish Line advertising target_name, or None if
+        there is no cached address for that name.
+        """
+        try:
+            with open(ADDRESS_CACHE) as cache_file:
+                cache = json.load(cache_file)
+        except (FileNotFoundError, ValueError):
+            return None
+
+        if cache.get("name") != target_name:
+            return None
+        return cache.get("address")
+
+    @staticmethod
+    def __save_address(target_name, address):
+        """
+        Cache the address of the Finish Line advertising target_name.
+        """
+        print("FinishLine: caching address ", address, " for ", target_name)
+        cache_string = json.dumps({"name": target_name, "address": address}, sort_keys=True,
+                                  indent=4, separators=(',', ': '))
+        try:
+            with open(ADDRESS_CACHE, 'w') as filehandle:
+                filehandle.write(cache_string)
+        except OSError as exc:
+            print("FinishLine: unable to write ", ADDRESS_CACHE, exc)
+
+    def __close(self):
+        """
+        Close the lost connection.
+        """
+        self.connection.close()
+        self.connection = None
+
+
+def main():
+    """
+    At some point I should write legitimate unit tests.  But for now, I just exercise
+    some basic functionality if the class is invoked as the Python main.
+    """
+    main_config = Config("config/starting_gate.json")
+    finish_line = FinishLine(main_config)
+    print("main: waiting for connection")
+    connection = finish_line.wait_connected()
+    print("main: connected")
+    while True:
+        for message in connection.receive():
+            print("main: received ", bytes(message))
+        time.sleep(0.1)
+
+
+if __name__ == '__main__':
+    main()
+
+# vim: expandtab sw=4
@@ -9,8 +9,7 @@ Starting Gate:
 
  TODO:
        Clean up startup process
-         * After exchanging HELLO messages, request version from FL
-         * Do version check on SG
+         * Do version check on SG against the version FinishLine reads on connect
          * Only if update needed, send UPFW command w/ bluetooth SSID and password
        Send encoded WiFI parameters to Finish Line if firmware update needed
 
@@ -23,7 +22,6 @@ Copyright (c) Thomas Quiggle. All rights reserved.
 Licensed under the MIT license. See LICENSE file in the project root for full license information.
 """
 
-import json
 import operator
 import select
 import time
@@ -31,20 +29,25 @@ import traceback
 
 import bluetooth
 import deviceio
-from deviceio import DeviceIO, SERVO, LANE1, LANE2, LANE3, LANE4
+from deviceio import DeviceIO, SERVO, LANE_MONITOR
 
 from config import Config, NOT_FINISHED
-from coordinator import Coordinator
+from channel import ChannelError
+from coordinator import Coordinator, CoordinatorCancelled
 from display import Display
+from finish_line import FinishLine, FirmwareError
 
 # Globals (yea, I know)
 #pylint: disable=invalid-name
 race_aborted = False # Set by key_pressed callback to reset race state
-finish_line_connected = False
 
 NANOSECONDS_TO_SECONDS = 1000000000
+SPIN_NANOSECONDS = 2000000
 READ_ONLY = select.POLLIN | select.POLLPRI | select.POLLHUP | select.POLLERR
 
+# How often, in seconds, to check for a key press while waiting for the Finish Line
+FINISH_LINE_POLL_SECONDS = 0.25
+
 def key_pressed():
     """
     Callback invoked when a key is pressed after exiting the top level menu.
@@ -54,54 +57,51 @@ def key_pressed():
     print("key_pressed(): Setting race_aborted to True")
     global race_aborted #pylint: disable=global-statement
     race_aborted = True
+    LANE_MONITOR.abort()
+
+def wait_for_finish_line(finish_line, display):
+    """ Wait for the background connector to establish the Bluetooth connection to the
+        Finish Line. Discovery starts when the Starting Gate launches, so the connection
+        is normally ready by the time the first race begins.
 
-#TODO: Make this async and kick it off as early as possible.
-def connect_to_finish_line(target_name, display, old_socket, poller):
-    """ Perform a bluetooth scan for the Finish Line advertising itself as 'target_name'
-        If found, establish a connection and return the connected socket
+        The wait is abandoned if a key is pressed, as the Finish Line may be switched off
+        or out of range.
 
         Args:
-            target_name:    The Bluetooth advertised name of the Finish Line to connect
+            finish_line:    FinishLine object managing the Bluetooth connection
             display:        Display object to manage display of race state
-            old_socket:     The socket previously connected to the Finish Line or None
-            poller:         The Select.Poll object to add new BT socket to
 
         Returns:
-            socket          The open socket to the Finish Line
+            connection      The Connection to the Finish Line, or None if the race was
+                            aborted first
 
     """
 
-    port = 1
-    socket = None
-    target_address = None
-    global finish_line_connected #pylint: disable=global-statement
-
-    print("Attempting Bluetooth connection to ", target_name)
+    if not finish_line.is_connected():
+        print("Waiting for Bluetooth connection to ", finish_line.config.finish_line_name)
+        display.wait_finish_line()
 
-    display.wait_finish_line()
+    while not race_aborted:
+        connection = finish_line.wait_connected(FINISH_LINE_POLL_SECONDS)
+        if connection is not None:
+            return connection
 
-    if old_socket is not None:
-        poller.unregister(old_socket)
-
-    while target_address is None:
-        nearby_devices = bluetooth.discover_devices()
-
-        for bdaddr in nearby_devices:
-            if target_name == bluetooth.lookup_name(bdaddr):
-                target_address = bdaddr
-                break
+    print("wait_for_finish_line(): aborted by key press")
+    return None
 
-        if target_address is None:
-            print("could not find ", target_name, " nearby")
-        else:
-            print("Found ", target_name, ", connecting...")
-            socket = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
-            socket.connect((target_address, port))
-            poller.register(socket, READ_ONLY)
-            finish_line_connected = True
-            print("Connected to finish line")
-            socket.send("HELO")
-    return socket
+def wait_until(deadline):
+    """ Sleep until time.monotonic_ns() reaches deadline. Sleeps coarsely, then spins for
+        the final couple of milliseconds as sleep() can overshoot by about that much.
+    """
+    remaining = deadline - time.monotonic_ns()
+    if remaining < 0:
+        print("wait_until(): deadline passed %6.3f seconds ago" %
+              (-remaining / NANOSECONDS_TO_SECONDS))
+        return
+    if remaining > SPIN_NANOSECONDS:
+        time.sleep((remaining - SPIN_NANOSECONDS) / NANOSECONDS_TO_SECONDS)
+    while time.monotonic_ns() < deadline:
+        pass
 
 def reset_starting_gate(config):
     """ Set servo to midpoint position to close the starting gate """
@@ -113,46 +113,17 @@ def release_starting_gate(config):
     """ Set servo to max position to release the starting gate """
     SERVO.value = config.servo_down_value
 
-def all_lanes_empty(config):
-    """ Scan the lane sensors to see if any lanes have cars present. """
-    num_lanes = config.num_lanes
-
-    if num_lanes == 1:
-        return LANE1.value == 0
-    if num_lanes == 2:
-        return LANE1.value + LANE2.value == 0
-    if num_lanes == 3:
-        return LANE1.value + LANE2.value + LANE3.value == 0
-    if num_lanes == 4:
-        return LANE1.value + LANE2.value + LANE3.value + LANE4.value == 0
-    return 0 # Dead code, but makes pylint happy
-
-def wait_for_car_in_lane(config):
+def wait_for_car_in_lane():
     """ Wait for at least one car to be placed in a lane """
-    global race_aborted #pylint: disable=global-statement,global-variable-not-assigned
-    while all_lanes_empty(config):
-        if race_aborted:
-            return
-        time.sleep(0.1)
+    LANE_MONITOR.wait_for_car()
 
+def calculate_results(config, coordinator, finish_times, released):
+    """ Create results dictionary sorted by finish time.
 
-def all_lanes_ready(config):
-    """ Scan the lane sensors to see if all lanes have cars present. """
-
-    num_lanes = config.num_lanes
-
-    if num_lanes == 1:
-        return LANE1.value == 1
-    if num_lanes == 2:
-        return LANE1.value + LANE2.value == 2
-    if num_lanes == 3:
-        return LANE1.value + LANE2.value + LANE3.value == 3
-    if num_lanes == 4:
-        return LANE1.value + LANE2.value + LANE4.value == 4
-    return 0 # Dead code, but makes pylint happy
-
-def calculate_results(config, coordinator, finish_times):
-    """ Create results dictionary sorted by finish time. """
+        released is the measured release instant of the local gate, in the
+        time.monotonic_ns() timebase, reported to the coordinator in multi-track races
+        so it can measure the start skew between tracks.
+    """
     num_lanes = config.num_lanes
     results = []
 
@@ -167,14 +138,13 @@ def calculate_results(config, coordinator, finish_times):
 
     # Send local results to race coordinator and await global results
     if config.multi_track:
-        results_string = coordinator.results(results)
-        results = json.loads(results_string)
+        results = coordinator.results(results, released)
 
     return results
 
 
-def purge_bluetooth_messages(socket):
-    """ Read any residual data from the Finish Line bluetooth connection.
+def purge_bluetooth_messages(connection):
+    """ Discard any residual messages from the Finish Line bluetooth connection.
 
     Before adding the BGIN/ENDR message exchange to prevent the finish line
     from sending results when something passed over a lane when no race was
@@ -183,25 +153,123 @@ def purge_bluetooth_messages(socket):
     a car actually reached the finish line.
 
     Now reading data should be rare and probably indicates a problem in the
-    finish line's debounce logic for the IR sensors. Nevertheless, a millisecond
-    delay to read any outstanding data on the socket seems like a reasonable
-    defensive act.
+    finish line's debounce logic for the IR sensors. Nevertheless, draining
+    any outstanding messages seems like a reasonable defensive act. The drain
+    does not block, so it adds no delay to the start of the race.
+    """
+
+    purged = connection.drain()
+    if purged:
+        print("purge_bluetooth_messages(): discarded", purged, "messages")
+
+def lane_index(msg, num_lanes):
+    """ Convert finished message received from the Finish Line to a lane index.
+
+        Lanes are named Lane1 through Lane4, but arrays are zero indexed.  So the "FIN1"
+        message indicates that the lane with an index position of 0 is finished.
+
+        Returns None for a lane number that isn't a digit from 1 to num_lanes.
+    """
+    lane_number = msg[3] - ord('0')
+    if not 1 <= lane_number <= num_lanes:
+        print("lane_index(): discarding finish for unknown lane", bytes(msg))
+        return None
+    return lane_number - 1
+
+def elapsed_time(lane, finish_ns, start):
+    """ Compute the elapsed time for a finished lane from the moment its car left the
+        starting gate, as detected by the lane sensor. A lane whose car was never seen
+        leaving indicates a failed release; its time is measured from start, the servo
+        command, instead.  Called once per lane, when it finishes.
+    """
+    departed = LANE_MONITOR.departure_ns(lane)
+    if departed is None:
+        print("Lane %d: car did not leave the starting gate" % (lane+1))
+        departed = start
+    return float(finish_ns[lane] - departed) / NANOSECONDS_TO_SECONDS
+
+def lane_finished(config, coordinator, race, lane, end):
+    """ Record the time, in the time.monotonic_ns() timebase, that the specified lane
+        finished, and its elapsed time, in race.  In multi-track races the lane time is
+        streamed to the other tracks right away.
+    """
+    finish_ns = race['finish_ns']
+    if finish_ns[lane] is not None:
+        print("lane ", lane+1, " reported redundant finish")
+        return
+
+    print("Lane %d finished." % (lane+1))
+    finish_ns[lane] = end
+    race['lane_times'][lane] = elapsed_time(lane, finish_ns, race['start'])
+    if config.multi_track:
+        coordinator.lane_finished(lane, race['lane_times'][lane])
+
+def all_lanes_finished(finish_ns, num_lanes):
+    """ Returns True if all configured lanes have finished.  False otherwise. """
+    return all(finish_ns[lane] is not None for lane in range(num_lanes))
+
+def release_time(num_lanes, start):
+    """ Returns the measured release instant of the gate: the earliest departure of a car
+        from the gate, or start, the servo command time, if no departure was detected.
+    """
+    departures = [LANE_MONITOR.departure_ns(lane) for lane in range(num_lanes)]
+    departures = [departed for departed in departures if departed is not None]
+    return min(departures) if departures else start
+
+def start_race(config, coordinator, display, connection):
+    """ Wait for the remote tracks in multi-track races, count down and release the
+        starting gate.  In multi-track races, every track releases its gate at the
+        instant scheduled by the coordinator.
+
+        Returns:
+            start           The time.monotonic_ns() at which the gate was released
+    """
+    start_at = None
+    if config.multi_track:
+        print("Waiting for remote ready")
+        display.wait_remote_ready()
+        remote = (config.remote_track_name, config.remote_car_icons)
+        start_at = coordinator.start_race()
+        print("Remote track ready")
+        if (config.remote_track_name, config.remote_car_icons) != remote:
+            # The coordinator drew a different opponent for this heat
+            display.remote_registration_done()
+
+    # Send start of race message to finish line.
+    # The message is sent before the countdown so it has been processed by the finish
+    # line well before the gate drops. Older finish line firmware read commands with
+    # readString(), which waited out a 1 second stream timeout before processing them.
+    connection.send("BGIN")
+    display.countdown()
+
+    purge_bluetooth_messages(connection)
+
+    if start_at is not None:
+        wait_until(start_at)
+
+    print("Start the race!")
+    LANE_MONITOR.arm_departures()
+    release_starting_gate(config)
+    return time.monotonic_ns()
+
+def post_results(config, coordinator, display, race):
+    """ Report the elapsed time of each lane, exchange results with the coordinator in
+        multi-track races and display them until a car is placed on a lane.
     """
+    print("Race finished")
+    for lane in range(config.num_lanes):
+        if race['finish_ns'][lane] is not None:
+            print("Lane %d elapsed time: %6.3f" % (lane+1, race['lane_times'][lane]))
+    results = calculate_results(config, coordinator, race['lane_times'],
+                                release_time(config.num_lanes, race['start']))
+
+    reset_starting_gate(config)
+    display.race_finished(results)
+
+    # Placing a car on a lane terminates the results display and exits the race
+    wait_for_car_in_lane()
 
-    prior_timeout = socket.gettimeout()
-    socket.settimeout(0.01)    # wait 1ms for any residual messages
-    try:
-        socket.recv(1024)   # Purge any messages from the Finish Line
-    except bluetooth.btcommon.BluetoothError as exc:
-        if exc.args[0] == 'timed out':
-            print("purge_bluetooth_messages(): BluetoothError = timed out, ignoring.")
-        else:
-            # Re raise any other bluetooth exception so the main loop will reconnect
-            print("purge_bluetooth_messages(): BluetoothError, other reason =", exc.args)
-            raise exc
-    socket.settimeout(prior_timeout)
-
-def run_race(config, coordinator, display, socket, poller):
+def run_race(config, coordinator, display, finish_line):
     """
     Run a race
 
@@ -209,114 +277,66 @@ def run_race(config, coordinator, display, socket, poller):
         config      Config object with current race configuration
         coordinator Coordinator object for communicating
         display     Display object to manage display of race state
-        socket      Bluetooth connection to Finish Line
-        poller      Polling object bound to socket to test for READ ready
+        finish_line FinishLine object managing the Bluetooth connection to the Finish Line
     """
 
     global race_aborted #pylint: disable=global-statement,global-variable-not-assigned
-    num_lanes = config.num_lanes
-    finish_times = [NOT_FINISHED, NOT_FINISHED, NOT_FINISHED, NOT_FINISHED]
-
-    def lane_index(msg):
-        """
-        Convert finished message received from the Finish Line to a lane index.
-
-        Lanes are named Lane1 through Lane4, but arrays are zero indexed.  So the "FIN1"
-        message indicates that the lane with an index position of 0 is finished.
-        """
-        lane_number = int(msg[3])
-        return lane_number - 1
-
-    def lane_finished(lane, times):
-        """
-        Record the finish time for the specified lane in the times array
-        """
-        if times[lane] != NOT_FINISHED:
-            print("lane ", lane+1, " reported redundant finish")
-            return
-
-        end = time.monotonic_ns()
-        delta = float(end - start) / NANOSECONDS_TO_SECONDS
-        print("Lane %d finished. Elapsed time: %6.3f" % (lane+1, delta))
-        times[lane] = delta
-
-    def all_lanes_finished():
-        """
-        Returns True if all configured lanes have finished.  False otherwise.
-        """
-        for lane in range(num_lanes):
-            if finish_times[lane] == NOT_FINISHED:
-                return False
-        return True
 
     # Wait for cars on the local starting lanes
     display.wait_local_ready()
     print("Waiting for cars at the gate")
-    while not all_lanes_ready(config) and not race_aborted:
-        time.sleep(0.1)
+    LANE_MONITOR.wait_ready()
 
     if race_aborted:
         return
 
     print("All Lanes Ready.")
 
-    if config.multi_track:
-        print("Waiting for remote ready")
-        display.wait_remote_ready()
-        coordinator.start_race()
-        print("Remote track ready")
+    connection = wait_for_finish_line(finish_line, display)
+    if connection is None:
+        return
 
-    # Send start of race message to finish line.
-    # The message is sent before the countdown because it can take more than 1 second
-    # for the bluetooth communication and the message to be picked up and processed by
-    # the finish line. Odd, given that the lane finished messages from the finish line
-    # are received nearly instantly.
-    socket.send("BGIN")
-    display.countdown()
+    poller = select.poll()
+    poller.register(connection, READ_ONLY)
 
-    purge_bluetooth_messages(socket)
+    # The background thread keeps the Finish Line clock estimate fresh between races, so
+    # this normally returns without any HELO round trips
+    finish_line.begin_race(connection)
 
-    print("Start the race!")
-    release_starting_gate(config)
+    start = start_race(config, coordinator, display, connection)
+    race = {'start': start,
+            'finish_ns': [None, None, None, None],
+            'lane_times': [NOT_FINISHED, NOT_FINISHED, NOT_FINISHED, NOT_FINISHED]}
 
     display.race_started()
 
-    start = time.monotonic_ns()
     timeout = start + config.race_timeout * NANOSECONDS_TO_SECONDS
 
-    while not all_lanes_finished() and not race_aborted and time.monotonic_ns() < timeout:
-        try:
-            events = poller.poll(100)
-            if events:
-                data = socket.recv(5)
+    while not all_lanes_finished(race['finish_ns'], config.num_lanes) and not race_aborted \
+            and time.monotonic_ns() < timeout:
+        events = poller.poll(100)
+        if not events:
+            continue
+        received = time.monotonic_ns()
 
-                msg = data.decode('utf-8')
-                print("received ", msg)
+        # Bluetooth errors propagate to main(), which reconnects to the Finish Line
+        for msg in connection.receive():
+            print("received ", bytes(msg))
 
-                if msg.startswith("FIN"):
-                    lane_finished(lane_index(msg), finish_times)
-
-        except bluetooth.btcommon.BluetoothError as exc:
-            if exc.args[0] == 'timed out':
-                print("Timeout waiting for race results. Finishing race")
-            else:
-                print("purge_bluetooth_messages(): BluetoothError, other reason =", exc.args)
-                raise exc
+            lane = lane_index(msg, config.num_lanes) \
+                if msg[:3] == b"FIN" and len(msg) >= 4 else None
+            if lane is not None:
+                lane_finished(config, coordinator, race, lane,
+                              connection.finish_time_ns(msg, received))
 
     # Send end of race message to Finish Line to disable further completion messages
-    socket.send("ENDR")
+    connection.send("ENDR")
+    finish_line.end_race()
 
     if race_aborted:
         return
 
-    print("Race finished")
-    results = calculate_results(config, coordinator, finish_times)
-
-    reset_starting_gate(config)
-    display.race_finished(results)
-
-    # Placing a car on a lane terminates the results display and exits the race
-    wait_for_car_in_lane(config)
+    post_results(config, coordinator, display, race)
 
 def main():
     """
@@ -325,12 +345,11 @@ def main():
 
     #config = Config("/home/pi/config/starting_gate.json")
     config = Config("config/starting_gate.json")
+    finish_line = FinishLine(config)    # Start Bluetooth discovery while the menu is up
     display = Display(config)
     device = DeviceIO()
     coordinator = Coordinator(config)
-    socket = None
-    poller = select.poll()
-    global finish_line_connected #pylint: disable=global-statement
+    LANE_MONITOR.set_listener(coordinator.lanes_changed)
 
     reset_starting_gate(config)
 
@@ -341,36 +360,53 @@ def main():
         global race_aborted #pylint: disable=global-statement
         race_aborted = False
 
-        # De-register with race coordinator.
-        config.allow_multi_track = coordinator.deregister()
+        # De-register with race coordinator in the background. Its health monitor enables
+        # the Multi Track menu option whenever the coordinator is reachable.
+        coordinator.menu_entered()
 
         # Display the main menu and wait for race selection
         display.wait_menu()
+        coordinator.menu_exited()
+
+        # Track lane sensors for the number of lanes selected for this session
+        LANE_MONITOR.configure(config.num_lanes)
 
         device.push_key_handlers(key_pressed, key_pressed, key_pressed,
                                  deviceio.default_joystick_handler)
 
-        # Establish Bluetooth connection to Finish Line
-        if not finish_line_connected:
-            socket = connect_to_finish_line(config.finish_line_name, display, socket, poller)
-
         # Register with the race coordinator if multi-track race selected in menu
         if config.multi_track:
             display.wait_remote_registration()
-            coordinator.register()
-            display.remote_registration_done()
+            try:
+                coordinator.register()
+            except CoordinatorCancelled:
+                print("Registration cancelled. Returning to menu")
+                race_aborted = True
+            except ChannelError as exc:
+                print("Registration failed. Returning to menu", exc)
+                race_aborted = True
+            else:
+                display.remote_registration_done()
 
         while not race_aborted:
             try:
-                run_race(config, coordinator, display, socket, poller)
+                run_race(config, coordinator, display, finish_line)
             except bluetooth.btcommon.BluetoothError:
                 print("Bluetooth exception caught.  Reconnecting...")
-                finish_line_connected = False
-                socket = connect_to_finish_line(config.finish_line_name, display, socket, poller)
+                finish_line.link_lost()
+            except FirmwareError as exc:
+                print("Unsupported Finish Line firmware. Returning to menu.", exc)
+                break
+            except CoordinatorCancelled:
+                print("Coordinator request cancelled. Returning to menu")
+                reset_starting_gate(config)
+                break
             except Exception as exc: #pylint: disable=broad-except
                 print("Unexpected exception caught", exc)
                 traceback.print_exc()
                 break # Go back to main menu on unhandled exception within a race
+            finally:
+                finish_line.end_race()  # Resume background clock synchronization
 
         device.pop_key_handlers()
 
@@ -0,0 +1,40 @@
+"""
+Diecast Remote Raceway - Test Fixtures
+
+The Starting Gate's modules import one another by bare name, as starting_gate.py is run
+from its own directory, so the tests put that directory, and the Coordinator directory
+holding drr_reference.py, on the import path.
+
+Author: Tom Quiggle
+tquiggle@gmail.com
+https://github.com/tquiggle/Die-Cast-Remote-Raceway
+
+Copyright (c) Thomas Quiggle. All rights reserved.
+
+Licensed under the MIT license. See LICENSE file in the project root for full license information.
+
+"""
+
+import os
+import sys
+
+import pytest
+
+STARTING_GATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+COORDINATOR_DIR = os.path.join(STARTING_GATE_DIR, '..', 'Coordinator')
+
+sys.path.insert(0, os.path.abspath(STARTING_GATE_DIR))
+sys.path.insert(0, os.path.abspath(COORDINATOR_DIR))
+
+@pytest.fixture(scope='module')
+def reference():
+    """
+    drr_reference.py serving on a free port of localhost, on a thread of its own
+    """
+    from drr_reference import ReferenceCoordinator #pylint: disable=import-outside-toplevel
+    coordinator = ReferenceCoordinator(port=0)
+    coordinator.start_in_thread()
+    yield coordinator
+    coordinator.stop_in_thread()
+
+# vim: expandtab sw=4
@@ -0,0 +1,91 @@
+"""
+Diecast Remote Raceway - Coordinator Client Unit Tests
+
+ServerClock and backoff_delay of coordinator.py, and the handling of the events the
+coordinator forwards over the channel
+
+Author: Tom Quiggle
+tquiggle@gmail.com
+https://github.com/tquiggle/Die-Cast-Remote-Raceway
+
+Copyright (c) Thomas Quiggle. All rights reserved.
+
+Licensed under the MIT license. See LICENSE file in the project root for full license information.
+
+"""
+
+#pylint: disable=missing-function-docstring
+
+import random
+
+import pytest
+
+from channel import Channel
+from config import Config
+from coordinator import (BACKOFF_CAP_SECONDS, BACKOFF_SECONDS, Coordinator, ServerClock,
+                         backoff_delay)
+from drr_load import VirtualDevice
+
+NANOSECONDS_PER_MILLISECOND = 1000000
+
+def test_server_clock_unsynchronized():
+    clock = ServerClock()
+    assert not clock.is_synchronized()
+
+def test_server_clock_uses_smallest_round_trip():
+    clock = ServerClock()
+    # The coordinator's clock reads 1000ms more than the local clock's milliseconds
+    clock.add_sample(1000 + 15, 10 * NANOSECONDS_PER_MILLISECOND, 20 * NANOSECONDS_PER_MILLISECOND)
+    clock.add_sample(1000 + 52, 50 * NANOSECONDS_PER_MILLISECOND, 54 * NANOSECONDS_PER_MILLISECOND)
+    clock.add_sample(2000, 60 * NANOSECONDS_PER_MILLISECOND, 90 * NANOSECONDS_PER_MILLISECOND)
+
+    assert clock.is_synchronized()
+    assert clock.best == (1052, 52 * NANOSECONDS_PER_MILLISECOND, 4 * NANOSECONDS_PER_MILLISECOND)
+    assert clock.to_server_ms(100 * NANOSECONDS_PER_MILLISECOND) == pytest.approx(1100)
+    assert clock.to_local_ns(1100) == 100 * NANOSECONDS_PER_MILLISECOND
+
+def test_server_clock_round_trip_conversion():
+    clock = ServerClock()
+    clock.add_sample(1.7e12, 123456789, 124456789)
+    local_ns = 987654321
+    assert clock.to_local_ns(clock.to_server_ms(local_ns)) == pytest.approx(local_ns, abs=1000)
+
+def test_server_clock_reset():
+    clock = ServerClock()
+    clock.add_sample(1000, 0, 10)
+    clock.reset()
+    assert not clock.is_synchronized()
+
+def test_backoff_delay_grows_to_cap():
+    random.seed(1968)
+    for attempt in range(12):
+        bound = min(BACKOFF_CAP_SECONDS, BACKOFF_SECONDS * 2 ** attempt)
+        delays = [backoff_delay(attempt) for _ in range(200)]
+        assert all(0 <= delay <= bound for delay in delays)
+        assert max(delays) > bound / 2     # Spread over the whole range, not clustered
+
+def test_backoff_delay_honours_retry_after():
+    random.seed(1968)
+    delays = [backoff_delay(0, retry_after=5) for _ in range(200)]
+    assert all(5 <= delay <= 10 for delay in delays)
+    assert max(delays) - min(delays) > 2.5
+
+def test_malformed_finish_events_ignored():
+    coordinator = Coordinator(Config(None), VirtualDevice())
+    coordinator.config.remote_track_name = 'remote'
+    remote_events = coordinator._Coordinator__remote_events #pylint: disable=protected-access
+    for lane_number in (None, 0, 5, '1', True, 2):
+        remote_events([{'type': 'finish', 'trackName': 'remote',
+                        'body': {'laneNumber': lane_number, 'laneTime': 1.5}}])
+    remote_events([{'type': 'finish', 'trackName': 'remote', 'body': {'laneNumber': 1}}])
+    assert coordinator.config.remote_finish_times == [None, 1.5, None, None]
+
+def test_failing_listener_spares_reader():
+    def listener(body):
+        raise KeyError(body)
+
+    channel = Channel('ws://127.0.0.1:1/channel')
+    channel.listen('events', listener)
+    channel._Channel__dispatch({'type': 'events', 'body': []}) #pylint: disable=protected-access
+
+# vim: expandtab sw=4
@@ -0,0 +1,183 @@
+"""
+Diecast Remote Raceway - Reference Coordinator Scheduling Unit Tests
+
+HeatScheduler and AdmissionQueue of drr_scheduling.py, which drr_reference.py races with
+and which mirror those of drr_server.js.  Timings are scaled down to tens of milliseconds.
+
+Author: Tom Quiggle
+tquiggle@gmail.com
+https://github.com/tquiggle/Die-Cast-Remote-Raceway
+
+Copyright (c) Thomas Quiggle. All rights reserved.
+
+Licensed under the MIT license. See LICENSE file in the project root for full license information.
+
+"""
+
+#pylint: disable=missing-function-docstring
+
+import asyncio
+import time
+
+import pytest
+
+from drr_scheduling import AdmissionQueue, HeatScheduler, RequestError
+
+# Seconds a heat is held for a fairer one, and a short heat waits for absent tracks
+ROTATION = 0.05
+GRACE = 0.3
+
+def make_scheduler(heat_size=2, rotation=ROTATION, grace=GRACE):
+    """
+    A HeatScheduler, and the list of heats it forms
+    """
+    formed = []
+    return HeatScheduler('test', heat_size, rotation, grace, formed.append), formed
+
+async def settled(future, timeout=2):
+    return await asyncio.wait_for(asyncio.shield(future), timeout)
+
+def test_heat_formed_when_enough_ready():
+    async def scenario():
+        scheduler, formed = make_scheduler()
+        for session in 'AB':
+            scheduler.add(session)
+        first = scheduler.arrive('A')
+        assert not first.done()
+        second = scheduler.arrive('B')
+        outcome = await settled(first)
+        assert outcome is await settled(second)
+        assert sorted(outcome['arrived']) == ['A', 'B']
+        assert outcome['missing'] == []
+        assert formed == [outcome]
+        assert scheduler.racing == {'A', 'B'}
+    asyncio.run(scenario())
+
+def test_short_heat_after_grace():
+    async def scenario():
+        scheduler, _ = make_scheduler()
+        for session in 'AB':
+            scheduler.add(session)
+        started = time.monotonic()
+        outcome = await settled(scheduler.arrive('A'))
+        assert time.monotonic() - started >= GRACE * 0.9
+        assert outcome['arrived'] == ['A']
+        assert outcome['missing'] == ['B']
+    asyncio.run(scenario())
+
+def test_no_short_heat_while_member_racing():
+    async def scenario():
+        scheduler, _ = make_scheduler(heat_size=3)
+        for session in 'ABC':
+            scheduler.add(session)
+        scheduler.racing.add('C')
+        waiting = scheduler.arrive('A')
+        await asyncio.sleep(GRACE * 1.5)
+        assert not waiting.done()
+        scheduler.finished(['C'])
+        scheduler.arrive('C')
+        await asyncio.sleep(GRACE * 1.5)
+        outcome = await settled(waiting)
+        assert sorted(outcome['arrived']) == ['A', 'C']
+        assert outcome['missing'] == ['B']
+    asyncio.run(scenario())
+
+def test_grace_runs_from_when_absent_tracks_became_available():
+    """
+    A and B race while C waits.  Once they finish, C waits a full grace for them rather
+    than forming a short heat at once, and races with whichever returns in time.
+    """
+    async def scenario():
+        scheduler, _ = make_scheduler()
+        for session in 'ABC':
+            scheduler.add(session)
+        scheduler.arrive('A')
+        scheduler.arrive('B')
+        waiting = scheduler.arrive('C')
+        await asyncio.sleep(GRACE * 1.5)    # Longer than grace, but A and B are racing
+        assert not waiting.done()
+
+        scheduler.finished(['A', 'B'])
+        await asyncio.sleep(GRACE * 0.3)
+        assert not waiting.done()
+        scheduler.arrive('A')
+        outcome = await settled(waiting)
+        assert sorted(outcome['arrived']) == ['A', 'C']
+    asyncio.run(scenario())
+
+def test_rotation_holds_heat_for_fairer_opponent():
+    """
+    After A and B race, both are ready again before C.  The rematch is held for up to
+    rotation, and C arriving in that time races A instead.
+    """
+    async def scenario():
+        scheduler, _ = make_scheduler(grace=5)
+        for session in 'ABC':
+            scheduler.add(session)
+        scheduler.arrive('A')
+        scheduler.arrive('B')
+        scheduler.finished(['A', 'B'])
+        first = scheduler.arrive('A')
+        second = scheduler.arrive('B')
+        await asyncio.sleep(ROTATION * 0.3)
+        assert not first.done()
+        outcome = await settled(scheduler.arrive('C'))
+        assert sorted(outcome['arrived']) == ['A', 'C']
+        assert outcome is await settled(first)
+        assert not second.done()
+    asyncio.run(scenario())
+
+def test_rotation_rematch_after_hold():
+    async def scenario():
+        scheduler, _ = make_scheduler(grace=5)
+        for session in 'ABC':
+            scheduler.add(session)
+        scheduler.arrive('A')
+        scheduler.arrive('B')
+        scheduler.finished(['A', 'B'])
+        started = time.monotonic()
+        scheduler.arrive('A')
+        outcome = await settled(scheduler.arrive('B'))
+        assert time.monotonic() - started >= ROTATION * 0.9
+        assert sorted(outcome['arrived']) == ['A', 'B']
+    asyncio.run(scenario())
+
+def test_removed_member_wait_fails():
+    async def scenario():
+        scheduler, _ = make_scheduler()
+        for session in 'AB':
+            scheduler.add(session)
+        waiting = scheduler.arrive('A')
+        scheduler.remove('A')
+        with pytest.raises(RequestError) as failure:
+            await settled(waiting)
+        assert failure.value.code == 410
+        assert 'A' not in scheduler.members
+    asyncio.run(scenario())
+
+def test_admission_queue_burst_then_rate():
+    async def scenario():
+        rate = 100
+        queue = AdmissionQueue(rate, burst=3, max_queued=10)
+        started = time.monotonic()
+        for _ in range(3):
+            await queue.admit()
+        assert not queue.queue and queue.tokens < 1
+        await asyncio.gather(*(queue.admit() for _ in range(5)))
+        assert time.monotonic() - started >= 5 / rate * 0.8
+    asyncio.run(scenario())
+
+def test_admission_queue_turns_away_when_full():
+    async def scenario():
+        queue = AdmissionQueue(rate=10, burst=1, max_queued=2)
+        await queue.admit()
+        waiting = [asyncio.ensure_future(queue.admit()) for _ in range(2)]
+        await asyncio.sleep(0)
+        with pytest.raises(RequestError) as failure:
+            await queue.admit()
+        assert failure.value.code == 503
+        assert failure.value.retry_after >= 1
+        await asyncio.wait_for(asyncio.gather(*waiting), 2)
+    asyncio.run(scenario())
+
+# vim: expandtab sw=4
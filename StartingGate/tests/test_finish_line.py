@@ -0,0 +1,191 @@
+"""
+Diecast Remote Raceway - Finish Line Unit Tests
+
+ClockSync, and the message framing of Connection, of finish_line.py.  A socketpair stands
+in for the RFCOMM socket to the Finish Line.
+
+finish_line.py needs pybluez, so these tests are skipped where it isn't installed.
+
+Author: Tom Quiggle
+tquiggle@gmail.com
+https://github.com/tquiggle/Die-Cast-Remote-Raceway
+
+Copyright (c) Thomas Quiggle. All rights reserved.
+
+Licensed under the MIT license. See LICENSE file in the project root for full license information.
+
+"""
+
+#pylint: disable=missing-function-docstring,redefined-outer-name
+
+import socket
+
+import pytest
+
+bluetooth = pytest.importorskip("bluetooth")
+
+#pylint: disable=wrong-import-position
+from finish_line import (ANCHOR_MAX_AGE_NS, BUFFER_SIZE, MICROS_WRAP, SAMPLE_MAX_AGE_NS,
+                         ClockSync, Connection)
+
+NANOSECONDS_PER_SECOND = 1000000000
+
+# The Finish Line's clock in these tests reads this many microseconds at local time 0
+DEVICE_OFFSET_US = 123456789
+
+def device_reading(local_ns, rate=1000.0):
+    """
+    The Finish Line's micros() reading at local_ns, for a clock running at rate local
+    nanoseconds per microsecond
+    """
+    return int(DEVICE_OFFSET_US + local_ns / rate) % MICROS_WRAP
+
+def add_sample(clock, local_ns, rtt_ns=200000, rate=1000.0):
+    clock.add_sample(device_reading(local_ns, rate), local_ns - rtt_ns // 2, local_ns + rtt_ns // 2)
+
+@pytest.fixture
+def pair():
+    """
+    A Connection and the socket at the Finish Line's end of it
+    """
+    local, remote = socket.socketpair()
+    connection = Connection(local)
+    yield connection, remote
+    connection.close()
+    remote.close()
+
+def received(connection):
+    return [bytes(message) for message in connection.receive()]
+
+def test_clock_unsynchronized():
+    clock = ClockSync()
+    assert not clock.is_synchronized(0)
+
+def test_clock_maps_device_time():
+    clock = ClockSync()
+    add_sample(clock, 10 * NANOSECONDS_PER_SECOND)
+    local_ns = 12 * NANOSECONDS_PER_SECOND
+    assert clock.to_local_ns(device_reading(local_ns), local_ns) == \
+        pytest.approx(local_ns, abs=1000)
+
+def test_clock_anchors_on_smallest_round_trip():
+    clock = ClockSync()
+    add_sample(clock, 1 * NANOSECONDS_PER_SECOND, rtt_ns=5000000)
+    add_sample(clock, 2 * NANOSECONDS_PER_SECOND, rtt_ns=100000)
+    add_sample(clock, 3 * NANOSECONDS_PER_SECOND, rtt_ns=8000000)
+    assert clock.anchor[1] == 2 * NANOSECONDS_PER_SECOND
+
+def test_clock_expires_with_anchor():
+    clock = ClockSync()
+    add_sample(clock, 0)
+    assert clock.is_synchronized(ANCHOR_MAX_AGE_NS)
+    assert not clock.is_synchronized(ANCHOR_MAX_AGE_NS + 1)
+
+def test_clock_unwraps_across_wrap():
+    clock = ClockSync()
+    # Sample just before micros() wraps, then read a finish just after it
+    before_wrap_ns = (MICROS_WRAP - DEVICE_OFFSET_US - 1000) * 1000
+    add_sample(clock, before_wrap_ns)
+    local_ns = before_wrap_ns + 2 * NANOSECONDS_PER_SECOND
+    assert device_reading(local_ns) < 1000 * 1000 * 2
+    assert clock.to_local_ns(device_reading(local_ns), local_ns) == \
+        pytest.approx(local_ns, abs=1000)
+
+def test_clock_unwraps_after_long_idle():
+    """
+    Three hours idle spans more than two wraps of micros()
+    """
+    clock = ClockSync()
+    add_sample(clock, 0)
+    local_ns = 3 * 3600 * NANOSECONDS_PER_SECOND
+    add_sample(clock, local_ns)
+    assert clock.samples[0][1] == local_ns    # The first sample expired
+    later_ns = local_ns + 5 * NANOSECONDS_PER_SECOND
+    assert clock.to_local_ns(device_reading(later_ns), later_ns) == \
+        pytest.approx(later_ns, abs=1000)
+
+def test_clock_estimates_drift():
+    rate = 1000.0 * (1 + 50e-6)   # The Finish Line's crystal runs 50ppm slow
+    clock = ClockSync()
+    for second in range(0, 121, 10):
+        add_sample(clock, second * NANOSECONDS_PER_SECOND, rate=rate)
+    assert clock.rate == pytest.approx(rate, rel=2e-6)
+    local_ns = 240 * NANOSECONDS_PER_SECOND
+    assert clock.to_local_ns(device_reading(local_ns, rate), local_ns) == \
+        pytest.approx(local_ns, abs=20000)
+
+def test_clock_drops_old_samples():
+    clock = ClockSync()
+    add_sample(clock, 0)
+    add_sample(clock, SAMPLE_MAX_AGE_NS + 1)
+    assert len(clock.samples) == 1
+
+def test_connection_splits_coalesced_messages(pair):
+    connection, remote = pair
+    remote.sendall(b"FIN1 100\nFIN2 200\n")
+    assert received(connection) == [b"FIN1 100", b"FIN2 200"]
+
+def test_connection_holds_partial_message(pair):
+    connection, remote = pair
+    remote.sendall(b"FIN1 100\nFIN")
+    assert received(connection) == [b"FIN1 100"]
+    remote.sendall(b"2 200\n")
+    assert received(connection) == [b"FIN2 200"]
+    assert received(connection) == []
+
+def test_connection_compacts_overlapping_partial_message(pair):
+    connection, remote = pair
+    partial = bytes(range(ord('a'), ord('z') + 1)) * 3
+    remote.sendall(b"F\n" + partial)
+    assert received(connection) == [b"F"]
+    remote.sendall(b"\n")
+    assert received(connection) == [partial]
+
+def test_connection_discards_oversized_message(pair):
+    connection, remote = pair
+    remote.sendall(b"x" * (BUFFER_SIZE + 10))
+    assert received(connection) == []
+    remote.sendall(b"\nFIN1 100\n")
+    assert received(connection)[-1] == b"FIN1 100"
+
+def test_connection_drain(pair):
+    connection, remote = pair
+    remote.sendall(b"HELLO 1 0\nHELLO 2 1\n")
+    assert connection.drain() == 2
+    assert received(connection) == []
+
+def test_connection_raises_bluetooth_error_when_closed(pair):
+    connection, remote = pair
+    remote.close()
+    with pytest.raises(bluetooth.btcommon.BluetoothError):
+        connection.receive()
+
+def test_connection_finish_time_falls_back_to_received(pair):
+    connection, _ = pair
+    assert connection.finish_time_ns(b"FIN1 100", 42) == 42
+    add_sample(connection.clock, 0)
+    assert connection.finish_time_ns(b"FIN1", 42) == 42
+
+def test_connection_finish_time_from_timestamp(pair):
+    connection, _ = pair
+    add_sample(connection.clock, NANOSECONDS_PER_SECOND)
+    crossed_ns = 2 * NANOSECONDS_PER_SECOND
+    message = "FIN1 {}".format(device_reading(crossed_ns)).encode()
+    assert connection.finish_time_ns(message, crossed_ns + 30000000) == \
+        pytest.approx(crossed_ns, abs=1000)
+
+def test_legacy_connection_picks_out_finishes():
+    local, remote = socket.socketpair()
+    connection = Connection(local, legacy=True)
+    try:
+        remote.sendall(b"noiseFIN1FI")
+        assert received(connection) == [b"FIN1"]
+        remote.sendall(b"N2")
+        assert received(connection) == [b"FIN2"]
+        connection.synchronize()    # Does nothing, as legacy firmware has no HELO
+        assert not connection.clock.is_synchronized()
+    finally:
+        connection.close()
+        remote.close()
+
+# vim: expandtab sw=4
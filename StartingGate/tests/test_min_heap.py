@@ -0,0 +1,87 @@
+"""
+Diecast Remote Raceway - MinHeap Tests
+
+MinHeap exists only in drr_server.js, whose modules need npm packages to load, so its
+class is extracted from the source and exercised under Node.js on its own.  Skipped
+where Node.js isn't installed.
+
+Author: Tom Quiggle
+tquiggle@gmail.com
+https://github.com/tquiggle/Die-Cast-Remote-Raceway
+
+Copyright (c) Thomas Quiggle. All rights reserved.
+
+Licensed under the MIT license. See LICENSE file in the project root for full license information.
+
+"""
+
+#pylint: disable=missing-function-docstring
+
+import json
+import os
+import re
+import shutil
+import subprocess
+
+import pytest
+
+COORDINATOR_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..',
+                               'Coordinator')
+
+pytestmark = pytest.mark.skipif(shutil.which('node') is None, reason="Node.js not installed")
+
+EXERCISE = """
+const heap = new MinHeap(item => item.key)
+const popped = []
+const sizes = []
+for (const step of STEPS) {
+    if (step === null) {
+        popped.push(heap.pop().key)
+    } else {
+        heap.push({key: step})
+    }
+    sizes.push(heap.size)
+}
+const peeked = heap.size > 0 ? heap.peek().key : null
+while (heap.size > 0) {
+    popped.push(heap.pop().key)
+}
+console.log(JSON.stringify({popped, sizes, peeked, empty: heap.pop() === undefined}))
+"""
+
+def min_heap_source():
+    with open(os.path.join(COORDINATOR_DIR, 'drr_server.js')) as source:
+        match = re.search(r'^class MinHeap \{.*?^\}$', source.read(), re.MULTILINE | re.DOTALL)
+    assert match, "class MinHeap not found in drr_server.js"
+    return match.group(0)
+
+def run_heap(steps):
+    """
+    Push each number of steps, popping for each None, then pop the rest.  Returns the
+    popped keys, the size after each step, the key peeked before popping the rest, and
+    whether popping the empty heap returned undefined.
+    """
+    script = "{}\nconst STEPS = {}\n{}".format(min_heap_source(), json.dumps(steps), EXERCISE)
+    output = subprocess.run(['node', '-e', script], capture_output=True, text=True,
+                            check=True, timeout=30).stdout
+    return json.loads(output)
+
+def test_pops_in_key_order():
+    keys = [5, 3, 9, 1, 7, 3, 8, 2, 6, 4, 0]
+    result = run_heap(keys)
+    assert result['popped'] == sorted(keys)
+    assert result['peeked'] == 0
+    assert result['empty']
+
+def test_interleaved_push_and_pop():
+    steps = [50, 20, None, 70, 10, 30, None, None, 60, 40, None, 5, None]
+    result = run_heap(steps)
+    assert result['popped'] == [20, 10, 30, 40, 5, 50, 60, 70]
+    assert result['sizes'] == [1, 2, 1, 2, 3, 4, 3, 2, 3, 4, 3, 4, 3]
+    assert result['peeked'] == 50
+
+def test_many_keys():
+    keys = [(index * 7919) % 1009 for index in range(500)]
+    assert run_heap(keys)['popped'] == sorted(keys)
+
+# vim: expandtab sw=4
@@ -0,0 +1,184 @@
+"""
+Diecast Remote Raceway - Coordinator Contract Tests
+
+Races Coordinator clients (coordinator.py), with virtual devices in place of the Starting
+Gate's buttons and lane sensors, against drr_reference.py over their channels
+(channel.py): register, start, results, resume and deregister.
+
+Author: Tom Quiggle
+tquiggle@gmail.com
+https://github.com/tquiggle/Die-Cast-Remote-Raceway
+
+Copyright (c) Thomas Quiggle. All rights reserved.
+
+Licensed under the MIT license. See LICENSE file in the project root for full license information.
+
+"""
+
+#pylint: disable=missing-function-docstring
+
+import itertools
+import time
+
+import pytest
+
+from channel import Channel, ChannelClosed
+from config import Config
+from coordinator import Coordinator
+from drr_load import VirtualDevice, in_parallel
+
+# Seconds allowed for any one request, far longer than the reference should take
+REQUEST_TIMEOUT = 20
+
+circuit_numbers = itertools.count()
+
+def make_track(reference, circuit, name):
+    """
+    A Coordinator client of reference, with a virtual device
+    """
+    config = Config(None)
+    config.coord_host = reference.host
+    config.coord_port = reference.port
+    config.circuit = circuit
+    config.track_name = "{}-{}".format(circuit, name)
+    config.num_lanes = 2
+    return Coordinator(config, VirtualDevice())
+
+def make_tracks(reference):
+    """
+    Two Coordinator clients of reference in a circuit of their own
+    """
+    circuit = "contract-{}".format(next(circuit_numbers))
+    return make_track(reference, circuit, 'A'), make_track(reference, circuit, 'B')
+
+def lane_results(offset):
+    """
+    Lane times for a two lane track, offset seconds slower than the fastest track
+    """
+    return [{'laneNumber': 1, 'laneTime': 2.0 + offset},
+            {'laneNumber': 2, 'laneTime': 2.5 + offset}]
+
+def post_results(*tracks):
+    """
+    Post results from every track at once.  Returns the standings each got back.
+    """
+    released = time.monotonic_ns()
+    calls = [lambda track=track, offset=offset: track.results(lane_results(offset), released)
+             for offset, track in enumerate(tracks)]
+    return in_parallel(*calls, timeout=REQUEST_TIMEOUT)
+
+def lose_channel(track):
+    """
+    Leave track holding a dead channel while the coordinator still sees its old one open,
+    as when the Starting Gate notices a dropped link first
+    """
+    live = track.channel
+    track.channel = Channel(track.channel_url)
+    track.channel.close()
+    return live
+
+def registered(reference, track):
+    return track.session_token in reference.session_to_circuit
+
+def test_register_race_deregister(reference):
+    first, second = make_tracks(reference)
+    in_parallel(first.register, second.register, timeout=REQUEST_TIMEOUT)
+
+    assert first.session_token and second.session_token
+    assert first.session_token != second.session_token
+    assert first.config.remote_track_name == second.config.track_name
+    assert second.config.remote_track_name == first.config.track_name
+
+    in_parallel(first.start_race, second.start_race, timeout=REQUEST_TIMEOUT)
+    assert first.race is not None and first.race == second.race
+    assert first.clock.is_synchronized()
+
+    standings = post_results(first, second)
+    assert standings[0] == standings[1]
+    assert len(standings[0]) == 4
+
+    assert first.deregister() and second.deregister()
+    assert not registered(reference, first)
+    assert not registered(reference, second)
+
+def test_resume_while_waiting_for_heat(reference):
+    first, second = make_tracks(reference)
+    in_parallel(first.register, second.register, timeout=REQUEST_TIMEOUT)
+
+    lose_channel(first)
+    in_parallel(first.start_race, second.start_race, timeout=REQUEST_TIMEOUT)
+    assert first.race == second.race
+    assert first.channel.is_open()
+    assert registered(reference, first)
+
+    post_results(first, second)
+    first.deregister()
+    second.deregister()
+
+def test_resume_after_start_reply_lost(reference):
+    """
+    The coordinator drew the track into a heat but the reply never arrived.  The resume
+    reply reports the race, which the track asks for again rather than abandoning it.
+    """
+    first, second = make_tracks(reference)
+    in_parallel(first.register, second.register, timeout=REQUEST_TIMEOUT)
+
+    live = first.channel
+    lost = in_parallel(lambda: live.request('start', timeout=REQUEST_TIMEOUT),
+                       second.start_race, timeout=REQUEST_TIMEOUT)[0]
+    lose_channel(first)
+    in_parallel(first.start_race, timeout=REQUEST_TIMEOUT)
+    assert first.race == lost['race'] == second.race
+
+    standings = post_results(first, second)
+    assert len(standings[0]) == 4
+    first.deregister()
+    second.deregister()
+
+def test_resume_during_results(reference):
+    first, second = make_tracks(reference)
+    in_parallel(first.register, second.register, timeout=REQUEST_TIMEOUT)
+    in_parallel(first.start_race, second.start_race, timeout=REQUEST_TIMEOUT)
+
+    lose_channel(second)
+    standings = post_results(first, second)
+    assert standings[0] == standings[1]
+    assert len(standings[0]) == 4
+    first.deregister()
+    second.deregister()
+
+def test_timeout_on_open_channel_not_resumed(reference):
+    """
+    A request that times out met a slow coordinator, so the channel is kept rather than
+    replaced by resuming
+    """
+    first, second = make_tracks(reference)
+    in_parallel(first.register, second.register, timeout=REQUEST_TIMEOUT)
+
+    channel = first.channel
+    request = first._Coordinator__channel_request #pylint: disable=protected-access
+    with pytest.raises(ChannelClosed):
+        request('start', timeout=0.2)  # No heat forms, as the second track isn't ready
+    assert first.channel is channel
+    assert channel.is_open()
+    first.deregister()
+    second.deregister()
+
+def test_resume_unknown_session_fails(reference):
+    """
+    A channel closed at both ends deregisters the track, so there is nothing to resume
+    """
+    first, second = make_tracks(reference)
+    in_parallel(first.register, second.register, timeout=REQUEST_TIMEOUT)
+
+    first.channel.close()
+    deadline = time.monotonic() + REQUEST_TIMEOUT
+    while registered(reference, first) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert not registered(reference, first)
+
+    with pytest.raises(ChannelClosed):
+        first.start_race()
+    second.deregister()
+
+# vim: expandtab sw=4